@@ -0,0 +1,28 @@
+#!/bin/bash
+#
+# Script to run the worker processes consuming the on-demand update queue
+#
+# How to use
+# ./bin/run_update_worker.sh <arguments>
+# All arguments are passed through to the Python script
+#
+# Example
+# ./bin/run_update_worker.sh --processes 2
+
+set -o errexit
+set -o pipefail
+set -o nounset
+
+CURRENT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+. $CURRENT_DIR/defaults.sh
+
+cd $SOURCE_PATH || exit
+
+# Use a virtual environment with our requirements
+set +u
+source $VIRTUAL_ENV_PATH/bin/activate
+set -u
+
+echo_time "Starting update workers."
+
+exec python -m integraality.update_worker "$@"
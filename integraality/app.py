@@ -2,22 +2,31 @@
 # -*- coding: utf-8  -*-
 """Flask web application."""
 
+import csv
+import io
+import itertools
+import math
 import traceback
 
 from flask import Flask, Response, jsonify, render_template, request
 
+from .cache import get_cache_client, get_local_cache
+from .labels import LabelService
+from .metrics import Metrics
 from .pages_processor import (
     PagesProcessor,
     ProcessingException,
     TransientServerException,
 )
+from .property_statistics import InvalidDrilldownException, PropertyStatistics
 from .sparql_utils import (
     QLeverSparqlQueryEngine,
     QueryException,
     SparqlEngineBuilder,
     add_prefixes_to_query,
 )
-from .sse import run_with_sse
+from .sse import format_sse, publish_partial_result
+from .update_jobs import UpdateJob, UpdateQueue
 
 app = Flask(__name__)
 
@@ -30,6 +39,28 @@ def get_qlever_ui_url(page_url):
     return "https://qlever.dev/wikidata/"
 
 
+def get_grouping_label(page_url, grouping, lang, cache=None):
+    """Return the label of the grouping, if it is an entity with one."""
+    engine = SparqlEngineBuilder.make(site_url=page_url)
+    try:
+        return LabelService(engine, cache=cache).get_label(grouping, lang)
+    except QueryException:
+        return None
+
+
+def iter_csv_lines(variables, rows):
+    """Yield the CSV lines of drill-down rows, one at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for values in itertools.chain(
+        [variables], ([row.get(var, "") for var in variables] for row in rows)
+    ):
+        writer.writerow(values)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
 @app.template_filter("add_prefixes")
 def add_prefixes_filter(query):
     """Jinja filter to add prefixes to SPARQL queries for QLever."""
@@ -41,6 +72,19 @@ def healthcheck():
     return jsonify(status="healthy")
 
 
+@app.route("/metrics")
+def metrics():
+    cache_client = get_cache_client()
+    get_local_cache(cache_client).flush_stats()
+    result = Metrics(cache_client).get_all()
+    for tier in ("local", "redis"):
+        hits = result.get(f"cache_{tier}_hits", 0)
+        lookups = hits + result.get(f"cache_{tier}_misses", 0)
+        if lookups:
+            result[f"cache_{tier}_hit_ratio"] = round(hits / lookups, 3)
+    return jsonify(result)
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -103,17 +147,98 @@ def _update_sync(page_url, page_title):
         )
 
 
+@app.route("/preview")
+def preview():
+    page_url = request.args.get("url")
+    page_title = request.args.get("page")
+    sample_rate = request.args.get("rate")
+    if sample_rate is not None:
+        try:
+            sample_rate = float(sample_rate)
+        except ValueError:
+            sample_rate = math.nan
+        # Also rejects nan and infinities, which fail both comparisons
+        if not 0 < sample_rate <= 1:
+            return (
+                render_template(
+                    "update_error.html",
+                    page_title=page_title,
+                    page_url=page_url,
+                    error_message="The sample rate must be a number between 0 and 1.",
+                ),
+                400,
+            )
+    processor = PagesProcessor(page_url)
+    try:
+        (output, elapsed_time) = processor.preview_one_page(
+            page_title, sample_rate=sample_rate
+        )
+        return render_template(
+            "preview.html",
+            page_title=page_title,
+            page_url=page_url,
+            output=output,
+            elapsed_time=elapsed_time,
+        )
+    except QueryException as e:
+        return render_template(
+            "update_query_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=e,
+            query=e.query,
+            qlever_ui_url=get_qlever_ui_url(page_url),
+        )
+    except TransientServerException as e:
+        return render_template(
+            "update_transient_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=e,
+        )
+    except ProcessingException as e:
+        return render_template(
+            "update_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=e,
+        )
+    except Exception as e:
+        return render_template(
+            "update_unknown_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=traceback.format_exception(type(e), e, e.__traceback__),
+        )
+
+
 @app.route("/update/stream")
 def update_stream():
     page_url = request.args.get("url")
     page_title = request.args.get("page")
 
-    def do_update():
+    def do_update(cancel_token):
         processor = PagesProcessor(page_url)
-        return processor.process_one_page(page_title)
+        return processor.process_one_page(
+            page_title,
+            cancel_token=cancel_token,
+            result_callback=publish_partial_result,
+        )
+
+    cache_client = get_cache_client()
+    job = UpdateJob(cache_client, page_url, page_title)
+    # Registered before the update starts, so that it is not seen as abandoned
+    watcher_id = job.add_watcher()
+    if job.acquire():
+        queue = UpdateQueue(cache_client)
+        if queue.has_workers():
+            queue.submit(job)
+        else:
+            # No worker process is running (e.g. in local development)
+            job.start(do_update)
 
     return Response(
-        run_with_sse(do_update),
+        format_sse(job.iter_events(watcher_id)),
         mimetype="text/event-stream",
         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
@@ -125,27 +250,36 @@ def queries():
     page_title = request.args.get("page")
     column_key = request.args.get("column") or request.args.get("property")
     output_format = request.args.get("format")
+    lang = request.args.get("lang", "en")
     processor = PagesProcessor(page_url)
     try:
-        stats = processor.make_stats_object_for_page_title(page_title)
         grouping = request.args.get("grouping")
-        query_data = stats.get_queries_for_column(column_key, grouping)
+        query_data, grouping_label = processor.get_cached_queries_for_column(
+            page_title, column_key, grouping, lang
+        )
+        if query_data is None:
+            stats = processor.make_stats_object_for_page_title(page_title)
+            query_data = PropertyStatistics.describe_queries(
+                stats.get_queries_for_column(column_key, grouping)
+            )
 
-        column = query_data["column"]
-        positive_query = query_data["positive_query"]
-        negative_query = query_data["negative_query"]
-        formatted_predicate = query_data["formatted_predicate"]
         qlever_ui_url = get_qlever_ui_url(page_url)
+        if grouping_label is None:
+            grouping_label = get_grouping_label(
+                page_url, grouping, lang, cache=processor.cache
+            )
+        grouping_label = grouping_label or None
 
         if output_format == "json":
             return jsonify(
                 page_title=page_title,
                 page_url=page_url,
-                column=column.get_key(),
+                column=query_data["column"],
                 grouping=grouping,
-                formatted_predicate=formatted_predicate,
-                positive_query=positive_query,
-                negative_query=negative_query,
+                grouping_label=grouping_label,
+                formatted_predicate=query_data["formatted_predicate"],
+                positive_query=query_data["positive_query"],
+                negative_query=query_data["negative_query"],
                 qlever_ui_url=qlever_ui_url,
             )
 
@@ -153,12 +287,10 @@ def queries():
             "queries.html",
             page_title=page_title,
             page_url=page_url,
-            column=column,
             grouping=grouping,
-            formatted_predicate=formatted_predicate,
-            positive_query=positive_query,
-            negative_query=negative_query,
+            grouping_label=grouping_label,
             qlever_ui_url=qlever_ui_url,
+            **query_data,
         )
     except ProcessingException as e:
         if output_format == "json":
@@ -180,6 +312,101 @@ def queries():
         )
 
 
+@app.route("/drilldown")
+def drilldown():
+    page_url = request.args.get("url")
+    page_title = request.args.get("page")
+    column_key = request.args.get("column")
+    grouping = request.args.get("grouping")
+    kind = "negative" if request.args.get("kind") == "negative" else "positive"
+    after = request.args.get("after")
+    output_format = request.args.get("format")
+    processor = PagesProcessor(page_url)
+    try:
+        stats = processor.make_stats_object_for_page_title(page_title)
+        if column_key not in stats.columns:
+            raise ProcessingException(f"There is no column {column_key} on this page.")
+        result = stats.get_drilldown_page(
+            column_key, grouping, positive=kind == "positive", after=after
+        )
+        if output_format == "json":
+            return jsonify(
+                page_title=page_title,
+                page_url=page_url,
+                column=column_key,
+                grouping=grouping,
+                kind=kind,
+                after=after,
+                **result,
+            )
+        if output_format == "csv":
+            return Response(
+                iter_csv_lines(result["variables"], result["rows"]),
+                mimetype="text/csv",
+                headers={"X-Next-After": result["next"] or ""},
+            )
+        return render_template(
+            "drilldown.html",
+            page_title=page_title,
+            page_url=page_url,
+            column=column_key,
+            grouping=grouping,
+            kind=kind,
+            after=after,
+            **result,
+        )
+    except InvalidDrilldownException as e:
+        if output_format in ("json", "csv"):
+            return jsonify(error=str(e)), 400
+        return (
+            render_template(
+                "queries_error.html",
+                page_title=page_title,
+                page_url=page_url,
+                error_message=e,
+            ),
+            400,
+        )
+    except ProcessingException as e:
+        if output_format in ("json", "csv"):
+            return jsonify(error=str(e)), 422
+        return render_template(
+            "queries_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=e,
+        )
+    except QueryException as e:
+        if output_format in ("json", "csv"):
+            return jsonify(error=str(e)), 504
+        return render_template(
+            "queries_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_type="The query timed out or returned no result.",
+            error_message=e,
+        )
+    except TransientServerException as e:
+        if output_format in ("json", "csv"):
+            return jsonify(error=str(e)), 503
+        return render_template(
+            "queries_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_type="A temporary server issue occurred.",
+            error_message=e,
+        )
+    except Exception as e:
+        if output_format in ("json", "csv"):
+            return jsonify(error=str(e)), 500
+        return render_template(
+            "queries_unknown_error.html",
+            page_title=page_title,
+            page_url=page_url,
+            error_message=traceback.format_exception(type(e), e, e.__traceback__),
+        )
+
+
 @app.errorhandler(404)
 def page_not_found(error):
     return render_template("page_not_found.html", title="Page not found"), 404
@@ -1,48 +1,534 @@
-"""Redis cache for parsed configs."""
+"""Redis cache for dashboard configs."""
 
 # Inspired/copied from https://github.com/taylorhakes/python-redis-cache/blob/master/redis_cache/__init__.py, MIT-licensed
 
-import pickle
+import collections
+import copy
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+import zlib
+
+from redis import StrictRedis
+from redis.exceptions import ConnectionError, WatchError
+
+from .metrics import Metrics
 
 DEFAULT_TTL = 604800  # 1 week
+INVALIDATION_CHANNEL = "integraality:cache:invalidate"
+
+_cache_client = None
+_local_caches = weakref.WeakKeyDictionary()
+_local_caches_lock = threading.Lock()
+
+
+def get_cache_client():
+    """Return the Redis client shared by the whole process.
+
+    The client holds a connection pool, so reusing it spares every request
+    the cost of setting up a new connection.
+    """
+    global _cache_client
+    if _cache_client is None:
+        host = os.getenv("REDIS_HOST", "tools-redis.svc.eqiad.wmflabs")
+        _cache_client = StrictRedis(host=host, decode_responses=False)
+    return _cache_client
+
+
+def publish_invalidations(cache_client, keys):
+    """Tell the local tier of every process to drop the (namespaced) keys."""
+    pipe = cache_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.publish(INVALIDATION_CHANNEL, key)
+    pipe.execute()
+
+
+def get_local_cache(cache_client):
+    """Return the in-process cache of this process for the given Redis client."""
+    with _local_caches_lock:
+        local_cache = _local_caches.get(cache_client)
+        if local_cache is None:
+            local_cache = LocalCache(cache_client)
+            _local_caches[cache_client] = local_cache
+        return local_cache
+
+
+class LocalCache:
+    """
+    In-process LRU cache, bounded in size and in time.
+
+    Invalidations are broadcast over Redis pub/sub. They are not listened to
+    in a thread, but drained from the subscription before every lookup: this
+    is a non-blocking read on an already open socket.
+
+    Hit and miss counts of both tiers are kept here, and added to the shared
+    Metrics every STATS_FLUSH_INTERVAL.
+    """
+
+    STATS_FLUSH_INTERVAL = 60
+
+    def __init__(self, cache_client, max_size=256, ttl=300):
+        self.client = cache_client
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pubsub = None
+        # PubSub objects are not thread-safe
+        self._pubsub_lock = threading.Lock()
+        self.stats = collections.Counter()
+        self._stats_flushed_at = time.monotonic()
+
+    def _subscribe(self):
+        self._pubsub = self.client.pubsub()
+        self._pubsub.subscribe(INVALIDATION_CHANNEL)
+
+    def _drain_invalidations(self):
+        # Another thread draining the subscription reads the same messages
+        if not self._pubsub_lock.acquire(blocking=False):
+            return
+        try:
+            self._drain_subscription()
+        finally:
+            self._pubsub_lock.release()
+
+    def _drain_subscription(self):
+        if self._pubsub is None:
+            # Nothing can be cached before the first lookup
+            self._subscribe()
+            return
+        try:
+            # Subscription confirmations are not skipped by get_message, as
+            # it would then return None while messages are still pending.
+            message = self._pubsub.get_message()
+            while message:
+                if message["type"] == "message":
+                    self.discard(message["data"].decode())
+                message = self._pubsub.get_message()
+        except ConnectionError:
+            # Invalidations may have been missed
+            self.clear()
+            self._subscribe()
+
+    def get(self, key):
+        self._drain_invalidations()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def publish_invalidation(self, *keys):
+        publish_invalidations(self.client, keys)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+            due = time.monotonic() - self._stats_flushed_at >= self.STATS_FLUSH_INTERVAL
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        with self._lock:
+            stats, self.stats = self.stats, collections.Counter()
+            self._stats_flushed_at = time.monotonic()
+        Metrics(self.client).incr_many(stats)
 
 
 class RedisCache:
+    """
+    Cache of JSON-serializable values.
+
+    Keys embed FORMAT_VERSION: a change to what is stored must bump it, so
+    that old and new code running side by side during a deploy do not read
+    each other's entries. Values are compact JSON, compressed with zlib above
+    COMPRESSION_THRESHOLD bytes, after a one-byte header telling which.
+    """
+
+    FORMAT_VERSION = 1
+    COMPRESSION_THRESHOLD = 1024
+    PLAIN_HEADER = b"j"
+    COMPRESSED_HEADER = b"z"
+
+    COMPUTE_LOCK_TTL = 30
+    COMPUTE_WAIT = 5
+    COMPUTE_POLL_INTERVAL = 0.1
+    STALE_TTL = 3600
+
     def __init__(self, cache_client, prefix="integraality"):
         self.prefix = prefix
         self.client = cache_client
 
     def make_key(self, key):
-        return "{0}:{1}".format(self.prefix, key)
+        return "{0}:v{1}:{2}".format(self.prefix, self.FORMAT_VERSION, key)
+
+    @property
+    def redis_tier(self):
+        """The cache without any local tier, for values never kept there."""
+        return self
+
+    @classmethod
+    def dumps(cls, value):
+        data = json.dumps(value, separators=(",", ":")).encode()
+        if len(data) >= cls.COMPRESSION_THRESHOLD:
+            return cls.COMPRESSED_HEADER + zlib.compress(data)
+        return cls.PLAIN_HEADER + data
+
+    @classmethod
+    def loads(cls, cached_value):
+        header, data = cached_value[:1], cached_value[1:]
+        if header == cls.COMPRESSED_HEADER:
+            data = zlib.decompress(data)
+        elif header != cls.PLAIN_HEADER:
+            raise ValueError(f"Unknown cache value header {header!r}")
+        return json.loads(data)
 
     def get_cache_value(self, key):
-        ns_key = self.make_key(key)
+        return self._get_decoded(self.make_key(key))
+
+    def _get_decoded(self, ns_key):
         cached_value = self.client.get(ns_key)
         if cached_value:
             try:
-                return pickle.loads(cached_value)
-            except (AttributeError, ModuleNotFoundError, pickle.UnpicklingError):
+                return self.loads(cached_value)
+            except (ValueError, zlib.error):
                 self.client.delete(ns_key)
                 return None
         else:
             return None
 
-    def set_cache_value(self, key, value):
+    def get_cache_values(self, keys):
+        """Return the {key: value} dict of the keys found, in one round-trip."""
+        if not keys:
+            return {}
+        values = {}
+        for key, cached_value in zip(
+            keys, self.client.mget([self.make_key(key) for key in keys])
+        ):
+            if not cached_value:
+                continue
+            try:
+                values[key] = self.loads(cached_value)
+            except (ValueError, zlib.error):
+                continue
+        return values
+
+    def get_or_compute(self, key, compute, ttl=DEFAULT_TTL):
+        """
+        Return the value cached at key, computing and caching it on a miss.
+
+        Only one caller computes a given key at a time. The others serve the
+        value it had before being invalidated, if any; otherwise they wait up
+        to COMPUTE_WAIT seconds for it to be computed, then compute it
+        themselves.
+        """
+        value = self.get_cache_value(key)
+        if value is not None:
+            return value
+
+        ns_key = self.make_key(key)
+        lock_key = f"{ns_key}:lock"
+        token = uuid.uuid4().hex
+        if not self.client.set(lock_key, token, nx=True, ex=self.COMPUTE_LOCK_TTL):
+            value = self._get_decoded(f"{ns_key}:stale")
+            if value is not None:
+                return value
+            deadline = time.monotonic() + self.COMPUTE_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(self.COMPUTE_POLL_INTERVAL)
+                value = self.get_cache_value(key)
+                if value is not None:
+                    return value
+            token = None
+
+        try:
+            value = compute()
+            self.set_cache_value(key, value, ttl=ttl)
+            return value
+        finally:
+            if token is not None:
+                self._release_lock(lock_key, token)
+
+    def _release_lock(self, lock_key, token):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == token.encode():
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    def set_cache_value(self, key, value, ttl=DEFAULT_TTL):
+        self.set_cache_values({key: value}, ttl=ttl)
+
+    def set_cache_values(self, values, ttl=DEFAULT_TTL):
+        """Cache all the values of a {key: value} dict in one round-trip."""
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(self.make_key(key), self.dumps(value), ex=ttl)
+        pipe.execute()
+
+    def set_cache_mapping(self, key, mapping):
+        """Replace the hash stored at key with the JSON-encoded mapping values."""
         ns_key = self.make_key(key)
-        cached_value = pickle.dumps(value)
         pipe = self.client.pipeline()
-        pipe.set(ns_key, cached_value)
-        pipe.expire(ns_key, DEFAULT_TTL)
+        pipe.delete(ns_key)
+        # One field per HSET, as multi-field HSET needs Redis 4
+        for field, value in mapping.items():
+            pipe.hset(ns_key, field, json.dumps(value))
+        if mapping:
+            pipe.expire(ns_key, DEFAULT_TTL)
         pipe.execute()
 
+    def get_cache_mapping_value(self, key, field):
+        """Return one decoded value of the hash stored at key, or None."""
+        return self.get_cache_mapping_values(key, [field])[0]
+
+    def get_cache_mapping_values(self, key, fields):
+        """Return the decoded values (or None) of the fields, in one round-trip."""
+        values = []
+        for cached_value in self.client.hmget(self.make_key(key), fields):
+            try:
+                values.append(
+                    None if cached_value is None else json.loads(cached_value)
+                )
+            except ValueError:
+                values.append(None)
+        return values
+
+    def invalidate_mapping(self, key):
+        """Remove the hash stored at key."""
+        self.client.delete(self.make_key(key))
+
     def invalidate(self, key):
+        """Remove the value, keeping it for a while as stale for get_or_compute."""
         ns_key = self.make_key(key)
+        cached_value = self.client.get(ns_key)
         pipe = self.client.pipeline()
         pipe.delete(ns_key)
+        if cached_value:
+            pipe.set(f"{ns_key}:stale", cached_value, ex=self.STALE_TTL)
         pipe.execute()
 
-    def list_keys(self):
-        return self.client.keys()
+    def iter_keys(self, pattern="*", count=500):
+        """
+        Iterate over the keys of this cache matching the pattern.
+
+        Uses SCAN, which walks the keyspace a batch at a time instead of
+        blocking the shared Redis server for its whole length like KEYS.
+        """
+        for key in self.client.scan_iter(match=f"{self.prefix}:{pattern}", count=count):
+            yield key.decode()
+
+    def list_keys(self, pattern="*"):
+        return list(self.iter_keys(pattern))
+
+    def invalidate_prefix(self, pattern="v*:*", batch_size=500):
+        """
+        Delete the keys of this cache matching the pattern, by default all
+        cached values whatever their format version, and return their number.
+
+        The deleted keys are also dropped from the local tier of the web
+        processes, batch by batch.
+        """
+        count = 0
+        keys = self.iter_keys(pattern, count=batch_size)
+        while batch := list(itertools.islice(keys, batch_size)):
+            self.client.delete(*batch)
+            publish_invalidations(self.client, batch)
+            count += len(batch)
+        return count
+
+    def describe_key(self, key):
+        """Return the kind of entry a key of this cache holds."""
+        rest = key[len(self.prefix) + 1 :]
+        match = re.match(r"v(\d+):", rest)
+        if not match:
+            if rest.startswith("update:"):
+                return "update"
+            if rest == "metrics":
+                return "metrics"
+            return "unversioned"
+        kind = "queries" if rest[match.end() :].startswith("queries:") else "config"
+        if int(match.group(1)) != self.FORMAT_VERSION:
+            return f"v{match.group(1)} {kind} (outdated)"
+        if rest.endswith(":stale"):
+            return f"{kind} (stale)"
+        if rest.endswith(":lock"):
+            return f"{kind} (lock)"
+        return kind
+
+    TTL_BUCKETS = (
+        (3600, "< 1 hour"),
+        (86400, "< 1 day"),
+        (DEFAULT_TTL + 1, "<= 1 week"),
+    )
+
+    @classmethod
+    def describe_ttl(cls, ttl):
+        if ttl < 0:
+            return "no expiry"
+        for limit, label in cls.TTL_BUCKETS:
+            if ttl < limit:
+                return label
+        return "> 1 week"
+
+    def get_stats(self, pattern="*", batch_size=500):
+        """
+        Return, for each kind of entry, the number of keys, the total size of
+        their values in bytes, and their distribution by time to live.
+        """
+        stats = collections.defaultdict(
+            lambda: {"count": 0, "size": 0, "ttl": collections.Counter()}
+        )
+        keys = self.iter_keys(pattern, count=batch_size)
+        while batch := list(itertools.islice(keys, batch_size)):
+            pipe = self.client.pipeline(transaction=False)
+            for key in batch:
+                pipe.type(key)
+                pipe.ttl(key)
+            replies = pipe.execute()
+            types = [key_type.decode() for key_type in replies[::2]]
+            ttls = replies[1::2]
+
+            # Only strings and hashes hold cached values; other types count
+            # for nothing.
+            sizes = dict.fromkeys(batch, 0)
+            sized_keys = []
+            pipe = self.client.pipeline(transaction=False)
+            for key, key_type in zip(batch, types):
+                if key_type == "string":
+                    pipe.strlen(key)
+                    sized_keys.append(key)
+                elif key_type == "hash":
+                    pipe.hvals(key)
+                    sized_keys.append(key)
+            for key, reply in zip(sized_keys, pipe.execute()):
+                sizes[key] = sum(map(len, reply)) if isinstance(reply, list) else reply
+
+            for key, ttl in zip(batch, ttls):
+                kind_stats = stats[self.describe_key(key)]
+                kind_stats["count"] += 1
+                kind_stats["size"] += sizes[key]
+                kind_stats["ttl"][self.describe_ttl(ttl)] += 1
+        return dict(stats)
+
+
+class TieredCache(RedisCache):
+    """
+    RedisCache with the values also kept decoded in an in-process LocalCache,
+    which spares the network round-trip and the decoding for popular
+    dashboards.
+    """
+
+    def __init__(self, cache_client, prefix="integraality", local_cache=None):
+        super().__init__(cache_client, prefix=prefix)
+        self.local = local_cache or get_local_cache(cache_client)
+
+    @property
+    def redis_tier(self):
+        # Writing through it spares broadcasting invalidations
+        return RedisCache(self.client, prefix=self.prefix)
+
+    def get_cache_value(self, key):
+        ns_key = self.make_key(key)
+        value = self.local.get(ns_key)
+        if value is not None:
+            self.local.count("cache_local_hits")
+            # Callers may alter the top level of what they are given
+            return copy.copy(value)
+        self.local.count("cache_local_misses")
+        value = super().get_cache_value(key)
+        if value is None:
+            self.local.count("cache_redis_misses")
+            return None
+        self.local.count("cache_redis_hits")
+        self.local.set(ns_key, value)
+        return copy.copy(value)
+
+    def set_cache_values(self, values, ttl=DEFAULT_TTL):
+        super().set_cache_values(values, ttl=ttl)
+        self._invalidate_local(*values.keys())
+
+    def invalidate(self, key):
+        super().invalidate(key)
+        self._invalidate_local(key)
+
+    def _invalidate_local(self, *keys):
+        ns_keys = [self.make_key(key) for key in keys]
+        for ns_key in ns_keys:
+            self.local.discard(ns_key)
+        self.local.publish_invalidation(*ns_keys)
+
+
+def args_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect the inteGraality cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats_parser = subparsers.add_parser(
+        "stats", help="report key counts, sizes and TTLs by kind of entry"
+    )
+    stats_parser.add_argument(
+        "--pattern", default="*", help="only consider keys matching the pattern"
+    )
+    invalidate_parser = subparsers.add_parser(
+        "invalidate", help="delete the cached values matching a pattern"
+    )
+    invalidate_parser.add_argument(
+        "--pattern",
+        default="v*:*",
+        help="pattern of the keys to delete, after the prefix (default: all cached values)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    cache = RedisCache(get_cache_client())
+    if args.command == "invalidate":
+        count = cache.invalidate_prefix(args.pattern)
+        print(f"Deleted {count} keys")
+        return
+    stats = cache.get_stats(args.pattern)
+    for kind, kind_stats in sorted(stats.items()):
+        ttls = ", ".join(
+            f"{label}: {count}" for label, count in sorted(kind_stats["ttl"].items())
+        )
+        print(
+            f"{kind}: {kind_stats['count']} keys, {kind_stats['size']} bytes ({ttls})"
+        )
+    stale_count = sum(
+        kind_stats["count"]
+        for kind, kind_stats in stats.items()
+        if kind.endswith(("(stale)", "(outdated)")) or kind == "unversioned"
+    )
+    print(f"Stale entries: {stale_count}")
+
 
-    def flushall(self):
-        self.client.flushall()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Cooperative cancellation of running updates."""
+
+import contextlib
+import threading
+import time
+
+from .error_category import ErrorCategory
+
+
+class UpdateCancelledException(Exception):
+    error_category = ErrorCategory.TRANSIENT
+
+    def __init__(self, message="The update was cancelled."):
+        super().__init__(message)
+
+
+class CancelToken:
+    """
+    Flag checked by long-running code between units of work.
+
+    The token can be cancelled directly, or through a check callable
+    (e.g. "is anyone still waiting for this update?"), which is polled at
+    most once every CHECK_INTERVAL seconds as it may be costly.
+    """
+
+    CHECK_INTERVAL = 1
+
+    def __init__(self, check=None):
+        self._event = threading.Event()
+        self._check = check
+        self._last_check = None
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self._check is not None:
+            now = time.monotonic()
+            if self._last_check is None or (
+                now - self._last_check >= self.CHECK_INTERVAL
+            ):
+                self._last_check = now
+                if self._check():
+                    self.cancel()
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise UpdateCancelledException()
+
+    @property
+    def query_time_left(self):
+        """Seconds left to the running query, None as it has no deadline."""
+        return None
+
+
+class DeadlineExceededException(Exception):
+    error_category = ErrorCategory.QUERY
+
+    def __init__(self, message="The query ran past its deadline."):
+        super().__init__(message)
+
+
+class TimeBudget:
+    """
+    Time allotted to an update, shared out between its queries.
+
+    Within query_deadline, a query is given its share of the time left;
+    the budget then acts as a cancel token, cancelled once that deadline is
+    past or its parent token is cancelled. Outside of it, only the parent
+    token is checked.
+    """
+
+    def __init__(self, seconds, parent=None):
+        self.expires_at = time.monotonic() + seconds
+        self.parent = parent
+        self._deadline = None
+
+    def get_remaining(self):
+        return max(0, self.expires_at - time.monotonic())
+
+    def reset(self, seconds):
+        """Allot seconds from now, e.g. to retry what ran past its deadline."""
+        self.expires_at = time.monotonic() + seconds
+
+    @contextlib.contextmanager
+    def query_deadline(self, remaining_queries):
+        """Give the next query its share of the time left to remaining_queries."""
+        self._deadline = time.monotonic() + self.get_remaining() / max(
+            1, remaining_queries
+        )
+        try:
+            yield
+        finally:
+            self._deadline = None
+
+    @property
+    def expired(self):
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    @property
+    def query_time_left(self):
+        """Seconds left to the running query, None outside of query_deadline."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.monotonic())
+
+    @property
+    def cancelled(self):
+        return self.expired or (self.parent is not None and self.parent.cancelled)
+
+    def raise_if_cancelled(self):
+        if self.parent is not None:
+            self.parent.raise_if_cancelled()
+        if self.expired:
+            raise DeadlineExceededException()
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 """Column types."""
 
+import collections
+import functools
 import json
 import os
 
@@ -25,10 +27,12 @@ def _format_value_sparql(value):
 
 class ColumnMaker:
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _load_wikiprojects():
         current_dir = os.path.dirname(__file__)
         wikiprojects_path = os.path.join(current_dir, "wikiprojects.json")
-        return json.load(open(wikiprojects_path, "r"))
+        with open(wikiprojects_path, "r") as wikiprojects_file:
+            return json.load(wikiprojects_file)
 
     @staticmethod
     def make(key, title):
@@ -186,17 +190,23 @@ class ColumnMaker:
 
 
 class AbstractColumn:
-    def get_info_query(self, property_statistics):
+    def get_info_query(
+        self, property_statistics, property_threshold=None, groupings=None
+    ):
         """
         Get the usage counts for a column for the groupings
 
+        :param property_threshold: overrides the threshold of the statistics
+        :param groupings: restricts the query to these grouping values
         :return: (str) SPARQL query
         """
+        if property_threshold is None:
+            property_threshold = property_statistics.property_threshold
         grouping_selector = "\n".join(
             property_statistics.grouping_configuration.get_grouping_selector()
         )
         values_clause_lines = (
-            property_statistics.grouping_configuration.get_values_clause()
+            property_statistics.grouping_configuration.get_values_clause(groupings)
         )
         values_clause = (
             "\n" + "\n".join(values_clause_lines) if values_clause_lines else ""
@@ -209,7 +219,7 @@ SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {{
   }})
 }}
 GROUP BY ?grouping
-HAVING (?count >= {property_statistics.property_threshold})
+HAVING (?count >= {property_threshold})
 ORDER BY DESC(?count)
 LIMIT 1000
 """
@@ -242,12 +252,40 @@ SELECT (COUNT(*) AS ?count) WHERE {{
   FILTER(EXISTS {{{self.get_filter_for_info()}
   }})
 }}
+"""
+        return query
+
+    def get_totals_and_no_grouping_query(self, property_statistics):
+        """
+        Get the totals of entities with the column set, and among them the
+        count of those without a grouping.
+
+        :return: (str) SPARQL query
+        """
+        query = f"""
+SELECT (COUNT(*) AS ?count) (SUM(?no_grouping) AS ?no_grouping_count) WHERE {{
+  ?entity {property_statistics.selector_sparql} .
+  BIND(IF(EXISTS {{ ?entity {property_statistics.grouping_configuration.get_predicate()} [] }}, 0, 1) AS ?no_grouping)
+  FILTER(EXISTS {{{self.get_filter_for_info()}
+  }})
+}}
 """
         return query
 
     def make_column_header(self):
         return f'! data-sort-type="number"|{self.get_column_label()}\n'
 
+    def get_filter_for_entity_page(self, positive=True):
+        """
+        Get the filter selecting the entities of a drill-down page, without
+        what is shown about them.
+        """
+        if positive:
+            (column_filter, _) = self.get_filter_for_positive_query()
+        else:
+            (column_filter, _) = self.get_filter_for_negative_query()
+        return column_filter
+
 
 class PropertyColumn(AbstractColumn):
     def __init__(self, property, title=None):
@@ -465,7 +503,18 @@ class ReferenceColumn(PropertyColumn):
       }}
     }}"""
 
-    def get_filter_for_positive_query(self):
+    def get_filter_for_entity_page(self, positive=True):
+        if positive:
+            (column_filter, _) = self.get_filter_for_positive_query(with_details=False)
+        else:
+            (column_filter, _) = self.get_filter_for_negative_query(with_details=False)
+        return column_filter
+
+    def get_filter_for_positive_query(self, with_details=True):
+        """
+        :param with_details: whether to bind the statement and reference
+            values shown in the drill-down
+        """
         ref_pattern = self.reference_check.sparql_pattern()
         indented_ref = ref_pattern.replace("\n", "\n      ")
         vc = self._value_constraint("?_unreferenced_stmt")
@@ -483,7 +532,12 @@ class ReferenceColumn(PropertyColumn):
         else:
             statement_qualifier = ""
         # Optionally bind reference value(s) from the reference node
-        ref_value_result = self.reference_check.sparql_ref_value_binding("?statement")
+        if with_details:
+            ref_value_result = self.reference_check.sparql_ref_value_binding(
+                "?statement"
+            )
+        else:
+            ref_value_result = None
         if ref_value_result:
             ref_value_lines, ref_vars = ref_value_result
             ref_value_fragment = "\n".join(f"  {line}" for line in ref_value_lines)
@@ -506,7 +560,7 @@ class ReferenceColumn(PropertyColumn):
             select_vars,
         )
 
-    def get_filter_for_negative_query(self):
+    def get_filter_for_negative_query(self, with_details=True):
         # Matches items that either lack the property (or specific value) entirely,
         # or have at least one unreferenced statement:
         # - First OPTIONAL binds ?_unreferenced_stmt only if an unreferenced statement exists
@@ -530,11 +584,13 @@ class ReferenceColumn(PropertyColumn):
         any_qualifier_line = f"\n    {qc_any}" if qc_any else ""
         # Show the statement value in the drill-down results.
         # Use explicit two-triple pattern (not property path) for QLever compatibility.
-        if self.value:
+        if not with_details:
+            show_value = ""
+        elif self.value:
             value_ref = _format_value_sparql(self.value)
-            show_value = f"  OPTIONAL {{ ?entity p:{self.property} ?_show_stmt . ?_show_stmt ps:{self.property} {value_ref} . BIND({value_ref} AS ?value) }}"
+            show_value = f"  OPTIONAL {{ ?entity p:{self.property} ?_show_stmt . ?_show_stmt ps:{self.property} {value_ref} . BIND({value_ref} AS ?value) }}\n"
         else:
-            show_value = f"  OPTIONAL {{ ?entity p:{self.property} ?_show_stmt . ?_show_stmt ps:{self.property} ?value . }}"
+            show_value = f"  OPTIONAL {{ ?entity p:{self.property} ?_show_stmt . ?_show_stmt ps:{self.property} ?value . }}\n"
         return (
             f"""
   OPTIONAL {{
@@ -545,12 +601,117 @@ class ReferenceColumn(PropertyColumn):
   }}
   OPTIONAL {{ ?entity p:{self.property} ?_any_stmt .{any_value_line}{any_qualifier_line} }}
   FILTER(!BOUND(?_any_stmt) || BOUND(?_unreferenced_stmt))
-{show_value}
-""",
+{show_value}""",
             ["?entity", "?value"],
         )
 
 
+class ReferenceScan:
+    """
+    Reference columns on the same statements (same property, value and
+    qualifier), counted together.
+
+    Rather than one query per column, each looking for an unreferenced
+    statement, a single query goes through the statements once, checks each
+    of them against all the reference checks, and counts per grouping the
+    entities with all their statements referenced for each check.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @staticmethod
+    def get_scan_key(column):
+        return (column.property, column.value, column.qualifier)
+
+    @classmethod
+    def make_scans(cls, columns):
+        """
+        Return the scans of the reference columns sharing their statements
+        with another column.
+
+        :param columns: the {key: column} dict of the statistics
+        """
+        columns_by_scan_key = collections.defaultdict(dict)
+        for key, column in columns.items():
+            if isinstance(column, ReferenceColumn):
+                columns_by_scan_key[cls.get_scan_key(column)][key] = column
+        return [
+            cls(scan_columns)
+            for scan_columns in columns_by_scan_key.values()
+            if len(scan_columns) > 1
+        ]
+
+    def get_statement_patterns(self):
+        column = next(iter(self.columns.values()))
+        patterns = [f"?entity p:{column.property} ?_unreferenced_stmt ."]
+        for constraint in (
+            column._value_constraint("?_unreferenced_stmt"),
+            column._qualifier_constraint("?_unreferenced_stmt"),
+        ):
+            if constraint:
+                patterns.append(constraint)
+        return patterns
+
+    def get_info_query(
+        self, property_statistics, property_threshold=None, groupings=None
+    ):
+        """
+        Get the usage counts of the columns for the groupings, as ?count_0,
+        ?count_1… in the order of the columns.
+
+        :param property_threshold: overrides the threshold of the statistics
+        :param groupings: restricts the query to these grouping values
+        :return: (str) SPARQL query
+        """
+        if property_threshold is None:
+            property_threshold = property_statistics.property_threshold
+        grouping_selector = "\n".join(
+            property_statistics.grouping_configuration.get_grouping_selector()
+        )
+        values_clause_lines = (
+            property_statistics.grouping_configuration.get_values_clause(groupings)
+        )
+        values_clause = (
+            "\n" + "\n".join(values_clause_lines) if values_clause_lines else ""
+        )
+        counts = []
+        referenced = []
+        checks = []
+        having = []
+        for i, column in enumerate(self.columns.values()):
+            counts.append(f"(SUM(?referenced_{i}) AS ?count_{i})")
+            referenced.append(f"(MIN(?statement_referenced_{i}) AS ?referenced_{i})")
+            ref_pattern = column.reference_check.sparql_pattern().replace(
+                "\n", "\n    "
+            )
+            checks.append(
+                f"  BIND(IF(EXISTS {{\n    {ref_pattern}\n  }}, 1, 0) "
+                f"AS ?statement_referenced_{i})"
+            )
+            having.append(f"?count_{i} >= {property_threshold}")
+        statement_patterns = "\n".join(
+            f"  {pattern}" for pattern in self.get_statement_patterns()
+        )
+        checks = "\n".join(checks)
+        query = f"""
+SELECT ?grouping {" ".join(counts)} WHERE {{
+  {{
+    SELECT ?entity ?grouping {" ".join(referenced)} WHERE {{
+  ?entity {property_statistics.selector_sparql} .
+{grouping_selector}{values_clause}
+{statement_patterns}
+{checks}
+    }}
+    GROUP BY ?entity ?grouping
+  }}
+}}
+GROUP BY ?grouping
+HAVING ({" || ".join(having)})
+"""
+        return query
+
+
 class TextColumn(AbstractColumn):
     def __init__(self, language, title=None):
         self.language = language
@@ -52,3 +52,98 @@ def ensure_schema(conn):
         for statement in _read_schema():
             cur.execute(statement)
     conn.commit()
+
+
+class DashboardRegistry:
+    """
+    The dashboards of a site, with the outcome of their last run.
+
+    The source of truth for the pages to process. It is kept in sync with
+    the pages transcluding the dashboard template by reconcile().
+    """
+
+    def __init__(self, conn, site_url):
+        self.conn = conn
+        self.site_url = site_url
+
+    def needs_reconciliation(self, max_age):
+        """Whether the registry was not reconciled in the last max_age seconds."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT MAX(last_seen_at) >= UTC_TIMESTAMP() - INTERVAL %s SECOND "
+                "FROM dashboards WHERE site_url = %s",
+                (max_age, self.site_url),
+            )
+            (fresh,) = cur.fetchone()
+        return not fresh
+
+    def reconcile(self, page_titles):
+        """
+        Register the given pages, and forget the ones no longer among them.
+
+        Return the numbers of pages registered and forgotten.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT UTC_TIMESTAMP()")
+            (started_at,) = cur.fetchone()
+            rows = [(page_title, self.site_url) for page_title in page_titles]
+            cur.executemany(
+                "INSERT INTO dashboards (page_title, site_url, last_seen_at) "
+                "VALUES (%s, %s, UTC_TIMESTAMP()) "
+                "ON DUPLICATE KEY UPDATE last_seen_at = VALUES(last_seen_at)",
+                rows,
+            )
+            cur.execute(
+                "DELETE FROM dashboards WHERE site_url = %s AND last_seen_at < %s",
+                (self.site_url, started_at),
+            )
+            removed_count = cur.rowcount
+        self.conn.commit()
+        return len(rows), removed_count
+
+    def get_page_titles(self, statuses=None, not_run_for=None):
+        """
+        Return the titles of the dashboards of the site, least recently run
+        first, optionally only those with one of the statuses, or not run in
+        the last not_run_for seconds.
+        """
+        query = "SELECT page_title FROM dashboards WHERE site_url = %s"
+        params = [self.site_url]
+        if statuses:
+            query += " AND status IN ({})".format(", ".join(["%s"] * len(statuses)))
+            params.extend(statuses)
+        if not_run_for is not None:
+            query += (
+                " AND (last_run_at IS NULL"
+                " OR last_run_at < UTC_TIMESTAMP() - INTERVAL %s SECOND)"
+            )
+            params.append(not_run_for)
+        query += " ORDER BY last_run_at"
+        with self.conn.cursor() as cur:
+            cur.execute(query, params)
+            return [page_title for (page_title,) in cur.fetchall()]
+
+    def record_run(
+        self, page_title, status, duration=None, config_hash=None, error=None
+    ):
+        """Store the outcome of a run; the config hash is kept if not given."""
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO dashboards (page_title, site_url, status, config_hash, "
+                "last_run_at, last_run_duration, last_error, last_seen_at) "
+                "VALUES (%s, %s, %s, %s, UTC_TIMESTAMP(), %s, %s, UTC_TIMESTAMP()) "
+                "ON DUPLICATE KEY UPDATE status = VALUES(status), "
+                "config_hash = COALESCE(VALUES(config_hash), config_hash), "
+                "last_run_at = VALUES(last_run_at), "
+                "last_run_duration = VALUES(last_run_duration), "
+                "last_error = VALUES(last_error)",
+                (
+                    page_title,
+                    self.site_url,
+                    status,
+                    config_hash,
+                    duration,
+                    error,
+                ),
+            )
+        self.conn.commit()
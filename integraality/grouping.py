@@ -3,12 +3,16 @@
 """Grouping configuration and types."""
 
 import collections
+import hashlib
 import re
 
 from .grouping_link import GroupingLinkMaker
+from .labels import LabelService
 from .line import ItemGrouping, SitelinkGrouping, UnknownValueGrouping, YearGrouping
 from .sparql_utils import UNKNOWN_VALUE_PREFIX, QueryException
 
+SINGLE_VALUE_CONSTRAINT = "Q19474404"
+
 
 class UnsupportedGroupingConfigurationException(Exception):
     pass
@@ -18,6 +22,10 @@ class AbstractGroupingType:
     """Base class for grouping type strategies."""
 
     line_type = None
+    # Pattern of the grouping values, e.g. given in a drill-down request
+    GROUPING_PATTERN = None
+    # Whether prepare probes the data
+    NEEDS_PROBE = False
 
     def get_grouping_selector(self, predicate):
         raise NotImplementedError
@@ -25,6 +33,19 @@ class AbstractGroupingType:
     def post_process(self, groupings):
         return groupings
 
+    def prepare(self, selector_sparql, predicate, sparql_query_engine):
+        """Probe the data before querying the groupings, if needed."""
+
+    @classmethod
+    def is_valid_grouping(cls, grouping):
+        if cls.GROUPING_PATTERN is None:
+            return False
+        return bool(cls.GROUPING_PATTERN.fullmatch(str(grouping)))
+
+    def is_single_valued(self, predicate, sparql_query_engine):
+        """Whether entities have at most one grouping through the predicate."""
+        return False
+
     @staticmethod
     def parse_groupings(groupings_string):
         raise NotImplementedError
@@ -36,10 +57,28 @@ class AbstractGroupingType:
 
 class ItemGroupingType(AbstractGroupingType):
     line_type = ItemGrouping
+    GROUPING_PATTERN = re.compile(r"^Q\d+$")
 
     def get_grouping_selector(self, predicate):
         return [f"  ?entity {predicate} ?grouping ."]
 
+    def is_single_valued(self, predicate, sparql_query_engine):
+        """Whether the property has a single-value constraint."""
+        match = re.match(r"^wdt:(P\d+)$", predicate)
+        if not match:
+            return False
+        query = (
+            f"SELECT (COUNT(*) AS ?count) WHERE {{\n"
+            f"  wd:{match.group(1)} p:P2302 ?constraint .\n"
+            f"  ?constraint ps:P2302 wd:{SINGLE_VALUE_CONSTRAINT} .\n"
+            f"}}"
+        )
+        try:
+            result = sparql_query_engine.select(query)
+        except QueryException:
+            return False
+        return bool(result) and int(result[0].get("count", 0)) > 0
+
     @staticmethod
     def parse_groupings(groupings_string):
         return [
@@ -58,28 +97,86 @@ class ItemGroupingType(AbstractGroupingType):
 
 class YearGroupingType(AbstractGroupingType):
     line_type = YearGrouping
+    # Years, followed by their time span once binned
+    GROUPING_PATTERN = re.compile(r"^-?\d+(/\d+)?$")
+    NEEDS_PROBE = True
     MAX_GROUPINGS = 100
+    TIME_SPANS = tuple(10**exponent for exponent in range(11))
+
+    def __init__(self, time_span=1):
+        self.time_span = time_span
 
     def get_grouping_selector(self, predicate):
+        if self.time_span == 1:
+            bind_expression = "YEAR(?date)"
+        else:
+            bind_expression = (
+                f"xsd:integer(FLOOR(YEAR(?date) / {self.time_span}) * {self.time_span})"
+            )
         return [
             f"  ?entity {predicate} ?date .",
-            "  BIND(YEAR(?date) as ?grouping) .",
+            f"  BIND({bind_expression} as ?grouping) .",
         ]
 
+    @staticmethod
+    def get_year_range_query(selector_sparql, predicate):
+        return (
+            "SELECT (MIN(YEAR(?date)) AS ?first) (MAX(YEAR(?date)) AS ?last) WHERE {\n"
+            f"  ?entity {selector_sparql} .\n"
+            f"  ?entity {predicate} ?date .\n"
+            "}"
+        )
+
+    def prepare(self, selector_sparql, predicate, sparql_query_engine):
+        """
+        Pick the time span up front, from the first and last years, so that
+        the endpoint bins the groupings in at most MAX_GROUPINGS rows.
+
+        If the years cannot be probed, the groupings are rebinned after
+        being fetched.
+        """
+        query = self.get_year_range_query(selector_sparql, predicate)
+        try:
+            result = sparql_query_engine.select(query)
+        except QueryException:
+            return
+        if not result or not result[0].get("first") or not result[0].get("last"):
+            return
+        first, last = int(result[0]["first"]), int(result[0]["last"])
+        for time_span in self.TIME_SPANS:
+            if last // time_span - first // time_span < self.MAX_GROUPINGS:
+                break
+        self.time_span = time_span
+
     def post_process(self, groupings):
+        if self.time_span > 1:
+            groupings = self._rebin(groupings, self.time_span)
         return self._rebin_if_needed(groupings)
 
+    def is_single_valued(self, predicate, sparql_query_engine):
+        # One year per date; entities with several dates are caught by
+        # checking the groupings against the total count
+        return True
+
     def _rebin_if_needed(self, groupings):
         """Rebin year groupings to a coarser resolution if there are too many."""
-        keys = [key for key in groupings.keys() if key != UnknownValueGrouping.MARKER]
+        years = [
+            int(grouping.title)
+            for key, grouping in groupings.items()
+            if key != UnknownValueGrouping.MARKER
+        ]
 
         time_span = 1
-        while len(set(int(key) // time_span for key in keys)) > self.MAX_GROUPINGS:
+        while len(set(year // time_span for year in years)) > self.MAX_GROUPINGS:
             time_span *= 10
 
         if time_span == 1:
             return groupings
 
+        return self._rebin(groupings, time_span)
+
+    @staticmethod
+    def _rebin(groupings, time_span):
         rebinned = collections.OrderedDict()
 
         for key, grouping in groupings.items():
@@ -128,6 +225,7 @@ class YearGroupingType(AbstractGroupingType):
 
 class SitelinkGroupingType(AbstractGroupingType):
     line_type = SitelinkGrouping
+    GROUPING_PATTERN = re.compile(r"^https?://[\w.-]+/$")
 
     def get_grouping_selector(self, predicate):
         return [
@@ -195,6 +293,8 @@ class GroupingConfigurationMaker:
 
 
 class GroupingConfiguration:
+    DECORATIONS_BATCH_SIZE = 500
+
     def __init__(
         self,
         predicate,
@@ -212,6 +312,11 @@ class GroupingConfiguration:
         self.explicit_groupings = explicit_groupings
         self.grouping_type = grouping_type
         self._raw_explicit_groupings = raw_explicit_groupings
+        # Only detected grouping types are probed, see prepare
+        self._needs_preparation = False
+
+    def is_valid_grouping(self, grouping):
+        return self.grouping_type.is_valid_grouping(grouping)
 
     @property
     def line_type(self):
@@ -235,6 +340,15 @@ class GroupingConfiguration:
     def post_process(self, groupings):
         return self.grouping_type.post_process(groupings)
 
+    def is_partition(self, sparql_query_engine):
+        """
+        Whether the groupings are expected to split the entities, each being
+        in at most one of them.
+        """
+        if self.explicit_groupings:
+            return False
+        return self.grouping_type.is_single_valued(self.predicate, sparql_query_engine)
+
     def format_predicate_html(self):
         if isinstance(self.grouping_type, SitelinkGroupingType):
             return "sitelink"
@@ -244,26 +358,24 @@ class GroupingConfiguration:
             return f'<a href="https://wikidata.org/wiki/Property:{prop}">{prop}</a>'
         return f"<tt>{self.predicate}</tt>"
 
-    def get_values_clause(self):
-        return self.grouping_type.get_values_clause(self.explicit_groupings)
+    def get_values_clause(self, groupings=None):
+        if groupings is None:
+            groupings = self.explicit_groupings
+        return self.grouping_type.get_values_clause(groupings)
 
-    def get_grouping_information_query(self, selector_sparql):
+    def get_grouping_information_query(self, selector_sparql, grouping_threshold=None):
+        """
+        :param grouping_threshold: overrides the threshold of the configuration
+        """
+        if grouping_threshold is None:
+            grouping_threshold = self.grouping_threshold
         query = []
 
-        outer_selects = [
-            "?grouping",
-            self.get_select_for_higher_grouping(),
-            self.grouping_link_type.get_select_clause(),
-            "?count",
-        ]
-
-        inner_selects = ["?grouping", "(COUNT(DISTINCT ?entity) as ?count)"]
-
         query.extend(
             [
-                f"\nSELECT {' '.join([x for x in outer_selects if x])} WHERE {{",
+                "\nSELECT ?grouping ?count WHERE {",
                 "  {",
-                f"    SELECT {' '.join(inner_selects)} WHERE {{",
+                "    SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {",
                 f"      ?entity {selector_sparql} .",
             ]
         )
@@ -273,41 +385,128 @@ class GroupingConfiguration:
             [
                 "    }",
                 "    GROUP BY ?grouping",
-                f"    HAVING (?count >= {self.grouping_threshold})",
+                f"    HAVING (?count >= {grouping_threshold})",
                 "  }",
+                "}",
+                "ORDER BY DESC(?count)",
+                "LIMIT 1000",
+                "",
             ]
         )
-        query.extend(self.get_higher_grouping_selector())
+        return "\n".join(query)
 
-        (grouping_link_select, grouping_link_group_by) = (
-            self.grouping_link_type.get_sparql_fragment()
+    def has_decorations(self):
+        """Whether the groupings have a higher grouping or link to look up."""
+        return bool(
+            self.has_sparql_decorations() or self.grouping_link_type.label_language
         )
-        query.extend(grouping_link_select)
-        query.append("}")
 
-        if self.higher_grouping:
-            group_bys = ["?grouping", grouping_link_group_by, "?count"]
-            query.append(f"GROUP BY {' '.join([x for x in group_bys if x])}")
+    def has_sparql_decorations(self):
+        return bool(self.higher_grouping or self.grouping_link_type.get_select_clause())
 
-        query.extend(
-            [
-                "ORDER BY DESC(?count)",
-                "LIMIT 1000",
-                "",
-            ]
-        )
+    def get_decorations_query(self, groupings):
+        """
+        Get the higher grouping and link values of the given groupings.
+
+        :return: (str) SPARQL query
+        """
+        selects = [
+            "?grouping",
+            "?higher_grouping" if self.higher_grouping else "",
+            self.grouping_link_type.get_select_clause(),
+        ]
+        query = [f"\nSELECT {' '.join([x for x in selects if x])} WHERE {{"]
+        query.extend(self.get_values_clause(groupings))
+        query.extend(self.get_higher_grouping_selector())
+        (grouping_link_select, _) = self.grouping_link_type.get_sparql_fragment()
+        query.extend(grouping_link_select)
+        query.extend(["}", ""])
         return "\n".join(query)
 
-    def get_select_for_higher_grouping(self):
-        if self.higher_grouping:
-            return "(SAMPLE(?_higher_grouping) as ?higher_grouping)"
-        else:
-            return ""
+    def get_decorations_cache_key(self, sparql_query_engine, grouping):
+        signature = hashlib.sha1(
+            repr(
+                (
+                    sparql_query_engine.name,
+                    getattr(sparql_query_engine, "endpoint", None),
+                    self.get_decorations_query(["__GROUPING__"]),
+                )
+            ).encode()
+        ).hexdigest()[:12]
+        return f"decorations:{signature}:{grouping}"
+
+    def get_decorations(self, groupings, sparql_query_engine, cache=None):
+        """
+        Get the higher grouping and link values of the given groupings.
+
+        Values from SPARQL are looked up DECORATIONS_BATCH_SIZE groupings at
+        a time, and labels with the LabelService. They rarely change, so are
+        kept in the cache, if given.
+
+        :return: dict of grouping: {"higher_grouping": ..., "grouping_link_value": ...}
+        """
+        decorations = {grouping: {} for grouping in groupings}
+        if self.has_sparql_decorations():
+            decorations.update(
+                self.get_sparql_decorations(groupings, sparql_query_engine, cache=cache)
+            )
+        label_language = self.grouping_link_type.label_language
+        if label_language:
+            labels = LabelService(sparql_query_engine, cache=cache).get_labels(
+                groupings, label_language
+            )
+            for grouping, label in labels.items():
+                decorations[grouping] = dict(
+                    decorations[grouping], grouping_link_value=label
+                )
+        return decorations
+
+    def get_sparql_decorations(self, groupings, sparql_query_engine, cache=None):
+        decorations = {}
+        if cache is not None:
+            # Decorations are too many for the local tier of the cache
+            cache = cache.redis_tier
+            keys = {
+                grouping: self.get_decorations_cache_key(sparql_query_engine, grouping)
+                for grouping in groupings
+            }
+            cached = cache.get_cache_values(list(keys.values()))
+            decorations = {
+                grouping: cached[key] for grouping, key in keys.items() if key in cached
+            }
+        missing = [grouping for grouping in groupings if grouping not in decorations]
+
+        found = {}
+        for i in range(0, len(missing), self.DECORATIONS_BATCH_SIZE):
+            batch = missing[i : i + self.DECORATIONS_BATCH_SIZE]
+            for grouping in batch:
+                found[grouping] = {}
+            query = self.get_decorations_query(batch)
+            for resultitem in sparql_query_engine.select(query) or []:
+                grouping = resultitem.get("grouping", "").replace(
+                    "http://www.wikidata.org/entity/", ""
+                )
+                decoration = found.setdefault(grouping, {})
+                for name in ("higher_grouping", "grouping_link_value"):
+                    if resultitem.get(name) and not decoration.get(name):
+                        decoration[name] = resultitem.get(name)
+
+        if cache is not None and found:
+            cache.set_cache_values(
+                {
+                    self.get_decorations_cache_key(
+                        sparql_query_engine, grouping
+                    ): decoration
+                    for grouping, decoration in found.items()
+                }
+            )
+        decorations.update(found)
+        return decorations
 
     def get_higher_grouping_selector(self):
         if self.higher_grouping:
             return [
-                f"  OPTIONAL {{ ?grouping {self.higher_grouping} ?_higher_grouping }}.",
+                f"  OPTIONAL {{ ?grouping {self.higher_grouping} ?higher_grouping }}.",
             ]
         else:
             return []
@@ -346,14 +545,37 @@ class GroupingConfiguration:
                 self.explicit_groupings = self.grouping_type.parse_groupings(
                     self._raw_explicit_groupings
                 )
+            # Explicit groupings are matched against unbinned values
+            self._needs_preparation = not self.explicit_groupings
+
+    def needs_preparation(self):
+        """Whether the grouping query is only known once prepared."""
+        return self._needs_preparation and self.grouping_type.NEEDS_PROBE
+
+    def prepare(self, selector_sparql, sparql_query_engine):
+        """
+        Probe the data for the grouping type, once, right before the grouping
+        query is sent.
+        """
+        if not self._needs_preparation:
+            return
+        self._needs_preparation = False
+        self.grouping_type.prepare(selector_sparql, self.predicate, sparql_query_engine)
 
-    def get_grouping_information(self, selector_sparql, sparql_query_engine):
+    def get_grouping_information(
+        self, selector_sparql, sparql_query_engine, cache=None, grouping_threshold=None
+    ):
         """
         Get all groupings and their counts.
 
+        Their higher grouping and link values are looked up separately, see
+        get_decorations.
+
         :return: List of Grouping objects
         """
-        query = self.get_grouping_information_query(selector_sparql)
+        query = self.get_grouping_information_query(
+            selector_sparql, grouping_threshold=grouping_threshold
+        )
         groupings = collections.OrderedDict()
 
         try:
@@ -375,6 +597,7 @@ class GroupingConfiguration:
             ) from e
 
         unknown_value_count = 0
+        counts = collections.OrderedDict()
 
         for resultitem in queryresult:
             if not resultitem.get("grouping") or resultitem.get("grouping").startswith(
@@ -386,25 +609,35 @@ class GroupingConfiguration:
                 qid = resultitem.get("grouping").replace(
                     "http://www.wikidata.org/entity/", ""
                 )
-                if self.higher_grouping:
-                    value = resultitem.get("higher_grouping")
-                    if value:
-                        value = value.replace("http://www.wikidata.org/entity/", "")
-                    else:
-                        value = ""
-                    higher_grouping = value
+                counts[qid] = int(resultitem.get("count"))
+
+        decorations = {}
+        if counts and self.has_decorations():
+            decorations = self.get_decorations(
+                list(counts.keys()), sparql_query_engine, cache=cache
+            )
+
+        for qid, count in counts.items():
+            decoration = decorations.get(qid, {})
+            if self.higher_grouping:
+                value = decoration.get("higher_grouping")
+                if value:
+                    value = value.replace("http://www.wikidata.org/entity/", "")
                 else:
-                    higher_grouping = None
+                    value = ""
+                higher_grouping = value
+            else:
+                higher_grouping = None
 
-                grouping_link = self.grouping_link_type.resolve(qid, resultitem)
+            grouping_link = self.grouping_link_type.resolve(qid, decoration)
 
-                property_grouping = self.line_type(
-                    title=qid,
-                    count=int(resultitem.get("count")),
-                    grouping_link=grouping_link,
-                    higher_grouping=higher_grouping,
-                )
-                groupings[property_grouping.get_key()] = property_grouping
+            property_grouping = self.line_type(
+                title=qid,
+                count=count,
+                grouping_link=grouping_link,
+                higher_grouping=higher_grouping,
+            )
+            groupings[property_grouping.get_key()] = property_grouping
 
         if unknown_value_count:
             unknown_link = self.grouping_link_type.resolve("UNKNOWN_VALUE", {})
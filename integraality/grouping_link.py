@@ -6,8 +6,6 @@ Grouping link strategy classes.
 
 import re
 
-from .sparql_utils import get_label_for_variable
-
 
 class GroupingLinkSyntaxException(Exception):
     pass
@@ -47,6 +45,9 @@ class GroupingLinkMaker:
 class AbstractGroupingLink:
     """Base class for grouping link strategies."""
 
+    # Language of the label to look up for the link, if any
+    label_language = None
+
     def __init__(self, template):
         self.template = template
 
@@ -114,17 +115,17 @@ class PropertyGroupingLink(SparqlGroupingLink):
         )
 
 
-class LabelGroupingLink(SparqlGroupingLink):
+class LabelGroupingLink(AbstractGroupingLink):
+    """Link using the label of the grouping, looked up with the LabelService."""
+
     def __init__(self, template, lang="en"):
         super().__init__(template)
         self.lang = lang
+        self.label_language = lang
         self.placeholder = f"{{L{lang}}}"
 
-    def get_sparql_fragment(self):
-        return (
-            get_label_for_variable("?grouping", "?grouping_link_value", self.lang),
-            "?grouping_link_value",
-        )
+    def get_value(self, qid, resultitem):
+        return resultitem.get("grouping_link_value") or qid
 
     def __eq__(self, other):
         return (
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Entity labels, looked up in batches and cached."""
+
+import re
+
+# Wikidata entities, and the media files of Commons
+ENTITY_ID_PATTERN = re.compile(r"^[QPLM]\d+$")
+
+
+class LabelService:
+    """
+    Labels of entities by language, falling back to the 'mul' label.
+
+    Labels are looked up BATCH_SIZE entities per query, and cached per
+    (entity, language) when a cache is given, including the absence of a
+    label so that it is not looked up again.
+    """
+
+    BATCH_SIZE = 500
+    FALLBACK_LANGUAGE = "mul"
+
+    def __init__(self, sparql_query_engine, cache=None):
+        self.sparql_query_engine = sparql_query_engine
+        # Labels are too many for the local tier of the cache
+        self.cache = cache.redis_tier if cache is not None else None
+
+    @staticmethod
+    def make_cache_key(entity_id, lang):
+        return f"label:{lang}:{entity_id}"
+
+    def get_labels_query(self, entity_ids, langs):
+        values = " ".join(f"wd:{entity_id}" for entity_id in entity_ids)
+        lang_list = ", ".join(f"'{lang}'" for lang in langs)
+        return (
+            "\nSELECT ?item ?lang ?label WHERE {\n"
+            f"  VALUES ?item {{ {values} }}\n"
+            "  ?item rdfs:label ?label .\n"
+            "  BIND(LANG(?label) AS ?lang)\n"
+            f"  FILTER(?lang IN ({lang_list}))\n"
+            "}\n"
+        )
+
+    def get_labels(self, entity_ids, lang="en"):
+        """
+        Return the {entity ID: label} dict of the entities with a label.
+
+        Values which are not entity IDs are ignored.
+        """
+        entity_ids = list(
+            dict.fromkeys(
+                entity_id
+                for entity_id in entity_ids
+                if ENTITY_ID_PATTERN.match(str(entity_id))
+            )
+        )
+        langs = list(dict.fromkeys([lang, self.FALLBACK_LANGUAGE]))
+        keys = {
+            (entity_id, label_lang): self.make_cache_key(entity_id, label_lang)
+            for entity_id in entity_ids
+            for label_lang in langs
+        }
+
+        labels = {}
+        if self.cache is not None:
+            cached = self.cache.get_cache_values(list(keys.values()))
+            labels = {
+                entity_label: cached[key]
+                for entity_label, key in keys.items()
+                if key in cached
+            }
+        missing = [
+            entity_id
+            for entity_id in entity_ids
+            if any((entity_id, label_lang) not in labels for label_lang in langs)
+        ]
+
+        found = {}
+        for i in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[i : i + self.BATCH_SIZE]
+            for entity_id in batch:
+                for label_lang in langs:
+                    found[(entity_id, label_lang)] = ""
+            query = self.get_labels_query(batch, langs)
+            for resultitem in self.sparql_query_engine.select(query) or []:
+                entity_id = resultitem.get("item", "").replace(
+                    "http://www.wikidata.org/entity/", ""
+                )
+                entity_label = (entity_id, resultitem.get("lang"))
+                if entity_label in found:
+                    found[entity_label] = resultitem.get("label")
+
+        if self.cache is not None and found:
+            self.cache.set_cache_values(
+                {keys[entity_label]: label for entity_label, label in found.items()}
+            )
+        labels.update(found)
+
+        result = {}
+        for entity_id in entity_ids:
+            for label_lang in langs:
+                if labels.get((entity_id, label_lang)):
+                    result[entity_id] = labels[(entity_id, label_lang)]
+                    break
+        return result
+
+    def get_label(self, entity_id, lang="en"):
+        return self.get_labels([entity_id], lang).get(entity_id)
@@ -60,7 +60,7 @@ class Grouping(AbstractLine):
         text += f"| {self.heading()}\n"
         return text
 
-    def format_cell(self, column_entry, cell_template):
+    def format_cell(self, column_entry, cell_template, extra_fields=()):
         column_count = self.cells.get(column_entry.get_key(), 0)
         percentage = self.get_percentage(column_count)
         fields = [
@@ -69,9 +69,14 @@ class Grouping(AbstractLine):
             str(column_count),
             f"column={column_entry.get_key()}",
             f"grouping={self.get_key()}",
+            *extra_fields,
         ]
         return f"| {{{{{'|'.join(fields)}}}}}\n"
 
+    def format_not_computed_cell(self):
+        # Sorted below any computed cell
+        return "| data-sort-value=\"-1\" | ''not computed''\n"
+
     def row_opener(self):
         return "|-\n"
 
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Counters shared by the web and worker processes, stored in Redis."""
+
+
+class Metrics:
+    def __init__(self, cache_client, key="integraality:metrics"):
+        self.client = cache_client
+        self.key = key
+
+    def incr(self, name, amount=1):
+        self.client.hincrby(self.key, name, amount)
+
+    def incr_many(self, amounts):
+        if not amounts:
+            return
+        pipe = self.client.pipeline()
+        for name, amount in amounts.items():
+            pipe.hincrby(self.key, name, amount)
+        pipe.execute()
+
+    def get_all(self):
+        return {
+            name.decode(): int(value)
+            for name, value in self.client.hgetall(self.key).items()
+        }
@@ -2,26 +2,44 @@
 # -*- coding: utf-8 -*-
 """Orchestration — reads wiki pages, triggers updates."""
 
+import hashlib
+import itertools
+import json
 import logging
-import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from time import perf_counter
 
 import mwparserfromhell
 import pywikibot
-from redis import StrictRedis
+from pywikibot import pagegenerators, textlib
 
-from .cache import RedisCache
+from .cache import TieredCache, get_cache_client
 from .config_assembler import PARAM_RENAMES, ConfigAssembler, ConfigAssemblyException
+from .db import DashboardRegistry, ensure_schema, get_connection
 from .error_category import ErrorCategory
 from .grouping import UnsupportedGroupingConfigurationException
 from .grouping_page_creator import GroupingPageCreator
 from .page_saving import save_to_wiki_or_local
 from .property_statistics import PropertyStatistics
+from .query_sharing import SharedQueryResults
+from .sampling import EntitySample
 from .sparql_utils import QueryException
 
 logger = logging.getLogger("integraality.update")
 
+RECONCILE_INTERVAL = 86400  # 1 day
+BROKEN_RETRY_INTERVAL = 2419200  # 4 weeks
+RUNNABLE_STATUSES = (
+    "new",
+    "ok",
+    "partial",
+    "query_error",
+    "transient_error",
+    "error",
+)
+BROKEN_STATUSES = ("no_template", "config_error")
+
 
 class ProcessingException(Exception):
     error_category = ErrorCategory.CONFIG
@@ -45,7 +63,41 @@ class TransientServerException(Exception):
     error_category = ErrorCategory.TRANSIENT
 
 
+def _normalize_template_name(name):
+    name = name.replace("_", " ").strip()
+    if name.lower().startswith("template:"):
+        name = name[len("template:") :].strip()
+    return name[:1].upper() + name[1:]
+
+
+def extract_dashboard_params(text, template_name, end_template_name):
+    """
+    Return (params, None) for the start template found in the wikitext,
+    as "key=value" strings, or (None, error message) for a page to skip.
+
+    Only depends on its arguments, so that it can run in a process pool.
+    """
+    templates = [
+        (_normalize_template_name(name), params)
+        for (name, params) in textlib.extract_templates_and_params(text, True, True)
+    ]
+    names = [name for (name, _) in templates]
+    if template_name not in names:
+        return None, f"No start template '{template_name}' found"
+    if end_template_name not in names:
+        return None, f"No end template '{end_template_name}' provided"
+    params = next(params for (name, params) in templates if name == template_name)
+    return [f"{key}={value}" for (key, value) in params.items()], None
+
+
 class PagesProcessor:
+    # Share of the entities an approximate preview is estimated from
+    PREVIEW_SAMPLE_RATE = 0.01
+    # Seconds shared out between the column queries of a dashboard
+    PAGE_TIME_BUDGET = 900
+    # Same, when retrying the columns not computed at the end of a cycle
+    RETRY_TIME_BUDGET = 3600
+
     def __init__(self, url="https://www.wikidata.org/wiki/", cache_client=None):
         self.url = url
         self._site = None
@@ -54,12 +106,15 @@ class PagesProcessor:
         self.summary = "Update property usage stats"
 
         self.outputs = []
+        # Page title to the keys of its columns not computed at its last update
+        self.not_computed_columns = {}
+        # Page title to the update of a page deferred for retry_page
+        self.deferred_updates = {}
         self.config_assembler = ConfigAssembler(site_url=url)
 
         if not cache_client:
-            host = os.getenv("REDIS_HOST", "tools-redis.svc.eqiad.wmflabs")
-            cache_client = StrictRedis(host=host, decode_responses=False)
-        self.cache = RedisCache(cache_client=cache_client)
+            cache_client = get_cache_client()
+        self.cache = TieredCache(cache_client=cache_client)
 
     @property
     def site(self):
@@ -79,11 +134,22 @@ class PagesProcessor:
             " ", "_"
         )
 
+    def make_queries_cache_key(self, page_title):
+        return "queries:" + self.make_cache_key(page_title)
+
     def get_all_pages(self):
         template = pywikibot.Page(self.site, self.template_name, ns=10)
         return template.getReferences(only_template_inclusion=True)
 
     def make_stats_object_arguments_for_page(self, page):
+        parsed_config = self.get_template_params_for_page(page)
+        # The raw template parameters are cached rather than the config
+        # built from them: they are plain strings, and cheap to assemble.
+        key = self.make_cache_key(page.title())
+        self.cache.set_cache_value(key, parsed_config)
+        return self.assemble_config(parsed_config)
+
+    def get_template_params_for_page(self, page):
         all_templates_with_params = page.templatesWithParams()
 
         if self.template_name not in [
@@ -114,18 +180,31 @@ class PagesProcessor:
             logger.warning("More than one template on the page %s", page.title())
 
         (template, params) = start_templates_with_params[0]
-        parsed_config = self.config_assembler.parse_config_from_params(params)
+        return self.config_assembler.parse_config_from_params(params)
+
+    def assemble_config(self, parsed_config):
         try:
-            config = self.config_assembler.parse_config(parsed_config)
+            return self.config_assembler.parse_config(dict(parsed_config))
         except ConfigAssemblyException as e:
             raise ConfigException(e) from e
-        key = self.make_cache_key(page.title())
-        self.cache.set_cache_value(key, config)
-        return config
 
-    def make_stats_object_for_page(self, page):
+    def make_stats_object_for_page(
+        self,
+        page,
+        cancel_token=None,
+        shared_results=None,
+        sample=None,
+        result_callback=None,
+        time_budget=None,
+    ):
         config = self.make_stats_object_arguments_for_page(page)
         grouping_link_mode = config.pop("grouping_link_mode", "link")
+        config["cancel_token"] = cancel_token
+        config["shared_results"] = shared_results
+        config["cache"] = self.cache
+        config["sample"] = sample
+        config["result_callback"] = result_callback
+        config["time_budget"] = time_budget
         try:
             stats = PropertyStatistics(**config)
         except TypeError:
@@ -134,21 +213,107 @@ class PagesProcessor:
             raise ConfigException(e) from e
         return stats, grouping_link_mode
 
-    def process_page(self, page):
+    def process_page(
+        self,
+        page,
+        cancel_token=None,
+        shared_results=None,
+        result_callback=None,
+        time_budget=None,
+        defer_partial=False,
+    ):
+        """
+        Update the statistics of the page, and save them.
+
+        :param defer_partial: rather than saving a page with columns not
+            computed, keep its update in deferred_updates for retry_page
+        :return: the time taken, or None if deferred
+        """
         start_time = perf_counter()
         logger.debug("Invalidating cache key for %s", page.title())
         self.cache.invalidate(self.make_cache_key(page.title()))
+        self.cache.invalidate_mapping(self.make_queries_cache_key(page.title()))
         logger.info("Parsing page configuration...")
-        stats, grouping_link_mode = self.make_stats_object_for_page(page)
+        stats, grouping_link_mode = self.make_stats_object_for_page(
+            page,
+            cancel_token=cancel_token,
+            shared_results=shared_results,
+            result_callback=result_callback,
+            time_budget=time_budget,
+        )
         groupings = stats.retrieve_data()
         output = stats.process_data(groupings)
         elapsed_time = perf_counter() - start_time
+        if defer_partial and stats.not_computed_columns:
+            logger.info(
+                "Deferring page %s, columns not computed: %s",
+                page.title(),
+                ", ".join(stats.not_computed_columns),
+            )
+            self.deferred_updates[page.title()] = (
+                stats,
+                grouping_link_mode,
+                elapsed_time,
+            )
+            return None
+        return self.save_page(
+            page, stats, grouping_link_mode, groupings, output, elapsed_time
+        )
+
+    def retry_page(self, page, time_budget):
+        """
+        Query again the columns not computed of a page deferred by
+        process_page, keeping its other cells, then save it.
+
+        :return: the time taken by both passes
+        """
+        start_time = perf_counter()
+        stats, grouping_link_mode, elapsed_time = self.deferred_updates.pop(
+            page.title()
+        )
+        groupings, output = stats.retry_not_computed_columns(time_budget)
+        elapsed_time += perf_counter() - start_time
+        return self.save_page(
+            page, stats, grouping_link_mode, groupings, output, elapsed_time
+        )
+
+    def save_page(
+        self, page, stats, grouping_link_mode, groupings, output, elapsed_time
+    ):
+        """Save the output of the statistics to the page."""
+        if stats.columns and len(stats.not_computed_columns) == len(stats.columns):
+            # Better keep the last statistics than a table of nothing
+            raise QueryException(
+                "No column could be computed within the time budget, "
+                "the page was not saved.",
+                query=stats.get_column_info_query(next(iter(stats.columns.values()))),
+            )
+        if stats.not_computed_columns:
+            logger.warning(
+                "Columns not computed on page %s: %s",
+                page.title(),
+                ", ".join(stats.not_computed_columns),
+            )
+            self.not_computed_columns[page.title()] = list(stats.not_computed_columns)
+        else:
+            self.not_computed_columns.pop(page.title(), None)
+        queries_mapping = stats.get_drilldown_query_templates(groupings)
+        try:
+            queries_mapping.update(stats.get_grouping_label_fields(groupings))
+        except QueryException as e:
+            # The /queries page then looks the labels up itself
+            logger.warning("Could not look up the grouping labels: %s", e)
+        self.cache.set_cache_mapping(
+            self.make_queries_cache_key(page.title()), queries_mapping
+        )
         new_text = self.replace_in_page(output, page.get())
         new_text = self.migrate_template_params(new_text)
         summary = (
             self.summary
             + f" using {stats.get_sparql_engine_name()} ({int(elapsed_time)}s)"
         )
+        if stats.not_computed_columns:
+            summary += f", {len(stats.not_computed_columns)} columns not computed"
         logger.info("Saving to wiki...")
         save_to_wiki_or_local(page, summary, new_text)
 
@@ -180,57 +345,260 @@ class PagesProcessor:
                         template.get(old).name = new
         return str(code)
 
-    def warm_cache(self):
-        """Populate the Redis cache for all dashboard pages without running queries."""
+    def warm_cache(self, batch_size=50, processes=None):
+        """
+        Populate the Redis cache for all dashboard pages without running queries.
+
+        Page texts are fetched batch_size titles per API request, the
+        templates parsed in a pool of processes, and the configs of a batch
+        cached in one Redis round-trip.
+        """
         logger.info("Warming cache for pages on site %s", self.site.sitename)
-        for page in self.get_all_pages():
-            try:
-                self.make_stats_object_arguments_for_page(page)
-                logger.info("Cached config for %s", page.title())
-            except (NoStartTemplateException, NoEndTemplateException, ConfigException):
-                logger.warning("Skipping %s", page.title())
-            except Exception as e:
-                logger.warning("Error caching %s: %s", page.title(), e)
-
-    def process_all(self):
+        start_time = perf_counter()
+        pages = pagegenerators.PreloadingGenerator(
+            self.get_all_pages(), groupsize=batch_size
+        )
+        cached_count = skipped_count = 0
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            while batch := list(itertools.islice(pages, batch_size)):
+                results = executor.map(
+                    extract_dashboard_params,
+                    [page.text for page in batch],
+                    itertools.repeat(self.template_name),
+                    itertools.repeat(self.end_template_name),
+                )
+                configs = {}
+                for page, (params, error) in zip(batch, results):
+                    if error:
+                        logger.warning("Skipping %s: %s", page.title(), error)
+                        skipped_count += 1
+                        continue
+                    configs[self.make_cache_key(page.title())] = (
+                        self.config_assembler.parse_config_from_params(params)
+                    )
+                self.cache.set_cache_values(configs)
+                cached_count += len(configs)
+                logger.info("Cached %d configs", cached_count)
+        logger.info(
+            "Warmed cache with %d configs (%d pages skipped) in %.1fs",
+            cached_count,
+            skipped_count,
+            perf_counter() - start_time,
+        )
+
+    def get_registry(self):
+        conn = get_connection()
+        ensure_schema(conn)
+        return DashboardRegistry(conn, self.url)
+
+    def reconcile_registry(self, registry):
+        """Sync the registry with the pages transcluding the dashboard template."""
+        registered_count, removed_count = registry.reconcile(
+            page.title() for page in self.get_all_pages()
+        )
+        logger.info(
+            "Registry reconciled: %d dashboards, %d removed",
+            registered_count,
+            removed_count,
+        )
+
+    def get_config_hash(self, page_title):
+        parsed_config = self.cache.get_cache_value(self.make_cache_key(page_title))
+        if parsed_config is None:
+            return None
+        return hashlib.sha1(
+            json.dumps(parsed_config, sort_keys=True).encode()
+        ).hexdigest()
+
+    def process_all(self, registry=None):
+        """
+        Process the dashboards of the registry, least recently run first.
+
+        Dashboards found broken (no templates, bad configuration) are only
+        retried after BROKEN_RETRY_INTERVAL. Dashboards with columns not
+        computed within PAGE_TIME_BUDGET are only saved once all the others
+        are done, after retrying these columns with RETRY_TIME_BUDGET.
+        """
         self.summary = "Weekly update of property usage stats"
         logger.info("Processing pages on site %s", self.site.sitename)
-        for page in self.get_all_pages():
-            logger.info("Processing page %s", page.title())
-            try:
-                self.process_page(page)
-            except NoStartTemplateException:
-                logger.warning("No start template on page %s, skipping", page.title())
-            except NoEndTemplateException:
-                logger.warning("No end template on page %s, skipping", page.title())
-            except ConfigException:
-                logger.warning("Bad configuration on page %s, skipping", page.title())
-            except QueryException:
-                logger.warning(
-                    "A SPARQL query went wrong on page %s, skipping", page.title()
-                )
-            except UnsupportedGroupingConfigurationException:
-                logger.warning(
-                    "Unsupported grouping configuration on page %s, skipping",
-                    page.title(),
+        if registry is None:
+            registry = self.get_registry()
+        if registry.needs_reconciliation(RECONCILE_INTERVAL):
+            self.reconcile_registry(registry)
+        page_titles = registry.get_page_titles(
+            statuses=RUNNABLE_STATUSES
+        ) + registry.get_page_titles(
+            statuses=BROKEN_STATUSES, not_run_for=BROKEN_RETRY_INTERVAL
+        )
+        shared_results = self.plan_cycle(page_titles)
+        deferred_page_titles = []
+        for page_title in page_titles:
+            status = self.process_and_record_page(
+                registry,
+                page_title,
+                shared_results,
+                self.PAGE_TIME_BUDGET,
+                defer_partial=True,
+            )
+            if status == "deferred":
+                deferred_page_titles.append(page_title)
+        if deferred_page_titles:
+            logger.info(
+                "Retrying the columns not computed on %d pages",
+                len(deferred_page_titles),
+            )
+        for page_title in deferred_page_titles:
+            self.process_and_record_page(
+                registry, page_title, time_budget=self.RETRY_TIME_BUDGET
+            )
+        report = shared_results.get_report()
+        logger.info(
+            "Shared queries: %d planned uses, %d sent, %d saved",
+            report["planned"],
+            report["executed"],
+            report["saved"],
+        )
+
+    def process_and_record_page(
+        self,
+        registry,
+        page_title,
+        shared_results=None,
+        time_budget=None,
+        defer_partial=False,
+    ):
+        """
+        Process the page and record the outcome in the registry, unless the
+        page is deferred.
+        """
+        page = pywikibot.Page(self.site, page_title)
+        status, error, elapsed_time = self.process_page_with_status(
+            page,
+            shared_results=shared_results,
+            time_budget=time_budget,
+            defer_partial=defer_partial,
+        )
+        if status == "deferred":
+            return status
+        registry.record_run(
+            page_title,
+            status,
+            duration=elapsed_time,
+            config_hash=self.get_config_hash(page_title),
+            error=error,
+        )
+        return status
+
+    def plan_cycle(self, page_titles):
+        """
+        Plan the queries that the dashboards of a cycle have in common:
+        their grouping information and totals, and the counts of the columns
+        they share on the same selector and grouping.
+
+        Dashboards are planned from their cached configuration; those
+        without one, or with a broken one, are processed without sharing.
+        """
+        shared_results = SharedQueryResults()
+        planned_stats = []
+        with shared_results.planning():
+            for page_title in page_titles:
+                parsed_config = self.cache.get_cache_value(
+                    self.make_cache_key(page_title)
                 )
-            except (
-                pywikibot.exceptions.TimeoutError,
-                pywikibot.exceptions.ServerError,
-            ) as e:
-                logger.warning(
-                    "Temporary server issue with page %s: %s. Will retry later.",
-                    page.title(),
-                    e,
+                if parsed_config is None:
+                    continue
+                try:
+                    config = self.assemble_config(parsed_config)
+                    config.pop("grouping_link_mode", None)
+                    stats = PropertyStatistics(**config, shared_results=shared_results)
+                    stats.plan_property_thresholds(shared_results)
+                except Exception as e:
+                    logger.debug("Not planning %s: %s", page_title, e)
+                    continue
+                planned_stats.append(stats)
+        # The column queries depend on the thresholds of all the dashboards
+        for stats in planned_stats:
+            for query in stats.get_shared_queries():
+                shared_results.plan(stats.sparql_query_engine, query)
+        logger.info(
+            "Planned %d queries, %d of them shared between dashboards",
+            shared_results.planned_count,
+            shared_results.get_shared_count(),
+        )
+        return shared_results
+
+    def process_page_with_status(
+        self, page, shared_results=None, time_budget=None, defer_partial=False
+    ):
+        """
+        Process the page, returning its registry status, the error message
+        if any (or the columns not computed), and the time taken if saved.
+
+        A page deferred by defer_partial gets the "deferred" status, and is
+        retried when processed again.
+        """
+        logger.info("Processing page %s", page.title())
+        try:
+            if page.title() in self.deferred_updates:
+                elapsed_time = self.retry_page(page, time_budget)
+            else:
+                elapsed_time = self.process_page(
+                    page,
+                    shared_results=shared_results,
+                    time_budget=time_budget,
+                    defer_partial=defer_partial,
                 )
-            except Exception as e:
-                logger.error("Unknown error with page %s: %s", page.title(), e)
+            if page.title() in self.deferred_updates:
+                return "deferred", None, None
+            not_computed_columns = self.not_computed_columns.get(page.title())
+            if not_computed_columns:
+                error = "Columns not computed: " + ", ".join(not_computed_columns)
+                return "partial", error, elapsed_time
+            return "ok", None, elapsed_time
+        except NoStartTemplateException as e:
+            logger.warning("No start template on page %s, skipping", page.title())
+            return "no_template", str(e), None
+        except NoEndTemplateException as e:
+            logger.warning("No end template on page %s, skipping", page.title())
+            return "no_template", str(e), None
+        except ConfigException as e:
+            logger.warning("Bad configuration on page %s, skipping", page.title())
+            return "config_error", str(e), None
+        except QueryException as e:
+            logger.warning(
+                "A SPARQL query went wrong on page %s, skipping", page.title()
+            )
+            return "query_error", str(e), None
+        except UnsupportedGroupingConfigurationException as e:
+            logger.warning(
+                "Unsupported grouping configuration on page %s, skipping",
+                page.title(),
+            )
+            return "config_error", str(e), None
+        except (
+            pywikibot.exceptions.TimeoutError,
+            pywikibot.exceptions.ServerError,
+        ) as e:
+            logger.warning(
+                "Temporary server issue with page %s: %s. Will retry later.",
+                page.title(),
+                e,
+            )
+            return "transient_error", str(e), None
+        except Exception as e:
+            logger.error("Unknown error with page %s: %s", page.title(), e)
+            return "error", str(e), None
 
-    def process_one_page(self, page_title):
+    def process_one_page(self, page_title, cancel_token=None, result_callback=None):
         page = pywikibot.Page(self.site, page_title)
         logger.info("Processing page %s", page.title())
         try:
-            return self.process_page(page)
+            return self.process_page(
+                page,
+                cancel_token=cancel_token,
+                result_callback=result_callback,
+                time_budget=self.PAGE_TIME_BUDGET,
+            )
         except (
             pywikibot.exceptions.TimeoutError,
             pywikibot.exceptions.ServerError,
@@ -239,16 +607,73 @@ class PagesProcessor:
                 f"Temporary server issue: {e}. Please try again later."
             ) from e
 
+    def preview_one_page(self, page_title, sample_rate=None):
+        """
+        Return the wikitext of an approximate preview of a dashboard,
+        estimated from a sample of its entities, without saving it.
+        """
+        if sample_rate is None:
+            sample_rate = self.PREVIEW_SAMPLE_RATE
+        start_time = perf_counter()
+        page = pywikibot.Page(self.site, page_title)
+        logger.info("Previewing page %s", page.title())
+        try:
+            stats, _ = self.make_stats_object_for_page(
+                page, sample=EntitySample(sample_rate)
+            )
+        except (
+            pywikibot.exceptions.TimeoutError,
+            pywikibot.exceptions.ServerError,
+        ) as e:
+            raise TransientServerException(
+                f"Temporary server issue: {e}. Please try again later."
+            ) from e
+        groupings = stats.retrieve_data()
+        output = stats.process_data(groupings)
+        return output, perf_counter() - start_time
+
+    def get_cached_queries_for_column(
+        self, page_title, column_key, grouping, lang="en"
+    ):
+        """
+        Return the drill-down queries for a cell and the label of its
+        grouping, from the ones cached when the dashboard was last generated.
+
+        :return: the queries, or None if they are not available, and the
+            label, empty if the grouping has none, or None if not available
+        """
+        field = PropertyStatistics.get_drilldown_template_field(column_key, grouping)
+        if field is None:
+            return None, None
+        template, label = self.cache.get_cache_mapping_values(
+            self.make_queries_cache_key(page_title),
+            [field, PropertyStatistics.make_label_field(grouping, lang)],
+        )
+        if template is None:
+            return None, label
+        return PropertyStatistics.render_drilldown_template(template, grouping), label
+
     def make_stats_object_for_page_title(self, page_title):
         key = self.make_cache_key(page_title)
-        result = self.cache.get_cache_value(key)
-        if not result:
+
+        def compute():
             logger.info("No result in cache for %s, computing...", key)
             page = pywikibot.Page(self.site, page_title)
-            result = self.make_stats_object_arguments_for_page(page)
+            try:
+                return self.get_template_params_for_page(page)
+            except (
+                pywikibot.exceptions.TimeoutError,
+                pywikibot.exceptions.ServerError,
+            ) as e:
+                raise TransientServerException(
+                    f"Temporary server issue: {e}. Please try again later."
+                ) from e
+
+        # Requests missing the same key at once do not all fetch the page
+        result = self.assemble_config(self.cache.get_or_compute(key, compute))
         result.pop("grouping_link_mode", None)
         try:
-            return PropertyStatistics(**result)
+            return PropertyStatistics(**result, cache=self.cache)
         except TypeError:
             raise ConfigException("The template parameters are incorrect.")
         except UnsupportedGroupingConfigurationException as e:
@@ -274,6 +699,11 @@ def args_parser():
         action="store_true",
         help="only populate the cache, don't run queries or update pages",
     )
+    parser.add_argument(
+        "--reconcile-only",
+        action="store_true",
+        help="only sync the dashboard registry with the pages using the template",
+    )
     return parser.parse_args()
 
 
@@ -286,6 +716,8 @@ def main():
     processor = PagesProcessor(url=args.url)
     if args.warm_cache_only:
         processor.warm_cache()
+    elif args.reconcile_only:
+        processor.reconcile_registry(processor.get_registry())
     elif args.page:
         processor.process_one_page(args.page)
     else:
@@ -3,19 +3,25 @@
 """Core logic — builds SPARQL queries, processes results."""
 
 import collections
+import contextlib
+import hashlib
 import logging
 
-from .column import ColumnMaker
+from .cancellation import DeadlineExceededException, TimeBudget
+from .column import ColumnMaker, ReferenceScan
 from .grouping import GroupingConfiguration, ItemGroupingType
+from .labels import ENTITY_ID_PATTERN, LabelService
 from .line import (
     NoGroupGrouping,
     TotalsGrouping,
     UnknownValueGrouping,
     YearGrouping,
 )
+from .query_sharing import SharedSparqlQueryEngine, make_query_key
 from .results_formatter import ResultsFormatter
 from .sparql_utils import (
     UNKNOWN_VALUE_PREFIX,
+    CancellableSparqlQueryEngine,
     QueryException,
     WdqsSparqlQueryEngine,
     expand_select_vars,
@@ -24,6 +30,12 @@ from .sparql_utils import (
 
 logger = logging.getLogger("integraality.update")
 
+DRILLDOWN_GROUPING_PLACEHOLDER = "__INTEGRAALITY_GROUPING__"
+
+
+class InvalidDrilldownException(Exception):
+    """A drill-down was requested with arguments which are not valid."""
+
 
 class PropertyStatistics:
     """
@@ -32,6 +44,12 @@ class PropertyStatistics:
     """
 
     SPECIAL_GROUPINGS = (NoGroupGrouping, TotalsGrouping, UnknownValueGrouping)
+    # Most groupings the column queries are restricted to, in a VALUES block
+    PUSHDOWN_MAX_GROUPINGS = 200
+    # Entities per page of a paged drill-down
+    DRILLDOWN_PAGE_SIZE = 100
+    # Seconds a drill-down page is cached
+    DRILLDOWN_CACHE_TTL = 600
 
     @classmethod
     def _find_special_grouping(cls, grouping_arg):
@@ -51,31 +69,115 @@ class PropertyStatistics:
         row_totals=True,
         property_threshold=0,
         sparql_query_engine=None,
+        cancel_token=None,
+        shared_results=None,
+        cache=None,
+        sample=None,
+        result_callback=None,
+        time_budget=None,
     ):
         """
         Set what to work on and other variables here.
+
+        :param sample: an EntitySample to estimate the counts from, for an
+            approximate preview
+        :param result_callback: called with each partial result (a dict with
+            its kind) as soon as it is known, e.g. to render the table live
+        :param time_budget: seconds shared out between the column queries;
+            columns running past their share are left out as not computed
         """
         if sparql_query_engine is None:
             sparql_query_engine = WdqsSparqlQueryEngine()
+        if shared_results is not None:
+            sparql_query_engine = SharedSparqlQueryEngine(
+                sparql_query_engine, shared_results
+            )
+        self.time_budget = None
+        if time_budget is not None:
+            # Checked by the engine like a cancel token
+            self.time_budget = TimeBudget(time_budget, parent=cancel_token)
+            cancel_token = self.time_budget
+        if cancel_token is not None:
+            sparql_query_engine = CancellableSparqlQueryEngine(
+                sparql_query_engine, cancel_token
+            )
         self.columns = {column.get_key(): column for column in columns}
         self.grouping_configuration = grouping_configuration
         self.higher_grouping_type = higher_grouping_type
+        if sample is not None:
+            # Every query starts from the selector, so gets the sampling
+            selector_sparql = sample.apply_to_selector(selector_sparql)
         self.selector_sparql = selector_sparql
+        self.sample = sample
         self.row_no_group = row_no_group
         self.row_totals = row_totals
         self.property_threshold = property_threshold
         self.sparql_query_engine = sparql_query_engine
+        self.shared_results = shared_results
+        self.cache = cache
+        self.result_callback = result_callback
+        self.not_computed_columns = []
+        self._remaining_queries = 0
+        # What the queries returned so far, for retry_not_computed_columns
+        self._populated_columns = []
+        self._queried_groupings = None
+        self._summary_groupings = []
 
         self.grouping_configuration._resolve_type(selector_sparql, sparql_query_engine)
         self.formatter = ResultsFormatter(
             columns=self.columns,
             grouping_configuration=grouping_configuration,
             property_threshold=property_threshold,
+            sample=sample,
+            not_computed_columns=self.not_computed_columns,
         )
 
     def get_sparql_engine_name(self):
         return self.sparql_query_engine.name
 
+    def publish_result(self, kind, **data):
+        """Pass a partial result to the result callback, if any."""
+        if self.result_callback is not None:
+            self.result_callback({"kind": kind, **data})
+
+    @staticmethod
+    def describe_line(grouping):
+        return {
+            "key": str(grouping.get_key()),
+            "count": grouping.count,
+            "cells": dict(grouping.cells),
+        }
+
+    @contextlib.contextmanager
+    def column_deadline(self, column_keys):
+        """
+        Run the queries of columns within their share of the time budget.
+
+        Without a time budget, this does nothing. With one, the queries are
+        cut off at their deadline, and their columns marked as not computed,
+        rather than failing the whole update. Other query failures (e.g. the
+        endpoint being unavailable) still fail it.
+        """
+        if self.time_budget is None:
+            yield
+            return
+        try:
+            with self.time_budget.query_deadline(self._remaining_queries):
+                yield
+        except DeadlineExceededException as e:
+            logger.warning(
+                f"Column {', '.join(column_keys)} not computed: {e}",
+                extra={"step_key": f"columns_{column_keys[0]}", "phase": "end"},
+            )
+            for column_key in column_keys:
+                if column_key not in self.not_computed_columns:
+                    self.not_computed_columns.append(column_key)
+                    self.publish_result(
+                        "column", column=column_key, cells={}, not_computed=True
+                    )
+        finally:
+            self._remaining_queries -= 1
+
     def get_grouping_information(self):
         """
         Get all groupings and their counts.
@@ -83,9 +185,26 @@ class PropertyStatistics:
         :return: List of Grouping objects
         """
         return self.grouping_configuration.get_grouping_information(
-            self.selector_sparql, self.sparql_query_engine
+            self.selector_sparql,
+            self.sparql_query_engine,
+            cache=self.cache,
+            grouping_threshold=self.get_query_grouping_threshold(),
         )
 
+    def get_query_grouping_threshold(self):
+        """Return the grouping threshold of the queries, on the sample if any."""
+        if self.sample is None:
+            return None
+        return self.sample.get_sample_threshold(
+            self.grouping_configuration.grouping_threshold
+        )
+
+    def get_query_property_threshold(self):
+        """Return the property threshold of the queries, on the sample if any."""
+        if self.sample is None:
+            return int(self.property_threshold)
+        return self.sample.get_sample_threshold(self.property_threshold)
+
     def get_queries_for_column(self, column_key, grouping):
         column = self.columns.get(column_key)
         return {
@@ -99,6 +218,108 @@ class PropertyStatistics:
             "formatted_predicate": self.grouping_configuration.format_predicate_html(),
         }
 
+    @staticmethod
+    def describe_queries(query_data):
+        """Flatten the result of get_queries_for_column into plain strings."""
+        column = query_data["column"]
+        return {
+            "column": column.get_key(),
+            "column_html_snippet": column.format_html_snippet(),
+            "column_type_name": column.get_type_name(),
+            "positive_query": query_data["positive_query"],
+            "negative_query": query_data["negative_query"],
+            "formatted_predicate": query_data["formatted_predicate"],
+        }
+
+    @classmethod
+    def _get_drilldown_kind(cls, grouping):
+        """Return (kind, value) for a grouping argument of the drill-down links.
+
+        All groupings of the same kind share the same query up to the grouping
+        value, which is substituted for DRILLDOWN_GROUPING_PLACEHOLDER.
+        """
+        if cls._find_special_grouping(grouping):
+            return grouping, None
+        title, _, time_span = str(grouping).rpartition("/")
+        if title and time_span.isdigit():
+            return f"*/{time_span}", title
+        return "*", str(grouping)
+
+    @staticmethod
+    def make_drilldown_field(column_key, kind):
+        return f"{column_key}|{kind}"
+
+    def get_drilldown_query_templates(self, groupings):
+        """
+        Compute the drill-down queries for every cell of the report.
+
+        Rather than one entry per cell, this returns one entry per column and
+        kind of grouping, keyed by make_drilldown_field.
+
+        :param groupings: the groupings the report was built from
+        :return: dict of field to the describe_queries dict
+        """
+        kinds = {}
+        for grouping_key in groupings:
+            kind, _ = self._get_drilldown_kind(grouping_key)
+            kinds[kind] = grouping_key
+        if self.row_no_group:
+            kinds[NoGroupGrouping.MARKER] = NoGroupGrouping.MARKER
+        if self.row_totals:
+            kinds[TotalsGrouping.MARKER] = TotalsGrouping.MARKER
+
+        templates = {}
+        for kind in kinds:
+            if kind == "*":
+                grouping = DRILLDOWN_GROUPING_PLACEHOLDER
+            elif kind.startswith("*/"):
+                grouping = DRILLDOWN_GROUPING_PLACEHOLDER + kind[1:]
+            else:
+                grouping = kind
+            for column_key in self.columns:
+                query_data = self.get_queries_for_column(column_key, grouping)
+                field = self.make_drilldown_field(column_key, kind)
+                templates[field] = self.describe_queries(query_data)
+        return templates
+
+    @staticmethod
+    def make_label_field(grouping, lang):
+        return f"label|{lang}|{grouping}"
+
+    def get_grouping_label_fields(self, groupings, lang="en"):
+        """
+        Return the labels of the groupings, keyed by make_label_field, to be
+        cached along with the drill-down query templates.
+
+        Groupings without a label get an empty one, so that the /queries
+        page does not look it up again.
+        """
+        labels = LabelService(self.sparql_query_engine, cache=self.cache).get_labels(
+            groupings, lang
+        )
+        return {
+            self.make_label_field(grouping, lang): labels.get(grouping, "")
+            for grouping in groupings
+        }
+
+    @classmethod
+    def get_drilldown_template_field(cls, column_key, grouping):
+        if grouping is None:
+            return None
+        kind, _ = cls._get_drilldown_kind(grouping)
+        return cls.make_drilldown_field(column_key, kind)
+
+    @classmethod
+    def render_drilldown_template(cls, template, grouping):
+        """Substitute the grouping value into a template from get_drilldown_query_templates."""
+        _, value = cls._get_drilldown_kind(grouping)
+        if value is None:
+            return template
+        result = dict(template)
+        for key in ("positive_query", "negative_query"):
+            result[key] = result[key].replace(DRILLDOWN_GROUPING_PLACEHOLDER, value)
+        return result
+
     def get_query_for_items_for_property_positive(self, column, grouping):
         grouping_predicate = self.grouping_configuration.get_predicate()
         line, grouping = self._make_line_for_grouping(grouping)
@@ -135,12 +356,15 @@ class PropertyStatistics:
         grouping_predicate,
         grouping,
         line,
+        entities=None,
     ):
         """Build a drilldown query with labels resolved in an outer query.
 
         Wraps the entity-selection logic in a subquery so that SPARQL
         optimizers resolve the complex pattern first, then join against
         the rdfs:label graph on a small result set.
+
+        :param entities: restricts the query to these entity IDs
         """
         inner_select_clause = " ".join(select_vars)
         outer_select_clause = expand_select_vars(select_vars)
@@ -149,6 +373,11 @@ class PropertyStatistics:
         inner = query_fn(
             self.selector_sparql, inner_select_clause, grouping_predicate, grouping
         )
+        if entities is not None:
+            (select_line, body) = inner.split("\n", 1)
+            entity_url = self.sparql_query_engine.entity_url
+            values = " ".join(f"<{entity_url}{entity}>" for entity in entities)
+            inner = f"{select_line}\n  VALUES ?entity {{ {values} }}\n{body}"
         inner += line.grouping_bind(grouping)
         inner += column_filter
         inner += "}"
@@ -164,6 +393,139 @@ class PropertyStatistics:
         query += "}\n"
         return query
 
+    def get_drilldown_entities_query(
+        self, column, grouping, positive=True, after=None, limit=None
+    ):
+        """
+        Get the first phase of a paged drill-down: the entities of a page,
+        ordered by ID, without anything about them.
+
+        :param after: the last entity of the previous page, if any
+        :param limit: the page size
+        """
+        grouping_predicate = self.grouping_configuration.get_predicate()
+        line, grouping = self._make_line_for_grouping(grouping)
+        query_fn = line.postive_query if positive else line.negative_query
+        query = "\n"
+        query += query_fn(self.selector_sparql, "?entity", grouping_predicate, grouping)
+        query += line.grouping_bind(grouping)
+        query += column.get_filter_for_entity_page(positive)
+        if after:
+            entity_url = self.sparql_query_engine.entity_url
+            query += f'  FILTER(STR(?entity) > "{entity_url}{after}")\n'
+        query += "}\n"
+        query += "ORDER BY ?entity\n"
+        if limit is not None:
+            query += f"LIMIT {limit}\n"
+        return query
+
+    def get_drilldown_details_query(self, column, grouping, entities, positive=True):
+        """
+        Get the second phase of a paged drill-down: what is shown about the
+        entities of a page, with their labels.
+        """
+        grouping_predicate = self.grouping_configuration.get_predicate()
+        line, grouping = self._make_line_for_grouping(grouping)
+        if positive:
+            column_filter, select_vars = column.get_filter_for_positive_query()
+            query_fn = line.postive_query
+        else:
+            column_filter, select_vars = column.get_filter_for_negative_query()
+            query_fn = line.negative_query
+        return self._build_drilldown_query(
+            query_fn,
+            select_vars,
+            column_filter,
+            grouping_predicate,
+            grouping,
+            line,
+            entities=entities,
+        )
+
+    def get_drilldown_page(
+        self, column_key, grouping, positive=True, after=None, page_size=None
+    ):
+        """
+        Run a drill-down one page at a time: the entities of the page are
+        selected first, then their details and labels are only looked up for
+        these entities.
+
+        :param after: the last entity of the previous page, if any
+        :return: dict with the entities of the page, the variables and rows
+            of their details, and the entity to continue after (or None)
+        """
+        if page_size is None:
+            page_size = self.DRILLDOWN_PAGE_SIZE
+        column = self.columns.get(column_key)
+        if column is None:
+            raise InvalidDrilldownException(f"Unknown column {column_key}.")
+        # The arguments end up in a query run by the tool itself
+        if not self.is_valid_drilldown_grouping(grouping):
+            raise InvalidDrilldownException(f"Invalid grouping {grouping}.")
+        if after and not ENTITY_ID_PATTERN.fullmatch(after):
+            raise InvalidDrilldownException(f"Invalid entity {after}.")
+        query = self.get_drilldown_entities_query(
+            column, grouping, positive=positive, after=after, limit=page_size + 1
+        )
+        if self.cache is None:
+            return self._run_drilldown_page(
+                column, grouping, positive, query, page_size
+            )
+        # The page only depends on its queries, so it is shared by everyone
+        # looking at the same cell
+        key = "drilldown:{0}:{1}".format(
+            "+" if positive else "-",
+            hashlib.sha1(
+                repr(make_query_key(self.sparql_query_engine, query)).encode()
+            ).hexdigest(),
+        )
+        return self.cache.get_or_compute(
+            key,
+            lambda: self._run_drilldown_page(
+                column, grouping, positive, query, page_size
+            ),
+            ttl=self.DRILLDOWN_CACHE_TTL,
+        )
+
+    def is_valid_drilldown_grouping(self, grouping):
+        if self._find_special_grouping(grouping):
+            return True
+        return self.grouping_configuration.is_valid_grouping(grouping)
+
+    def _run_drilldown_page(self, column, grouping, positive, query, page_size):
+        entity_url = self.sparql_query_engine.entity_url
+        entities = [
+            resultitem.get("entity").replace(entity_url, "")
+            for resultitem in self.sparql_query_engine.select(query) or []
+        ]
+        next_after = entities[page_size - 1] if len(entities) > page_size else None
+        entities = entities[:page_size]
+
+        if positive:
+            (_, select_vars) = column.get_filter_for_positive_query()
+        else:
+            (_, select_vars) = column.get_filter_for_negative_query()
+        variables = [var.lstrip("?") for var in expand_select_vars(select_vars).split()]
+        rows = []
+        if entities:
+            query = self.get_drilldown_details_query(
+                column, grouping, entities, positive=positive
+            )
+            order = {entity: i for i, entity in enumerate(entities)}
+            rows = sorted(
+                self.sparql_query_engine.select(query) or [],
+                key=lambda row: order.get(
+                    row.get("entity", "").replace(entity_url, ""),
+                    len(order),
+                ),
+            )
+        return {
+            "entities": entities,
+            "variables": variables,
+            "rows": rows,
+            "next": next_after,
+        }
+
     def _make_line_for_grouping(self, grouping):
         grouping_class = self._find_special_grouping(grouping)
         if grouping_class:
@@ -174,14 +536,140 @@ class PropertyStatistics:
             return YearGrouping(None, time_span=int(time_span)), title
         return line_type(None), grouping
 
-    def get_totals_no_grouping(self):
+    def get_shared_queries(self):
+        """
+        Return the queries which only depend on the selector, grouping and
+        columns, and may be shared with other dashboards.
+        """
+        if self.grouping_configuration.needs_preparation():
+            # Not probed for planning, so its grouping queries are not known
+            return []
+        queries = [
+            self.grouping_configuration.get_grouping_information_query(
+                self.selector_sparql
+            )
+        ]
+        scans = self.get_reference_scans()
+        scanned_keys = {key for scan in scans for key in scan.columns}
+        queries.extend(
+            self.get_column_info_query(column)
+            for key, column in self.columns.items()
+            if key not in scanned_keys
+        )
+        queries.extend(self.get_reference_scan_query(scan) for scan in scans)
+        if self.row_no_group and self.row_totals:
+            queries.append(self.get_totals_and_no_grouping_query())
+            queries.extend(
+                column.get_totals_and_no_grouping_query(self)
+                for column in self.columns.values()
+            )
+        elif self.row_no_group:
+            queries.append(self.get_totals_no_grouping_query())
+            queries.extend(
+                column.get_info_no_grouping_query(self)
+                for column in self.columns.values()
+            )
+        elif self.row_totals:
+            queries.append(self.get_totals_query())
+            queries.extend(
+                column.get_totals_query(self) for column in self.columns.values()
+            )
+        return queries
+
+    def plan_property_thresholds(self, shared_results):
+        """
+        Record the property threshold of the columns, so that dashboards
+        sharing a column on the same selector and grouping send one query,
+        with the lowest of their thresholds.
+        """
+        for column in self.columns.values():
+            shared_results.plan_threshold(
+                self.sparql_query_engine,
+                column.get_info_query(self, property_threshold=0),
+                self.get_query_property_threshold(),
+            )
+
+    def get_column_property_threshold(self, column):
+        """
+        Return the threshold to query the column with: the lowest one of the
+        dashboards sharing it, if planned.
+        """
+        property_threshold = self.get_query_property_threshold()
+        if self.shared_results is None:
+            return property_threshold
+        return self.shared_results.get_threshold(
+            self.sparql_query_engine,
+            column.get_info_query(self, property_threshold=0),
+            property_threshold,
+        )
+
+    def get_column_info_query(self, column, groupings=None):
+        """
+        :param groupings: the grouping values to restrict the query to, unless
+            the unrestricted query is planned, to share its result
+        """
+        property_threshold = self.get_column_property_threshold(column)
+        query = column.get_info_query(self, property_threshold=property_threshold)
+        if groupings is None or (
+            self.shared_results is not None
+            and self.shared_results.is_planned(self.sparql_query_engine, query)
+        ):
+            return query
+        return column.get_info_query(
+            self, property_threshold=property_threshold, groupings=groupings
+        )
+
+    def get_reference_scans(self):
+        """Return the scans of the reference columns on the same statements."""
+        return ReferenceScan.make_scans(self.columns)
+
+    def get_reference_scan_query(self, scan, groupings=None):
+        """
+        :param groupings: the grouping values to restrict the query to, unless
+            the unrestricted query is planned, to share its result
+        """
+        property_threshold = self.get_query_property_threshold()
+        query = scan.get_info_query(self, property_threshold=property_threshold)
+        if groupings is None or (
+            self.shared_results is not None
+            and self.shared_results.is_planned(self.sparql_query_engine, query)
+        ):
+            return query
+        return scan.get_info_query(
+            self, property_threshold=property_threshold, groupings=groupings
+        )
+
+    def get_pushdown_groupings(self, groupings):
+        """
+        Return the grouping values the column queries should be restricted
+        to, or None to count all of them.
+
+        This pays off when the grouping threshold left out a tail of
+        groupings, which the endpoint would otherwise count for nothing,
+        and the retained ones fit in a reasonable VALUES block.
+        """
+        if self.grouping_configuration.explicit_groupings:
+            return None
+        if int(self.grouping_configuration.grouping_threshold) <= 1:
+            return None
+        if not groupings or len(groupings) > self.PUSHDOWN_MAX_GROUPINGS:
+            return None
+        if UnknownValueGrouping.MARKER in groupings:
+            # Unknown values cannot be listed in a VALUES block
+            return None
+        return list(groupings.keys())
+
+    def get_totals_no_grouping_query(self):
         grouping_predicate = self.grouping_configuration.get_predicate()
-        query = f"""
+        return f"""
 SELECT (COUNT(*) as ?count) WHERE {{
   ?entity {self.selector_sparql}
   MINUS {{ ?entity {grouping_predicate} _:b28. }}
 }}
 """
+
+    def get_totals_no_grouping(self):
+        query = self.get_totals_no_grouping_query()
         logger.info(
             "Querying count of items without grouping...",
             extra={"query": query, "step_key": "nogroup_count"},
@@ -193,12 +681,15 @@ SELECT (COUNT(*) as ?count) WHERE {{
         )
         return result
 
-    def get_totals(self):
-        query = f"""
+    def get_totals_query(self):
+        return f"""
 SELECT (COUNT(*) as ?count) WHERE {{
   ?entity {self.selector_sparql}
 }}
 """
+
+    def get_totals(self):
+        query = self.get_totals_query()
         logger.info(
             "Querying total item count...",
             extra={"query": query, "step_key": "totals_count"},
@@ -210,6 +701,26 @@ SELECT (COUNT(*) as ?count) WHERE {{
         )
         return result
 
+    def get_totals_and_no_grouping_query(self):
+        grouping_predicate = self.grouping_configuration.get_predicate()
+        return f"""
+SELECT (COUNT(*) AS ?count) (SUM(?no_grouping) AS ?no_grouping_count) WHERE {{
+  ?entity {self.selector_sparql} .
+  BIND(IF(EXISTS {{ ?entity {grouping_predicate} [] }}, 0, 1) AS ?no_grouping)
+}}
+"""
+
+    def _get_counts_with_no_grouping_from_sparql(self, query):
+        """Return the total count and the count without grouping of a query."""
+        queryresult = self.sparql_query_engine.select(query)
+        if not queryresult:
+            raise QueryException("No result when running a SPARQL query.", query=query)
+        # The sum of no row may be left unbound
+        return (
+            int(queryresult[0].get("count")),
+            int(queryresult[0].get("no_grouping_count") or 0),
+        )
+
     def _get_count_from_sparql(self, query):
         try:
             queryresult = self.sparql_query_engine.select(query)
@@ -224,7 +735,6 @@ SELECT (COUNT(*) as ?count) WHERE {{
         return int(queryresult[0].get("count"))
 
     def _get_grouping_counts_from_sparql(self, query):
-        result = collections.OrderedDict()
         try:
             queryresult = self.sparql_query_engine.select(query)
             if not queryresult:
@@ -233,21 +743,44 @@ SELECT (COUNT(*) as ?count) WHERE {{
         except QueryException:
             raise
 
+        return self._parse_grouping_counts(queryresult)
+
+    def _get_scan_counts_from_sparql(self, query, scan):
+        """Return the {column key: grouping counts} dict of a reference scan."""
+        queryresult = self.sparql_query_engine.select(query)
+        if not queryresult:
+            return {}
+        return {
+            column_key: self._parse_grouping_counts(queryresult, f"count_{i}")
+            for i, column_key in enumerate(scan.columns)
+        }
+
+    def _parse_grouping_counts(self, queryresult, count_variable="count"):
+        result = collections.OrderedDict()
         for resultitem in queryresult:
+            count = int(resultitem.get(count_variable) or 0)
             if not resultitem.get("grouping") or resultitem.get("grouping").startswith(
                 UNKNOWN_VALUE_PREFIX
             ):
                 if UnknownValueGrouping.MARKER not in result.keys():
                     result[UnknownValueGrouping.MARKER] = 0
-                result[UnknownValueGrouping.MARKER] += int(resultitem.get("count"))
+                result[UnknownValueGrouping.MARKER] += count
             else:
                 qid = resultitem.get("grouping").replace(
                     "http://www.wikidata.org/entity/", ""
                 )
-                result[qid] = int(resultitem.get("count"))
+                result[qid] = count
 
         return result
 
+    def get_columns(self, column_keys=None):
+        """Return the columns of the keys, in the order of the dashboard."""
+        if column_keys is None:
+            return self.columns
+        return {
+            key: column for key, column in self.columns.items() if key in column_keys
+        }
+
     def make_stats_for_no_group(self):
         """
         Query the data for no_group, return the grouping object.
@@ -256,51 +789,154 @@ SELECT (COUNT(*) as ?count) WHERE {{
         grouping_object = NoGroupGrouping(
             count=count, higher_grouping=self.grouping_configuration.higher_grouping
         )
+        return self.populate_no_group(grouping_object)
 
-        column_keys = list(self.columns.keys())
-        for i, (column_entry_key, column_entry) in enumerate(self.columns.items(), 1):
+    def populate_no_group(self, grouping_object, column_keys=None):
+        """
+        Query the cells of the columns, all of them by default, for no_group.
+        """
+        columns = self.get_columns(column_keys)
+        for i, (column_entry_key, column_entry) in enumerate(columns.items(), 1):
+            if column_entry_key in self.not_computed_columns:
+                continue
             query = column_entry.get_info_no_grouping_query(self)
             step_key = f"nogroup_{column_entry_key}"
             logger.info(
-                f"Querying column {column_entry_key} without grouping... ({i}/{len(column_keys)})",
+                f"Querying column {column_entry_key} without grouping... ({i}/{len(columns)})",
                 extra={"query": query, "step_key": step_key},
             )
-            value = self._get_count_from_sparql(query)
+            with self.column_deadline([column_entry_key]):
+                value = self._get_count_from_sparql(query)
+            if column_entry_key in self.not_computed_columns:
+                continue
             logger.info(
-                f"Column {column_entry_key} without grouping done ({i}/{len(column_keys)})",
+                f"Column {column_entry_key} without grouping done ({i}/{len(columns)})",
                 extra={"phase": "end", "step_key": step_key},
             )
             grouping_object.cells[column_entry_key] = value
 
         return grouping_object
 
-    def make_totals(self):
+    def make_totals(self, count=None):
         """
         Query the data for totals, return the grouping object.
         """
-        count = self.get_totals()
+        if count is None:
+            count = self.get_totals()
         grouping_object = TotalsGrouping(
             count=count,
             higher_grouping=self.grouping_configuration.higher_grouping,
         )
+        return self.populate_totals(grouping_object)
 
-        column_keys = list(self.columns.keys())
-        for i, (column_entry_key, column_entry) in enumerate(self.columns.items(), 1):
+    def populate_totals(self, grouping_object, column_keys=None):
+        """
+        Query the cells of the columns, all of them by default, for totals.
+        """
+        columns = self.get_columns(column_keys)
+        for i, (column_entry_key, column_entry) in enumerate(columns.items(), 1):
+            if column_entry_key in self.not_computed_columns:
+                continue
             query = column_entry.get_totals_query(self)
             step_key = f"totals_{column_entry_key}"
             logger.info(
-                f"Querying totals for column {column_entry_key}... ({i}/{len(column_keys)})",
+                f"Querying totals for column {column_entry_key}... ({i}/{len(columns)})",
                 extra={"query": query, "step_key": step_key},
             )
-            value = self._get_count_from_sparql(query)
+            with self.column_deadline([column_entry_key]):
+                value = self._get_count_from_sparql(query)
+            if column_entry_key in self.not_computed_columns:
+                continue
             logger.info(
-                f"Totals for column {column_entry_key} done ({i}/{len(column_keys)})",
+                f"Totals for column {column_entry_key} done ({i}/{len(columns)})",
                 extra={"phase": "end", "step_key": step_key},
             )
             grouping_object.cells[column_entry_key] = value
 
         return grouping_object
 
+    def make_stats_for_no_group_and_totals(self):
+        """
+        Query the data for both no_group and totals, with one query for the
+        counts and one per column, return the two grouping objects.
+        """
+        query = self.get_totals_and_no_grouping_query()
+        logger.info(
+            "Querying total item count and count of items without grouping...",
+            extra={"query": query, "step_key": "totals_count"},
+        )
+        count, no_grouping_count = self._get_counts_with_no_grouping_from_sparql(query)
+        logger.info(
+            "Total item count and count of items without grouping done",
+            extra={"phase": "end", "step_key": "totals_count"},
+        )
+        no_group_object = NoGroupGrouping(
+            count=no_grouping_count,
+            higher_grouping=self.grouping_configuration.higher_grouping,
+        )
+        totals_object = TotalsGrouping(
+            count=count,
+            higher_grouping=self.grouping_configuration.higher_grouping,
+        )
+        return self.populate_no_group_and_totals(no_group_object, totals_object)
+
+    def populate_no_group_and_totals(
+        self, no_group_object, totals_object, column_keys=None
+    ):
+        """
+        Query the cells of the columns, all of them by default, for both
+        no_group and totals, with one query per column.
+        """
+        columns = self.get_columns(column_keys)
+        for i, (column_entry_key, column_entry) in enumerate(columns.items(), 1):
+            if column_entry_key in self.not_computed_columns:
+                continue
+            query = column_entry.get_totals_and_no_grouping_query(self)
+            step_key = f"totals_{column_entry_key}"
+            logger.info(
+                f"Querying totals for column {column_entry_key}... ({i}/{len(columns)})",
+                extra={"query": query, "step_key": step_key},
+            )
+            with self.column_deadline([column_entry_key]):
+                value, no_grouping_value = (
+                    self._get_counts_with_no_grouping_from_sparql(query)
+                )
+            if column_entry_key in self.not_computed_columns:
+                continue
+            logger.info(
+                f"Totals for column {column_entry_key} done ({i}/{len(columns)})",
+                extra={"phase": "end", "step_key": step_key},
+            )
+            totals_object.cells[column_entry_key] = value
+            no_group_object.cells[column_entry_key] = no_grouping_value
+
+        return no_group_object, totals_object
+
+    def make_totals_from_groupings(self, groupings, count):
+        """
+        Sum the totals from the groupings, when they are known to split the
+        entities of the selector, and complete the total count of entities.
+
+        :param groupings: the groupings, with the no-group one if computed
+        :return: the grouping object, or None if totals must be queried
+        """
+        if int(self.property_threshold) > 0:
+            # Cells under the threshold are missing from the groupings
+            return None
+        if count != sum(grouping.count for grouping in groupings):
+            return None
+        if not self.grouping_configuration.is_partition(self.sparql_query_engine):
+            return None
+        grouping_object = TotalsGrouping(
+            count=count,
+            higher_grouping=self.grouping_configuration.higher_grouping,
+        )
+        for column_entry_key in self.columns:
+            grouping_object.cells[column_entry_key] = sum(
+                grouping.cells.get(column_entry_key, 0) for grouping in groupings
+            )
+        return grouping_object
+
     def retrieve_and_process_data(self):
         """
         Query the data, output wikitext
@@ -309,42 +945,104 @@ SELECT (COUNT(*) as ?count) WHERE {{
         text = self.process_data(groupings)
         return text
 
-    def populate_groupings(self, groupings):
-        column_keys = list(self.columns.keys())
+    def populate_groupings(self, groupings, column_keys=None):
+        """
+        Query the cells of the columns, all of them by default, into the
+        groupings.
+        """
+        columns = self.get_columns(column_keys)
+        column_keys = list(columns.keys())
         logger.info(
             f"Querying columns ({len(column_keys)})...",
             extra={"step_key": "columns"},
         )
-        for i, (column_entry_key, column_entry) in enumerate(self.columns.items(), 1):
-            query = column_entry.get_info_query(self)
-            logger.info(
-                f"Querying column {column_entry_key}... ({i}/{len(column_keys)})",
-                extra={"query": query, "step_key": f"columns_{column_entry_key}"},
-            )
-            data = self._get_grouping_counts_from_sparql(query)
-            logger.info(
-                f"Column {column_entry_key} done ({i}/{len(column_keys)})",
-                extra={"phase": "end", "step_key": f"columns_{column_entry_key}"},
-            )
-            if not data:
-                continue
-            for grouping_item, value in data.items():
+        pushdown_groupings = self.get_pushdown_groupings(groupings)
+        reference_scans = [
+            scan
+            for scan in self.get_reference_scans()
+            if any(key in columns for key in scan.columns)
+        ]
+        scans = {key: scan for scan in reference_scans for key in scan.columns}
+        scan_data = {}
+        queried_scans = []
+        own_threshold = self.get_query_property_threshold()
+        # One query per column or scan, then one per column for the totals
+        self._remaining_queries = len(column_keys) - len(scans) + len(reference_scans)
+        if self.row_no_group or self.row_totals:
+            self._remaining_queries += len(column_keys)
+        for i, (column_entry_key, column_entry) in enumerate(columns.items(), 1):
+            scan = scans.get(column_entry_key)
+            data = None
+            if scan is not None:
+                if scan not in queried_scans:
+                    queried_scans.append(scan)
+                    with self.column_deadline(list(scan.columns)):
+                        scan_data.update(
+                            self.query_reference_scan(scan, pushdown_groupings)
+                        )
+                if column_entry_key in self.not_computed_columns:
+                    continue
+                data = scan_data.pop(column_entry_key, None)
+                # Counts of the other columns of the scan are only filtered
+                # as a whole by the query
+                min_value = own_threshold
+                logger.info(
+                    f"Column {column_entry_key} done ({i}/{len(column_keys)})",
+                    extra={"phase": "end", "step_key": f"columns_{column_entry_key}"},
+                )
+            else:
+                property_threshold = self.get_column_property_threshold(column_entry)
+                query = self.get_column_info_query(column_entry, pushdown_groupings)
+                # Counts queried for a dashboard with a lower threshold are filtered
+                min_value = own_threshold if property_threshold < own_threshold else 0
+                logger.info(
+                    f"Querying column {column_entry_key}... ({i}/{len(column_keys)})",
+                    extra={"query": query, "step_key": f"columns_{column_entry_key}"},
+                )
+                with self.column_deadline([column_entry_key]):
+                    data = self._get_grouping_counts_from_sparql(query)
+                if column_entry_key in self.not_computed_columns:
+                    continue
+                logger.info(
+                    f"Column {column_entry_key} done ({i}/{len(column_keys)})",
+                    extra={"phase": "end", "step_key": f"columns_{column_entry_key}"},
+                )
+            cells = {}
+            for grouping_item, value in (data or {}).items():
+                if value < min_value:
+                    continue
                 grouping = groupings.get(grouping_item)
                 if grouping:
                     grouping.cells[column_entry_key] = value
+                    cells[str(grouping_item)] = value
                 else:
                     logging.debug(
                         f"Discarding data on {grouping_item}, not in the groupings"
                     )
+            self._populated_columns.append(column_entry_key)
+            self.publish_result("column", column=column_entry_key, cells=cells)
         logger.info(
             f"All columns queried ({len(column_keys)}/{len(column_keys)})",
             extra={"phase": "end", "step_key": "columns"},
         )
         return groupings
 
+    def query_reference_scan(self, scan, groupings=None):
+        """Query the counts of the columns of a reference scan."""
+        column_keys = ", ".join(scan.columns)
+        query = self.get_reference_scan_query(scan, groupings)
+        logger.info(
+            f"Querying columns {column_keys} with one statement scan...",
+            extra={"query": query, "step_key": f"columns_{next(iter(scan.columns))}"},
+        )
+        return self._get_scan_counts_from_sparql(query, scan)
+
     def retrieve_data(self):
+        self.grouping_configuration.prepare(
+            self.selector_sparql, self.sparql_query_engine
+        )
         grouping_query = self.grouping_configuration.get_grouping_information_query(
-            self.selector_sparql
+            self.selector_sparql, grouping_threshold=self.get_query_grouping_threshold()
         )
         logger.info(
             "Retrieving grouping information...",
@@ -361,7 +1059,22 @@ SELECT (COUNT(*) as ?count) WHERE {{
             f"Retrieved {len(groupings)} groupings",
             extra={"phase": "end", "step_key": "groupings"},
         )
+        self.publish_result(
+            "groupings",
+            columns=[
+                {"key": key, "title": getattr(column, "title", None) or key}
+                for key, column in self.columns.items()
+            ],
+            groupings=[
+                self.describe_line(grouping)
+                for grouping in sorted(
+                    groupings.values(), key=lambda t: t.count, reverse=True
+                )
+            ],
+        )
         groupings = self.populate_groupings(groupings)
+        # Kept as queried, as post-processing may rebin them
+        self._queried_groupings = groupings
         groupings = self.grouping_configuration.post_process(groupings)
         return groupings
 
@@ -369,8 +1082,20 @@ SELECT (COUNT(*) as ?count) WHERE {{
         sorted_groupings = sorted(
             groupings.values(), key=lambda t: t.count, reverse=True
         )
+        summary_start = len(sorted_groupings)
 
-        if self.row_no_group:
+        if self.row_no_group and self.row_totals:
+            logger.info(
+                "Computing stats for items without grouping and totals...",
+                extra={"step_key": "totals"},
+            )
+            sorted_groupings.extend(self.make_stats_for_no_group_and_totals())
+            logger.info(
+                "Computing stats for items without grouping and totals done",
+                extra={"phase": "end", "step_key": "totals"},
+            )
+
+        elif self.row_no_group:
             logger.info(
                 "Computing stats for items without grouping...",
                 extra={"step_key": "nogroup"},
@@ -381,17 +1106,104 @@ SELECT (COUNT(*) as ?count) WHERE {{
                 extra={"phase": "end", "step_key": "nogroup"},
             )
 
-        if self.row_totals:
+        elif self.row_totals:
             logger.info("Computing totals...", extra={"step_key": "totals"})
-            sorted_groupings.append(self.make_totals())
+            # When the groupings cover all entities, the totals may be
+            # summed from them rather than queried
+            count = self.get_totals()
+            totals = self.make_totals_from_groupings(sorted_groupings, count)
+            if totals is None:
+                totals = self.make_totals(count=count)
+            sorted_groupings.append(totals)
             logger.info(
                 "Computing totals done", extra={"phase": "end", "step_key": "totals"}
             )
 
+        self._summary_groupings = sorted_groupings[summary_start:]
+        for grouping in self._summary_groupings:
+            self.publish_result("summary", **self.describe_line(grouping))
         return sorted_groupings
 
+    def retry_not_computed_columns(self, time_budget):
+        """
+        Query the columns not computed again, within a new time budget.
+
+        Their cells are filled in the groupings and summary rows of the
+        previous pass, whose other cells are kept as they are.
+
+        :return: the groupings, and the wikitext with the cells of both passes
+        """
+        column_keys = [key for key in self.columns if key in self.not_computed_columns]
+        logger.info(f"Retrying columns {', '.join(column_keys)}...")
+        # The list is shared with the formatter
+        del self.not_computed_columns[:]
+        self.time_budget.reset(time_budget)
+        summary_column_keys = [
+            key for key in column_keys if key in self._populated_columns
+        ]
+        self._remaining_queries = 0
+        grouping_column_keys = [
+            key for key in column_keys if key not in summary_column_keys
+        ]
+        if grouping_column_keys:
+            self.populate_groupings(self._queried_groupings, grouping_column_keys)
+        if self.row_no_group or self.row_totals:
+            # Also query the summary rows of the columns only missing them
+            self._remaining_queries += len(summary_column_keys)
+        summary_groupings = {
+            type(grouping): grouping for grouping in self._summary_groupings
+        }
+        no_group = summary_groupings.get(NoGroupGrouping)
+        totals = summary_groupings.get(TotalsGrouping)
+        if no_group is not None and totals is not None:
+            self.populate_no_group_and_totals(no_group, totals, column_keys)
+        elif no_group is not None:
+            self.populate_no_group(no_group, column_keys)
+        elif totals is not None:
+            summed_totals = self.make_totals_from_groupings(
+                list(self._queried_groupings.values()), totals.count
+            )
+            if summed_totals is None:
+                self.populate_totals(totals, column_keys)
+            else:
+                for column_key in column_keys:
+                    if column_key not in self.not_computed_columns:
+                        totals.cells[column_key] = summed_totals.cells[column_key]
+
+        groupings = self.grouping_configuration.post_process(self._queried_groupings)
+        report_groupings = sorted(
+            groupings.values(), key=lambda t: t.count, reverse=True
+        )
+        report_groupings.extend(self._summary_groupings)
+        return groupings, self.formatter.format_report(report_groupings)
+
+    def estimate_report_groupings(self, report_groupings):
+        """
+        Scale the counts on the sample to estimates of the full counts, and
+        leave out the groupings and cells which fall below their threshold.
+        """
+        grouping_threshold = int(self.grouping_configuration.grouping_threshold)
+        property_threshold = int(self.property_threshold)
+        result = []
+        for grouping in report_groupings:
+            is_summary = isinstance(grouping, (NoGroupGrouping, TotalsGrouping))
+            grouping.count = self.sample.estimate(grouping.count)
+            if grouping.count < grouping_threshold and not is_summary:
+                continue
+            cells = collections.OrderedDict()
+            for column_key, value in grouping.cells.items():
+                value = self.sample.estimate(value)
+                if value >= property_threshold or is_summary:
+                    cells[column_key] = value
+            grouping.cells = cells
+            result.append(grouping)
+        return result
+
     def process_data(self, groupings):
-        return self.formatter.format_report(self.prepare_report_groupings(groupings))
+        report_groupings = self.prepare_report_groupings(groupings)
+        if self.sample is not None:
+            report_groupings = self.estimate_report_groupings(report_groupings)
+        return self.formatter.format_report(report_groupings)
 
 
 def main(*args):
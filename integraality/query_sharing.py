@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Sharing of identical SPARQL queries between the dashboards of a cycle."""
+
+import collections
+import contextlib
+
+
+def make_query_key(engine, query):
+    """
+    Return the canonical key of a query: the endpoint it is sent to, and its
+    text with whitespace normalised.
+    """
+    return (engine.name, getattr(engine, "endpoint", None), " ".join(query.split()))
+
+
+class SharedQueryResults:
+    """
+    Results of the queries that several dashboards of a cycle have in common.
+
+    The queries are planned up front, with one use per dashboard needing
+    them. A planned query is only sent once: its result is kept until its
+    last planned use, and then dropped. Queries which were not planned are
+    sent as usual.
+
+    Queries run while planning (e.g. the detection of the grouping type) are
+    kept for when the dashboard is processed.
+    """
+
+    def __init__(self):
+        self._remaining = collections.Counter()
+        self._results = {}
+        self._thresholds = {}
+        self._planning = False
+        self.planned_count = 0
+        self.executed_count = 0
+        self.reused_count = 0
+
+    @contextlib.contextmanager
+    def planning(self):
+        self._planning = True
+        try:
+            yield self
+        finally:
+            self._planning = False
+
+    def plan(self, engine, query):
+        self._remaining[make_query_key(engine, query)] += 1
+        self.planned_count += 1
+
+    def plan_threshold(self, engine, query, threshold):
+        """
+        Record the threshold wanted by a dashboard for a query, given
+        without threshold; the lowest one wins.
+        """
+        key = make_query_key(engine, query)
+        self._thresholds[key] = min(threshold, self._thresholds.get(key, threshold))
+
+    def get_threshold(self, engine, query, threshold):
+        """Return the threshold planned for a query, given without threshold."""
+        return self._thresholds.get(make_query_key(engine, query), threshold)
+
+    def is_planned(self, engine, query):
+        """Whether the query is planned, or its result kept, for a dashboard."""
+        key = make_query_key(engine, query)
+        return key in self._remaining or key in self._results
+
+    def get_shared_count(self):
+        """Return the number of planned queries used more than once."""
+        return sum(1 for count in self._remaining.values() if count > 1)
+
+    def _execute(self, engine, query, **kwargs):
+        self.executed_count += 1
+        return engine.select(query, **kwargs)
+
+    def select(self, engine, query, **kwargs):
+        key = make_query_key(engine, query)
+        if self._planning:
+            if key not in self._results:
+                self._results[key] = self._execute(engine, query, **kwargs)
+            self.plan(engine, query)
+            return self._results[key]
+
+        if key not in self._remaining:
+            return engine.select(query, **kwargs)
+
+        if key in self._results:
+            result = self._results[key]
+            self.reused_count += 1
+        else:
+            result = self._execute(engine, query, **kwargs)
+
+        self._remaining[key] -= 1
+        if self._remaining[key] > 0:
+            self._results[key] = result
+        else:
+            del self._remaining[key]
+            self._results.pop(key, None)
+        return result
+
+    def get_report(self):
+        return {
+            "planned": self.planned_count,
+            "executed": self.executed_count,
+            "saved": self.reused_count,
+        }
+
+
+class SharedSparqlQueryEngine:
+    """Wrap an engine so that its queries go through a SharedQueryResults."""
+
+    def __init__(self, engine, shared_results):
+        self.engine = engine
+        self.shared_results = shared_results
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def select(self, query, **kwargs):
+        return self.shared_results.select(self.engine, query, **kwargs)
@@ -13,11 +13,21 @@ class ResultsFormatter:
         grouping_configuration,
         property_threshold=0,
         cell_template="Integraality cell",
+        sample=None,
+        not_computed_columns=(),
     ):
+        """
+        :param sample: the EntitySample the counts were estimated from, if
+            they are approximate
+        :param not_computed_columns: keys of the columns whose counts could
+            not be computed, shown as such
+        """
         self.columns = columns
         self.grouping_configuration = grouping_configuration
         self.property_threshold = property_threshold
         self.cell_template = cell_template
+        self.sample = sample
+        self.not_computed_columns = not_computed_columns
 
     def format_report(self, groupings):
         """Format groupings into WikiText table.
@@ -38,6 +48,12 @@ class ResultsFormatter:
 
     def _format_header(self):
         text = '{| class="wikitable sortable"\n'
+        if self.sample is not None:
+            text += (
+                f"|+ Approximate preview, estimated from a sample of "
+                f"{round(self.sample.rate * 100, 2)}% of the items "
+                f"(± gives the 95% confidence interval)\n"
+            )
         colspan = 3 if self.grouping_configuration.higher_grouping else 2
         text += f'! colspan="{colspan}" |Top groupings (Minimum {self.grouping_configuration.grouping_threshold} items)\n'
         if self.columns:
@@ -60,7 +76,28 @@ class ResultsFormatter:
         text += grouping_object.format_header_cell(
             self.grouping_configuration, grouping_type
         )
+        if self.sample is not None:
+            return text + self._format_approximate_cells(grouping_object)
         text += grouping_object.format_count_cell()
         for column_entry in self.columns.values():
-            text += grouping_object.format_cell(column_entry, self.cell_template)
+            if column_entry.get_key() in self.not_computed_columns:
+                text += grouping_object.format_not_computed_cell()
+            else:
+                text += grouping_object.format_cell(column_entry, self.cell_template)
+        return text
+
+    def _format_approximate_cells(self, grouping_object):
+        """Format the count and cells of a row of estimates, with their margin."""
+        count = grouping_object.count
+        text = f"| ~{count} ±{self.sample.get_margin(count)} \n"
+        for column_entry in self.columns.values():
+            if column_entry.get_key() in self.not_computed_columns:
+                text += grouping_object.format_not_computed_cell()
+                continue
+            value = grouping_object.cells.get(column_entry.get_key(), 0)
+            text += grouping_object.format_cell(
+                column_entry,
+                self.cell_template,
+                extra_fields=(f"margin={self.sample.get_margin(value)}",),
+            )
         return text
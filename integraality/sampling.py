@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Deterministic sampling of entities, for approximate previews."""
+
+import math
+
+
+class EntitySample:
+    """
+    The entities whose hashed URI falls below a threshold.
+
+    The sample is the same for every query, so that the counts of the
+    groupings and of the columns stay consistent with each other. Counts
+    on the sample are scaled back to estimates of the full counts.
+    """
+
+    # Hexadecimal digits of the MD5 hash compared to the threshold
+    HASH_DIGITS = 4
+    # Two-sided 95% confidence
+    Z_SCORE = 1.96
+
+    def __init__(self, rate):
+        buckets = 16**self.HASH_DIGITS
+        # A threshold of all the buckets would not fit in HASH_DIGITS digits
+        self.threshold = min(max(1, round(rate * buckets)), buckets - 1)
+        self.rate = self.threshold / buckets
+
+    def __eq__(self, other):
+        return isinstance(other, EntitySample) and self.threshold == other.threshold
+
+    def get_filter(self, variable="?entity"):
+        return (
+            f"FILTER(SUBSTR(MD5(STR({variable})), 1, {self.HASH_DIGITS}) "
+            f'< "{self.threshold:0{self.HASH_DIGITS}x}")'
+        )
+
+    def apply_to_selector(self, selector_sparql):
+        """Return the selector restricted to the sampled entities."""
+        return f"{selector_sparql.strip().rstrip('.').rstrip()} . {self.get_filter()}"
+
+    def get_sample_threshold(self, threshold):
+        """Return the count on the sample matching a threshold on full counts."""
+        threshold = int(threshold)
+        if threshold <= 0:
+            return 0
+        return max(1, math.floor(threshold * self.rate))
+
+    def estimate(self, count):
+        """Return the estimate of the full count from a count on the sample."""
+        return round(count / self.rate)
+
+    def get_margin(self, estimate):
+        """Return the half-width of the confidence interval of an estimate."""
+        return round(self.Z_SCORE * math.sqrt(estimate * (1 - self.rate) / self.rate))
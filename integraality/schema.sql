@@ -1,5 +1,17 @@
 CREATE TABLE IF NOT EXISTS dashboards (
     page_title VARCHAR(255) NOT NULL,
     site_url VARCHAR(255) NOT NULL DEFAULT 'https://www.wikidata.org/wiki/',
+    status VARCHAR(32) NOT NULL DEFAULT 'new',
+    config_hash CHAR(40) NULL,
+    last_run_at DATETIME NULL,
+    last_run_duration FLOAT NULL,
+    last_error TEXT NULL,
+    last_seen_at DATETIME NOT NULL,
     PRIMARY KEY (page_title, site_url)
 );
+
+CREATE INDEX IF NOT EXISTS dashboards_site_status_last_run
+    ON dashboards (site_url, status, last_run_at);
+
+CREATE INDEX IF NOT EXISTS dashboards_site_last_seen
+    ON dashboards (site_url, last_seen_at);
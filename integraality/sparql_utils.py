@@ -2,12 +2,18 @@
 # -*- coding: utf-8 -*-
 """SPARQL engine abstraction (WDQS and QLever)."""
 
+import json
+
 import pywikibot
+import pywikibot.comms.http
 import pywikibot.data.sparql
 import requests
 
 from .error_category import ErrorCategory
 
+WIKIDATA_ENTITY_URL = "http://www.wikidata.org/entity/"
+COMMONS_ENTITY_URL = "https://commons.wikimedia.org/entity/"
+
 
 class QueryException(Exception):
     error_category = ErrorCategory.QUERY
@@ -34,7 +40,8 @@ class SparqlEngineBuilder:
         """
         if site_url and "commons.wikimedia.org" in site_url:
             return QLeverSparqlQueryEngine(
-                endpoint="https://qlever.dev/api/wikimedia-commons"
+                endpoint="https://qlever.dev/api/wikimedia-commons",
+                entity_url=COMMONS_ENTITY_URL,
             )
         if sparql_endpoint:
             if "qlever" in sparql_endpoint.lower():
@@ -49,28 +56,111 @@ class SparqlEngineBuilder:
 
 
 class SparqlQueryEngine:
-    pass
+    # Prefix of the IRIs of the entities selected by the dashboards
+    entity_url = WIKIDATA_ENTITY_URL
+    # Seconds a query may run, when it has no deadline of its own
+    TIMEOUT = 30
+    # Shortest timeout requests accepts, for queries at their deadline
+    MIN_TIMEOUT = 0.1
+    CHUNK_SIZE = 64 * 1024
+
+    def get_timeout(self, cancel_token=None):
+        """Return the timeout of a query, cut down to its deadline if any."""
+        time_left = None if cancel_token is None else cancel_token.query_time_left
+        if time_left is None:
+            return self.TIMEOUT
+        return max(self.MIN_TIMEOUT, min(self.TIMEOUT, time_left))
+
+    def _get_cancellable(self, params, cancel_token, headers=None):
+        """
+        Stream the response, dropping the connection as soon as the token
+        is cancelled instead of downloading the rest of the results.
+        """
+        with requests.get(
+            self.endpoint,
+            params=params,
+            headers=headers,
+            timeout=self.get_timeout(cancel_token),
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                cancel_token.raise_if_cancelled()
+                chunks.append(chunk)
+        return json.loads(b"".join(chunks))
+
+
+class CancellableSparqlQueryEngine:
+    """
+    Wrap an engine so that no query is sent once the token is cancelled.
+
+    The token is also handed to the engine, to abort in-flight queries
+    where it can, and checked again once they return or time out.
+    """
+
+    def __init__(self, engine, cancel_token):
+        self.engine = engine
+        self.cancel_token = cancel_token
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def select(self, query):
+        self.cancel_token.raise_if_cancelled()
+        try:
+            result = self.engine.select(query, cancel_token=self.cancel_token)
+        except QueryException:
+            # The endpoint timing out at the deadline is reported as such
+            self.cancel_token.raise_if_cancelled()
+            raise
+        self.cancel_token.raise_if_cancelled()
+        return result
 
 
 class WdqsSparqlQueryEngine(SparqlQueryEngine):
     name = "Wikidata Query Service"
+    endpoint = "https://query.wikidata.org/sparql"
+    # The service itself stops queries after a minute
+    TIMEOUT = 60
 
     def __init__(self):
         self.sq = pywikibot.data.sparql.SparqlQuery(
-            endpoint="https://query.wikidata.org/sparql",
-            entity_url="http://www.wikidata.org/entity/",
+            endpoint=self.endpoint,
+            entity_url=self.entity_url,
         )
 
-    def select(self, query):
+    def select(self, query, cancel_token=None):
         try:
-            return self.sq.select(query)
-        except (pywikibot.exceptions.TimeoutError, pywikibot.exceptions.ServerError):
+            if cancel_token is None:
+                return self.sq.select(query)
+            # pywikibot gives no hold on the request once it is sent, and
+            # retries it on timeouts
+            headers = {
+                "Accept": "application/sparql-results+json",
+                "User-Agent": pywikibot.comms.http.user_agent(),
+            }
+            data = self._get_cancellable({"query": query}, cancel_token, headers)
+            return self._transform_response(data)
+        except (
+            pywikibot.exceptions.TimeoutError,
+            pywikibot.exceptions.ServerError,
+            requests.exceptions.RequestException,
+        ):
             raise QueryException(
                 "The Wikidata Query Service timed out when running a SPARQL query."
                 "You might be trying to do something too expensive.",
                 query=query,
             )
 
+    def _transform_response(self, data):
+        """Transform the response like pywikibot does, unbound variables as None."""
+        variables = data["head"]["vars"]
+        return [
+            {var: row[var]["value"] if var in row else None for var in variables}
+            for row in data["results"]["bindings"]
+        ]
+
 
 def add_prefixes_to_query(query):
     """Add standard Wikidata prefixes to a SPARQL query for QLever."""
@@ -87,6 +177,7 @@ def add_prefixes_to_query(query):
         "PREFIX bd: <http://www.bigdata.com/rdf#>",
         "PREFIX wikibase: <http://wikiba.se/ontology#>",
         "PREFIX wdno: <http://www.wikidata.org/prop/novalue/>",
+        "PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>",
     ]
     return "\n".join(prefixes) + "\n" + query
 
@@ -94,22 +185,28 @@ def add_prefixes_to_query(query):
 class QLeverSparqlQueryEngine(SparqlQueryEngine):
     name = "QLever"
 
-    def __init__(self, endpoint="https://qlever.dev/api/wikidata"):
+    def __init__(self, endpoint="https://qlever.dev/api/wikidata", entity_url=None):
         self.endpoint = endpoint
+        if entity_url is not None:
+            self.entity_url = entity_url
 
     @property
     def ui_url(self):
         return self.endpoint.replace("/api/", "/") + "/"
 
-    def select(self, query):
+    def select(self, query, cancel_token=None):
         try:
             query = add_prefixes_to_query(query)
 
             params = {"query": query}
-            response = requests.get(self.endpoint, params=params, timeout=30)
-            response.raise_for_status()
-
-            data = response.json()
+            if cancel_token is None:
+                response = requests.get(
+                    self.endpoint, params=params, timeout=self.TIMEOUT
+                )
+                response.raise_for_status()
+                data = response.json()
+            else:
+                data = self._get_cancellable(params, cancel_token)
 
             return self._transform_response(data)
 
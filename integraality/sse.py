@@ -1,11 +1,12 @@
 """Server-Sent Events for live update progress."""
 
+import contextvars
+import functools
 import json
 import logging
 import queue
 import threading
 import traceback
-from logging.handlers import QueueHandler
 
 
 def _classify_error(e):
@@ -24,32 +25,77 @@ def _classify_error(e):
     return event
 
 
-def run_with_sse(func, logger_name="integraality.update"):
-    """Run func in a background thread, yielding SSE events from its log messages."""
-    q = queue.Queue()
-    logger = logging.getLogger(logger_name)
-    handler = QueueHandler(q)
-    handler.setLevel(logging.INFO)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
+_progress_channel = contextvars.ContextVar("progress_channel", default=None)
+_handled_loggers = set()
+_handled_loggers_lock = threading.Lock()
+
+
+class ProgressChannelHandler(logging.Handler):
+    """Route each log record to the progress channel of its context, if any."""
+
+    def emit(self, record):
+        channel = _progress_channel.get()
+        if channel is not None:
+            channel.put(record)
+
+
+def _ensure_progress_handler(logger_name):
+    """Attach the one ProgressChannelHandler of the logger, on first use."""
+    with _handled_loggers_lock:
+        if logger_name in _handled_loggers:
+            return
+        logger = logging.getLogger(logger_name)
+        handler = ProgressChannelHandler()
+        handler.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        _handled_loggers.add(logger_name)
+
+
+def publish_partial_result(result):
+    """
+    Send a partial result (e.g. the cells of a column) to the progress
+    channel of the current context, if any, as a "partial" event.
+
+    Meant as the result_callback of PropertyStatistics.
+    """
+    channel = _progress_channel.get()
+    if channel is not None:
+        channel.put({"status": "partial", **result})
+
 
-    worker_thread = None
+def propagate_context(func):
+    """
+    Wrap func to run in a copy of the current context.
 
-    class ThreadFilter(logging.Filter):
-        def filter(self, record):
-            return record.thread == worker_thread.ident
+    Use it for work handed to other threads (e.g. a thread pool), so that
+    their log messages reach the same progress channel.
+    """
+    context = contextvars.copy_context()
 
-    thread_filter = ThreadFilter()
-    handler.addFilter(thread_filter)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def iter_progress_events(func, logger_name="integraality.update"):
+    """Run func in a background thread, yielding event dicts from its log messages."""
+    _ensure_progress_handler(logger_name)
+    q = queue.Queue()
 
     def target():
+        _progress_channel.set(q)
         try:
             result = func()
             q.put({"status": "done", "result": result})
         except Exception as e:
             q.put(_classify_error(e))
 
-    worker_thread = threading.Thread(target=target)
+    worker_thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(target,)
+    )
     worker_thread.start()
 
     try:
@@ -66,10 +112,22 @@ def run_with_sse(func, logger_name="integraality.update"):
                     "step_key": getattr(event, "step_key", None),
                 }
 
-            yield f"data: {json.dumps(event)}\n\n"
+            yield event
 
-            if event["status"] in ("done", "error"):
+            if is_final_event(event):
                 break
     finally:
-        logger.removeHandler(handler)
         worker_thread.join(timeout=1)
+
+
+def is_final_event(event):
+    return event["status"] in ("done", "error")
+
+
+def format_sse(events):
+    """Format event dicts as Server-Sent Events, and None as a keepalive comment."""
+    for event in events:
+        if event is None:
+            yield ": keepalive\n\n"
+        else:
+            yield f"data: {json.dumps(event)}\n\n"
@@ -1,18 +1,29 @@
 # -*- coding: utf-8  -*-
 import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+
+import fakeredis
 
 from .. import column
 from ..app import app
+from ..metrics import Metrics
 from ..pages_processor import ProcessingException, TransientServerException
+from ..property_statistics import InvalidDrilldownException
 from ..sparql_utils import QueryException
+from ..update_jobs import UpdateJob, UpdateQueue
 
 
 class AppTests(unittest.TestCase):
     def setUp(self):
         app.config["TESTING"] = True
         self.app = app.test_client()
+        self.cache_client = fakeredis.FakeStrictRedis()
+        patcher = patch(
+            "integraality.app.get_cache_client", return_value=self.cache_client
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
 
 class BasicTests(AppTests):
@@ -26,6 +37,19 @@ class BasicTests(AppTests):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json(), {"status": "healthy"})
 
+    def test_metrics(self):
+        Metrics(self.cache_client).incr("updates_cancelled")
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"updates_cancelled": 1})
+
+    def test_metrics_cache_hit_ratio(self):
+        Metrics(self.cache_client).incr_many(
+            {"cache_local_hits": 3, "cache_local_misses": 1}
+        )
+        response = self.app.get("/metrics")
+        self.assertEqual(response.get_json()["cache_local_hit_ratio"], 0.75)
+
     def test_404_page(self):
         response = self.app.get("/unexisting_page")
         self.assertEqual(response.status_code, 404)
@@ -89,6 +113,26 @@ class UpdateTests(PagesProcessorTests):
                 events.append(json.loads(line[len("data: ") :]))
         return events
 
+    def test_update_stream_partial_results(self):
+        def process_one_page(page_title, cancel_token=None, result_callback=None):
+            result_callback({"kind": "column", "column": "P1", "cells": {"Q1": 3}})
+            return 4.56
+
+        self.mock_pages_processor.return_value.process_one_page.side_effect = (
+            process_one_page
+        )
+        response = self.app.get(
+            "/update/stream?page=%s&url=%s" % (self.page_title, self.page_url)
+        )
+        events = self._parse_sse_events(response)
+        partial = {
+            "status": "partial",
+            "kind": "column",
+            "column": "P1",
+            "cells": {"Q1": 3},
+        }
+        self.assertEqual(events[-2:], [partial, {"status": "done", "result": 4.56}])
+
     def test_update_stream_success_end_to_end(self):
         self.mock_pages_processor.return_value.process_one_page.return_value = 4.56
         response = self.app.get(
@@ -158,6 +202,37 @@ class UpdateTests(PagesProcessorTests):
         self.assertIn("unexpected", error_event["message"])
         self.assertIn("traceback", error_event)
 
+    def test_update_stream_attaches_to_running_update(self):
+        job = UpdateJob(self.cache_client, self.page_url, self.page_title)
+        self.assertTrue(job.acquire())
+        job.record({"status": "progress", "message": "Already running"})
+        job.record({"status": "done", "result": 7.0})
+        job.release()
+        self.cache_client.set(job.lock_key, "other-runner")
+
+        response = self.app.get(
+            "/update/stream?page=%s&url=%s" % (self.page_title, self.page_url)
+        )
+        events = self._parse_sse_events(response)
+        self.mock_pages_processor.return_value.process_one_page.assert_not_called()
+        self.assertEqual(events[0]["message"], "Already running")
+        self.assertEqual(events[-1], {"status": "done", "result": 7.0})
+
+    def test_update_stream_queued_for_workers(self):
+        queue = UpdateQueue(self.cache_client)
+        queue.heartbeat("worker-1")
+
+        # The update is left to the (absent) worker, so do not wait for it
+        with patch.object(UpdateJob, "iter_events", return_value=iter([])):
+            self.app.get(
+                "/update/stream?page=%s&url=%s" % (self.page_title, self.page_url)
+            )
+        job = queue.pop(timeout=1)
+        self.assertEqual(job.page_title, self.page_title)
+        self.assertEqual(job.url, self.page_url)
+        self.assertIsNone(queue.pop(timeout=1))
+        self.mock_pages_processor.assert_not_called()
+
     def test_update_success(self):
         response = self.app.get(
             "/update?page=%s&url=%s&nostream" % (self.page_title, self.page_url)
@@ -235,6 +310,58 @@ class UpdateTests(PagesProcessorTests):
         self.assertSuccessPage(response, message)
 
 
+class PreviewTests(PagesProcessorTests):
+    def test_preview(self):
+        self.mock_pages_processor.return_value.preview_one_page.return_value = (
+            "{| class=...\n|}",
+            1.5,
+        )
+        response = self.app.get(
+            "/preview?page=%s&url=%s&rate=0.05" % (self.page_title, self.page_url)
+        )
+        self.mock_pages_processor.return_value.preview_one_page.assert_called_once_with(
+            self.page_title, sample_rate=0.05
+        )
+        content = response.get_data(as_text=True)
+        self.assertPresent("(in 1.50s). It was not saved.", content)
+        self.assertPresent("<pre><code>{| class=...\n|}</code></pre>", content)
+
+    def test_preview_error(self):
+        self.mock_pages_processor.return_value.preview_one_page.side_effect = (
+            ProcessingException("bad config")
+        )
+        response = self.app.get(
+            "/preview?page=%s&url=%s" % (self.page_title, self.page_url)
+        )
+        self.mock_pages_processor.return_value.preview_one_page.assert_called_once_with(
+            self.page_title, sample_rate=None
+        )
+        self.assertPresent("bad config", response.get_data(as_text=True))
+
+    def test_preview_invalid_rate(self):
+        for rate in ["nan", "inf", "-0.5", "0", "1.5", "foo"]:
+            response = self.app.get(
+                "/preview?page=%s&url=%s&rate=%s"
+                % (self.page_title, self.page_url, rate)
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertPresent(
+                "The sample rate must be a number between 0 and 1.",
+                response.get_data(as_text=True),
+            )
+        self.mock_pages_processor.return_value.preview_one_page.assert_not_called()
+
+    def test_preview_unknown_error(self):
+        self.mock_pages_processor.return_value.preview_one_page.side_effect = (
+            ValueError("Boom")
+        )
+        response = self.app.get(
+            "/preview?page=%s&url=%s&rate=1" % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertPresent("ValueError: Boom", response.get_data(as_text=True))
+
+
 class QueriesTests(PagesProcessorTests):
     def setUp(self):
         super().setUp()
@@ -272,6 +399,16 @@ class QueriesTests(PagesProcessorTests):
         }
         self.addCleanup(patcher1.stop)
 
+        self.mock_pages_processor.return_value.get_cached_queries_for_column.return_value = (
+            None,
+            None,
+        )  # noqa
+
+        self.mock_pages_processor.return_value.cache = None
+        patcher_label = patch("integraality.app.get_grouping_label", return_value=None)
+        self.mock_get_grouping_label = patcher_label.start()
+        self.addCleanup(patcher_label.stop)
+
     def _make_query_data(self, col, positive="X", negative="Z"):
         return {
             "column": col,
@@ -534,6 +671,7 @@ class QueriesTests(PagesProcessorTests):
                 "page_url": self.page_url,
                 "column": "P1",
                 "grouping": "Q2",
+                "grouping_label": None,
                 "formatted_predicate": '<a href="https://wikidata.org/wiki/Property:P495">P495</a>',
                 "positive_query": "SELECT ?x",
                 "negative_query": "SELECT ?y",
@@ -541,6 +679,33 @@ class QueriesTests(PagesProcessorTests):
             },
         )
 
+    def test_queries_grouping_label(self):
+        self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value = self.mock_property_statistics  # noqa
+        self.mock_property_statistics.get_queries_for_column.return_value = (
+            self._make_query_data(self.column_P1)
+        )
+        self.mock_get_grouping_label.return_value = "France"
+        response = self.app.get(
+            "/queries?page=%s&url=%s&column=P1&grouping=Q2&lang=fr"
+            % (self.page_title, self.page_url)
+        )
+        self.mock_get_grouping_label.assert_called_once_with(
+            self.page_url,
+            "Q2",
+            "fr",
+            cache=None,
+        )
+        content = response.get_data(as_text=True)
+        self.assertPresent(
+            'with <a href="https://wikidata.org/wiki/Q2">Q2</a> (France) as', content
+        )
+
+        response = self.app.get(
+            "/queries?page=%s&url=%s&column=P1&grouping=Q2&format=json"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.get_json()["grouping_label"], "France")
+
     def test_queries_json_format_processing_exception(self):
         self.mock_pages_processor.return_value.make_stats_object_for_page_title.side_effect = ProcessingException(
             "bad config"
@@ -564,3 +729,209 @@ class QueriesTests(PagesProcessorTests):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(response.content_type, "application/json")
         self.assertEqual(response.get_json(), {"error": "boom"})
+
+    def test_queries_from_cache(self):
+        self.mock_pages_processor.return_value.get_cached_queries_for_column.return_value = (  # noqa
+            {
+                "column": "P1",
+                "column_html_snippet": self.column_P1.format_html_snippet(),
+                "column_type_name": "property",
+                "positive_query": "X",
+                "negative_query": "Z",
+                "formatted_predicate": '<a href="https://wikidata.org/wiki/Property:P495">P495</a>',
+            },
+            "",
+        )
+        response = self.app.get(
+            "/queries?page=%s&url=%s&column=P1&grouping=Q2"
+            % (self.page_title, self.page_url)
+        )
+        self.mock_pages_processor.return_value.get_cached_queries_for_column.assert_called_once_with(
+            self.page_title, "P1", "Q2", "en"
+        )  # noqa
+        self.mock_pages_processor.return_value.make_stats_object_for_page_title.assert_not_called()
+        # Cached as having no label
+        self.mock_get_grouping_label.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        content = response.get_data(as_text=True)
+        expected_body = (
+            '<p>From page <a href="https://wikidata.org/wiki/Foo">Foo</a>, '
+            '<a href="https://wikidata.org/wiki/Property:P1">P1</a>, '
+            'with <a href="https://wikidata.org/wiki/Q2">Q2</a> as <a href="https://wikidata.org/wiki/Property:P495">P495</a>.</p>\n\t'
+        )
+        self.assertPresent(expected_body, content)
+        expected_wdqs = (
+            '<a class="btn btn-primary" href="https://query.wikidata.org/#X" role="button">WDQS: All items with the property set</a>'
+            '<a class="btn btn-primary" href="https://query.wikidata.org/#Z" role="button">WDQS: All items without the property set</a>'
+        )
+        self.assertPresent(expected_wdqs, content)
+
+
+class DrilldownTests(PagesProcessorTests):
+    def setUp(self):
+        super().setUp()
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.columns = {"P1/S*": Mock()}
+
+    def test_drilldown(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.return_value = {
+            "entities": ["Q1"],
+            "variables": ["entity", "entityLabel"],
+            "rows": [
+                {"entity": "http://www.wikidata.org/entity/Q1", "entityLabel": "Foo"}
+            ],
+            "next": "Q1",
+        }
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&kind=negative"
+            % (self.page_title, self.page_url)
+        )
+        mock_stats.get_drilldown_page.assert_called_once_with(
+            "P1/S*", "Q2", positive=False, after=None
+        )
+        self.assertEqual(response.status_code, 200)
+        content = response.get_data(as_text=True)
+        self.assertPresent(
+            '<td><a href="https://www.wikidata.org/wiki/Q1">Q1</a></td>', content
+        )
+        self.assertPresent("<td>Foo</td>", content)
+        self.assertIn("after=Q1", content)
+
+    def test_drilldown_json(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.return_value = {
+            "entities": ["Q1"],
+            "variables": ["entity", "entityLabel"],
+            "rows": [
+                {"entity": "http://www.wikidata.org/entity/Q1", "entityLabel": "Foo"}
+            ],
+            "next": None,
+        }
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&after=Q0&format=json"
+            % (self.page_title, self.page_url)
+        )
+        mock_stats.get_drilldown_page.assert_called_once_with(
+            "P1/S*", "Q2", positive=True, after="Q0"
+        )
+        self.assertEqual(response.content_type, "application/json")
+        data = response.get_json()
+        self.assertEqual(data["rows"][0]["entityLabel"], "Foo")
+        self.assertEqual(data["after"], "Q0")
+        self.assertIsNone(data["next"])
+
+    def test_drilldown_csv(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.return_value = {
+            "entities": ["Q1"],
+            "variables": ["entity", "entityLabel"],
+            "rows": [
+                {
+                    "entity": "http://www.wikidata.org/entity/Q1",
+                    "entityLabel": "Foo, bar",
+                }
+            ],
+            "next": "Q1",
+        }
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&format=csv"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertEqual(response.headers["X-Next-After"], "Q1")
+        self.assertEqual(
+            response.get_data(as_text=True),
+            'entity,entityLabel\r\nhttp://www.wikidata.org/entity/Q1,"Foo, bar"\r\n',
+        )
+
+    def test_drilldown_json_query_exception(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.side_effect = QueryException(
+            "Timeout", "SELECT X"
+        )
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&format=json"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.get_json(), {"error": "Timeout"})
+
+    def test_drilldown_unknown_column(self):
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P2&grouping=Q2"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("There is no column P2", response.get_data(as_text=True))
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.assert_not_called()
+
+    def test_drilldown_invalid_arguments(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.side_effect = InvalidDrilldownException(
+            "Invalid entity X."
+        )
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&after=X&format=json"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {"error": "Invalid entity X."})
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&after=X"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_drilldown_query_exception(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.side_effect = QueryException(
+            "Timeout", "SELECT X"
+        )
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "The query timed out or returned no result.",
+            response.get_data(as_text=True),
+        )
+
+    def test_drilldown_transient_server_exception(self):
+        self.mock_pages_processor.return_value.make_stats_object_for_page_title.side_effect = TransientServerException(
+            "503 Service Unavailable"
+        )
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&format=json"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json(), {"error": "503 Service Unavailable"})
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "A temporary server issue occurred.", response.get_data(as_text=True)
+        )
+
+    def test_drilldown_unknown_error(self):
+        mock_stats = self.mock_pages_processor.return_value.make_stats_object_for_page_title.return_value
+        mock_stats.get_drilldown_page.side_effect = ValueError("Boom")
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2&format=json"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json(), {"error": "Boom"})
+        response = self.app.get(
+            "/drilldown?page=%s&url=%s&column=P1/S*&grouping=Q2"
+            % (self.page_title, self.page_url)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "Something catastrophic happened", response.get_data(as_text=True)
+        )
@@ -0,0 +1,270 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+import fakeredis
+
+from ..cache import LocalCache, RedisCache, TieredCache
+from ..metrics import Metrics
+
+
+class RedisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.cache = RedisCache(self.client)
+
+    def test_versioned_key(self):
+        self.assertEqual(self.cache.make_key("foo"), "integraality:v1:foo")
+
+    def test_round_trip(self):
+        self.cache.set_cache_value("foo", {"selector_sparql": "wdt:P31 wd:Q5"})
+        self.assertEqual(
+            self.client.get("integraality:v1:foo"),
+            b'j{"selector_sparql":"wdt:P31 wd:Q5"}',
+        )
+        self.assertEqual(
+            self.cache.get_cache_value("foo"), {"selector_sparql": "wdt:P31 wd:Q5"}
+        )
+
+    def test_ttl(self):
+        self.cache.set_cache_value("foo", 1, ttl=60)
+        self.assertLessEqual(self.client.ttl("integraality:v1:foo"), 60)
+
+    def test_compressed_round_trip(self):
+        value = {"properties": ",".join(f"P{i}" for i in range(1000))}
+        self.cache.set_cache_value("foo", value)
+        cached_value = self.client.get("integraality:v1:foo")
+        self.assertTrue(cached_value.startswith(b"z"))
+        self.assertLess(len(cached_value), len(value["properties"]))
+        self.assertEqual(self.cache.get_cache_value("foo"), value)
+
+    def test_unreadable_value(self):
+        self.client.set("integraality:v1:foo", b"\x80\x04garbage")
+        self.assertIsNone(self.cache.get_cache_value("foo"))
+        self.assertFalse(self.client.exists("integraality:v1:foo"))
+
+    def test_get_cache_values(self):
+        self.cache.set_cache_values({"foo": [1], "bar": {"a": "b"}})
+        self.client.set("integraality:v1:baz", b"\x80\x04garbage")
+        self.assertEqual(
+            self.cache.get_cache_values(["foo", "bar", "baz", "qux"]),
+            {"foo": [1], "bar": {"a": "b"}},
+        )
+        self.assertEqual(self.cache.get_cache_values([]), {})
+
+    def test_cache_mapping(self):
+        self.cache.set_cache_mapping("foo", {"a": {"b": 1}, "c": "d"})
+        self.assertEqual(self.cache.get_cache_mapping_value("foo", "a"), {"b": 1})
+        self.assertEqual(self.cache.get_cache_mapping_value("foo", "c"), "d")
+        self.assertIsNone(self.cache.get_cache_mapping_value("foo", "e"))
+        self.cache.invalidate_mapping("foo")
+        self.assertIsNone(self.cache.get_cache_mapping_value("foo", "a"))
+
+
+class KeyspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.cache = RedisCache(self.client)
+        self.cache.set_cache_value("www.wikidata.org:Foo", {"a": 1})
+        self.cache.set_cache_value("www.wikidata.org:Bar", {"a": 2})
+        self.cache.invalidate("www.wikidata.org:Bar")
+        self.cache.set_cache_mapping("queries:www.wikidata.org:Foo", {"P1|*": {}})
+        self.client.set("integraality:www.wikidata.org:Old", b"pickled")
+        self.client.set("integraality:update:www.wikidata.org:Foo:lock", b"token")
+        self.client.set("otherapp:key", b"value")
+
+    def test_iter_keys(self):
+        self.assertEqual(
+            sorted(self.cache.iter_keys()),
+            [
+                "integraality:update:www.wikidata.org:Foo:lock",
+                "integraality:v1:queries:www.wikidata.org:Foo",
+                "integraality:v1:www.wikidata.org:Bar:stale",
+                "integraality:v1:www.wikidata.org:Foo",
+                "integraality:www.wikidata.org:Old",
+            ],
+        )
+
+    def test_invalidate_prefix(self):
+        self.assertEqual(self.cache.invalidate_prefix(), 3)
+        self.assertEqual(
+            sorted(self.cache.iter_keys()),
+            [
+                "integraality:update:www.wikidata.org:Foo:lock",
+                "integraality:www.wikidata.org:Old",
+            ],
+        )
+        self.assertTrue(self.client.exists("otherapp:key"))
+
+    def test_get_stats(self):
+        stats = self.cache.get_stats()
+        self.assertEqual(
+            sorted(stats.keys()),
+            ["config", "config (stale)", "queries", "unversioned", "update"],
+        )
+        self.assertEqual(stats["config"]["count"], 1)
+        self.assertEqual(stats["config"]["size"], len(b'j{"a":1}'))
+        self.assertEqual(stats["config"]["ttl"], {"<= 1 week": 1})
+        self.assertEqual(stats["config (stale)"]["ttl"], {"< 1 day": 1})
+        self.assertEqual(stats["queries"]["size"], len(b"{}"))
+        self.assertEqual(stats["unversioned"]["ttl"], {"no expiry": 1})
+
+    def test_describe_outdated_key(self):
+        self.assertEqual(
+            self.cache.describe_key("integraality:v0:www.wikidata.org:Foo"),
+            "v0 config (outdated)",
+        )
+
+
+class GetOrComputeTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.cache = RedisCache(self.client)
+        self.cache.COMPUTE_POLL_INTERVAL = 0.01
+        self.compute = Mock(return_value={"a": 1})
+
+    def test_hit(self):
+        self.cache.set_cache_value("foo", {"a": 0})
+        self.assertEqual(self.cache.get_or_compute("foo", self.compute), {"a": 0})
+        self.compute.assert_not_called()
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get_or_compute("foo", self.compute), {"a": 1})
+        self.assertEqual(self.cache.get_cache_value("foo"), {"a": 1})
+        self.assertFalse(self.client.exists("integraality:v1:foo:lock"))
+
+    def test_serves_stale_while_computing(self):
+        self.cache.set_cache_value("foo", {"a": 0})
+        self.cache.invalidate("foo")
+        self.client.set("integraality:v1:foo:lock", "other")
+        self.assertEqual(self.cache.get_or_compute("foo", self.compute), {"a": 0})
+        self.compute.assert_not_called()
+
+    def test_waits_for_computation(self):
+        self.client.set("integraality:v1:foo:lock", "other")
+
+        def finish_computation():
+            time.sleep(0.05)
+            self.cache.set_cache_value("foo", {"a": 2})
+
+        thread = threading.Thread(target=finish_computation)
+        thread.start()
+        self.assertEqual(self.cache.get_or_compute("foo", self.compute), {"a": 2})
+        thread.join()
+        self.compute.assert_not_called()
+
+    def test_computes_after_waiting_too_long(self):
+        self.cache.COMPUTE_WAIT = 0.05
+        self.client.set("integraality:v1:foo:lock", "other")
+        self.assertEqual(self.cache.get_or_compute("foo", self.compute), {"a": 1})
+        self.compute.assert_called_once_with()
+        self.assertEqual(self.client.get("integraality:v1:foo:lock"), b"other")
+
+    def test_concurrent_misses_compute_once(self):
+        def compute():
+            time.sleep(0.05)
+            return {"a": 1}
+
+        self.compute.side_effect = compute
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.get_or_compute("foo", self.compute)
+                )
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{"a": 1}] * 5)
+        self.compute.assert_called_once_with()
+
+
+class LocalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.local = LocalCache(fakeredis.FakeStrictRedis(), max_size=2, ttl=60)
+
+    def test_get_set(self):
+        self.assertIsNone(self.local.get("a"))
+        self.local.set("a", 1)
+        self.assertEqual(self.local.get("a"), 1)
+
+    def test_evicts_least_recently_used(self):
+        self.local.set("a", 1)
+        self.local.set("b", 2)
+        self.local.get("a")
+        self.local.set("c", 3)
+        self.assertEqual(self.local.get("a"), 1)
+        self.assertIsNone(self.local.get("b"))
+        self.assertEqual(self.local.get("c"), 3)
+
+    def test_expires(self):
+        self.local.ttl = -1
+        self.local.set("a", 1)
+        self.assertIsNone(self.local.get("a"))
+
+    def test_drain_skipped_while_another_thread_drains(self):
+        self.local.get("a")
+        self.local._pubsub = Mock()
+        with self.local._pubsub_lock:
+            self.local.get("a")
+        self.local._pubsub.get_message.assert_not_called()
+        self.local._pubsub.get_message.return_value = None
+        self.local.get("a")
+        self.local._pubsub.get_message.assert_called_once_with()
+
+
+class TieredCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.cache = TieredCache(self.client, local_cache=LocalCache(self.client))
+        self.other_cache = TieredCache(self.client, local_cache=LocalCache(self.client))
+
+    def test_get_from_local_tier(self):
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.assertEqual(self.cache.get_cache_value("foo"), {"a": 1})
+        self.client.delete("integraality:v1:foo")
+        self.assertEqual(self.cache.get_cache_value("foo"), {"a": 1})
+
+    def test_returns_copies(self):
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.cache.get_cache_value("foo").pop("a")
+        self.assertEqual(self.cache.get_cache_value("foo"), {"a": 1})
+
+    def test_invalidation_reaches_other_processes(self):
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.assertEqual(self.other_cache.get_cache_value("foo"), {"a": 1})
+        self.cache.invalidate("foo")
+        self.assertIsNone(self.other_cache.get_cache_value("foo"))
+
+    def test_update_reaches_other_processes(self):
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.assertEqual(self.other_cache.get_cache_value("foo"), {"a": 1})
+        self.cache.set_cache_value("foo", {"a": 2})
+        self.assertEqual(self.other_cache.get_cache_value("foo"), {"a": 2})
+
+    def test_invalidate_prefix_reaches_other_processes(self):
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.assertEqual(self.other_cache.get_cache_value("foo"), {"a": 1})
+        self.assertEqual(self.cache.invalidate_prefix(), 1)
+        self.assertIsNone(self.other_cache.get_cache_value("foo"))
+
+    def test_hit_counts(self):
+        self.cache.get_cache_value("foo")
+        self.cache.set_cache_value("foo", {"a": 1})
+        self.cache.get_cache_value("foo")
+        self.cache.get_cache_value("foo")
+        self.cache.local.flush_stats()
+        self.assertEqual(
+            Metrics(self.client).get_all(),
+            {
+                "cache_local_hits": 1,
+                "cache_local_misses": 2,
+                "cache_redis_hits": 1,
+                "cache_redis_misses": 1,
+            },
+        )
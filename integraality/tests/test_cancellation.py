@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import Mock
+
+from ..cancellation import (
+    CancelToken,
+    DeadlineExceededException,
+    TimeBudget,
+    UpdateCancelledException,
+)
+
+
+class CancelTokenTest(unittest.TestCase):
+    def test_cancel(self):
+        token = CancelToken()
+        self.assertFalse(token.cancelled)
+        token.raise_if_cancelled()
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        with self.assertRaises(UpdateCancelledException):
+            token.raise_if_cancelled()
+
+    def test_check(self):
+        check = Mock(return_value=True)
+        token = CancelToken(check=check)
+        self.assertTrue(token.cancelled)
+        self.assertTrue(token.cancelled)
+        check.assert_called_once_with()
+
+    def test_check_is_rate_limited(self):
+        check = Mock(return_value=False)
+        token = CancelToken(check=check)
+        token.CHECK_INTERVAL = 3600
+        self.assertFalse(token.cancelled)
+        self.assertFalse(token.cancelled)
+        check.assert_called_once_with()
+
+
+class TimeBudgetTest(unittest.TestCase):
+    def test_no_deadline_outside_queries(self):
+        budget = TimeBudget(0)
+        self.assertFalse(budget.cancelled)
+        budget.raise_if_cancelled()
+
+    def test_query_deadline(self):
+        budget = TimeBudget(3600)
+        with budget.query_deadline(4):
+            self.assertFalse(budget.cancelled)
+            self.assertAlmostEqual(budget._deadline - budget.expires_at, -2700, delta=1)
+
+    def test_query_time_left(self):
+        budget = TimeBudget(3600)
+        self.assertIsNone(budget.query_time_left)
+        with budget.query_deadline(4):
+            self.assertAlmostEqual(budget.query_time_left, 900, delta=1)
+        self.assertIsNone(CancelToken().query_time_left)
+
+    def test_query_deadline_exceeded(self):
+        budget = TimeBudget(0)
+        with budget.query_deadline(2):
+            self.assertTrue(budget.cancelled)
+            with self.assertRaises(DeadlineExceededException):
+                budget.raise_if_cancelled()
+
+    def test_reset(self):
+        budget = TimeBudget(0)
+        budget.reset(3600)
+        with budget.query_deadline(2):
+            self.assertFalse(budget.cancelled)
+
+    def test_parent_cancelled(self):
+        parent = CancelToken()
+        budget = TimeBudget(3600, parent=parent)
+        parent.cancel()
+        self.assertTrue(budget.cancelled)
+        with self.assertRaises(UpdateCancelledException):
+            budget.raise_if_cancelled()
@@ -10,6 +10,7 @@ from ..column import (
     PropertyColumn,
     QualifierColumn,
     ReferenceColumn,
+    ReferenceScan,
     SitelinkColumn,
 )
 from ..grouping import GroupingConfiguration, ItemGroupingType
@@ -75,6 +76,19 @@ SELECT (COUNT(*) AS ?count) WHERE {
     ?entity p:P131[]
   })
 }
+"""
+        self.assertEqual(result, expected)
+
+    def test_get_totals_and_no_grouping_query(self):
+        result = self.column.get_totals_and_no_grouping_query(self.stats)
+        expected = """
+SELECT (COUNT(*) AS ?count) (SUM(?no_grouping) AS ?no_grouping_count) WHERE {
+  ?entity wdt:P31 wd:Q39715 .
+  BIND(IF(EXISTS { ?entity wdt:P17 [] }, 0, 1) AS ?no_grouping)
+  FILTER(EXISTS {
+    ?entity p:P131[]
+  })
+}
 """
         self.assertEqual(result, expected)
 
@@ -706,6 +720,18 @@ class TestReferenceColumn(PropertyStatisticsTest):
         )
         self.assertEqual(result, expected)
 
+    def test_get_filter_for_entity_page(self):
+        result = self.column.get_filter_for_entity_page()
+        self.assertIn("?_unreferenced_stmt prov:wasDerivedFrom []", result)
+        self.assertNotIn("?_refNode", result)
+
+    def test_get_filter_for_entity_page_negative(self):
+        result = self.column.get_filter_for_entity_page(positive=False)
+        self.assertIn(
+            "FILTER(!BOUND(?_any_stmt) || BOUND(?_unreferenced_stmt))", result
+        )
+        self.assertNotIn("?_show_stmt", result)
+
     def test_get_totals_query(self):
         result = self.column.get_totals_query(self.stats)
         expected = """
@@ -1206,3 +1232,63 @@ class TestReferenceColumnQualifierScoped(PropertyStatisticsTest):
         self.assertEqual(col1, col2)
         self.assertNotEqual(col1, col3)
         self.assertNotEqual(col1, col4)
+
+
+class TestReferenceScan(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.columns = {
+            "P31/S*": ReferenceColumn(property="P31"),
+            "P31/S248": ReferenceColumn(
+                property="P31", reference_check=PropertyReferenceCheck("P248")
+            ),
+            "P31/Q5/S*": ReferenceColumn(property="P31", value="Q5"),
+            "P21": PropertyColumn(property="P21"),
+        }
+
+    def test_make_scans(self):
+        scans = ReferenceScan.make_scans(self.columns)
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(list(scans[0].columns), ["P31/S*", "P31/S248"])
+
+    def test_make_scans_single_column(self):
+        del self.columns["P31/S248"]
+        self.assertEqual(ReferenceScan.make_scans(self.columns), [])
+
+    def test_get_info_query(self):
+        scan = ReferenceScan.make_scans(self.columns)[0]
+        result = scan.get_info_query(self.stats)
+        expected = """
+SELECT ?grouping (SUM(?referenced_0) AS ?count_0) (SUM(?referenced_1) AS ?count_1) WHERE {
+  {
+    SELECT ?entity ?grouping (MIN(?statement_referenced_0) AS ?referenced_0) (MIN(?statement_referenced_1) AS ?referenced_1) WHERE {
+  ?entity wdt:P31 wd:Q39715 .
+  ?entity wdt:P17 ?grouping .
+  ?entity p:P31 ?_unreferenced_stmt .
+  BIND(IF(EXISTS {
+    ?_unreferenced_stmt prov:wasDerivedFrom []
+  }, 1, 0) AS ?statement_referenced_0)
+  BIND(IF(EXISTS {
+    ?_unreferenced_stmt prov:wasDerivedFrom/pr:P248 []
+  }, 1, 0) AS ?statement_referenced_1)
+    }
+    GROUP BY ?entity ?grouping
+  }
+}
+GROUP BY ?grouping
+HAVING (?count_0 >= 10 || ?count_1 >= 10)
+"""
+        self.assertEqual(result, expected)
+
+    def test_get_info_query_value_scoped(self):
+        self.columns["P31/Q5/S!"] = ReferenceColumn(
+            property="P31", value="Q5", reference_check=GoodReferenceCheck()
+        )
+        scan = ReferenceScan.make_scans(self.columns)[1]
+        result = scan.get_info_query(self.stats, property_threshold=0)
+        self.assertIn(
+            "  ?entity p:P31 ?_unreferenced_stmt .\n"
+            "  ?_unreferenced_stmt ps:P31 wd:Q5 .\n",
+            result,
+        )
+        self.assertIn("HAVING (?count_0 >= 0 || ?count_1 >= 0)", result)
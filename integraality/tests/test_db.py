@@ -4,7 +4,7 @@
 import unittest
 from unittest.mock import MagicMock, patch
 
-from ..db import _read_schema, ensure_schema, get_connection
+from ..db import DashboardRegistry, _read_schema, ensure_schema, get_connection
 
 
 class TestReadSchema(unittest.TestCase):
@@ -48,6 +48,64 @@ class TestEnsureSchema(unittest.TestCase):
         mock_conn.commit.assert_called_once()
 
 
+class TestDashboardRegistry(unittest.TestCase):
+    def setUp(self):
+        self.conn = MagicMock()
+        self.cursor = MagicMock()
+        self.conn.cursor.return_value.__enter__ = MagicMock(return_value=self.cursor)
+        self.conn.cursor.return_value.__exit__ = MagicMock(return_value=False)
+        self.url = "https://www.wikidata.org/wiki/"
+        self.registry = DashboardRegistry(self.conn, self.url)
+
+    def test_needs_reconciliation(self):
+        self.cursor.fetchone.return_value = (None,)
+        self.assertTrue(self.registry.needs_reconciliation(86400))
+        self.cursor.fetchone.return_value = (1,)
+        self.assertFalse(self.registry.needs_reconciliation(86400))
+        self.assertEqual(self.cursor.execute.call_args.args[1], (86400, self.url))
+
+    def test_reconcile(self):
+        self.cursor.fetchone.return_value = ("2026-01-01 00:00:00",)
+        self.cursor.rowcount = 1
+        result = self.registry.reconcile(iter(["Foo", "Bar"]))
+        self.assertEqual(result, (2, 1))
+        self.assertEqual(
+            self.cursor.executemany.call_args.args[1],
+            [("Foo", self.url), ("Bar", self.url)],
+        )
+        delete_query, delete_params = self.cursor.execute.call_args.args
+        self.assertTrue(delete_query.startswith("DELETE FROM dashboards"))
+        self.assertEqual(delete_params, (self.url, "2026-01-01 00:00:00"))
+        self.conn.commit.assert_called_once()
+
+    def test_get_page_titles(self):
+        self.cursor.fetchall.return_value = [("Foo",), ("Bar",)]
+        self.assertEqual(self.registry.get_page_titles(), ["Foo", "Bar"])
+        query, params = self.cursor.execute.call_args.args
+        self.assertEqual(
+            query,
+            "SELECT page_title FROM dashboards WHERE site_url = %s"
+            " ORDER BY last_run_at",
+        )
+        self.assertEqual(params, [self.url])
+
+    def test_get_page_titles_filtered(self):
+        self.cursor.fetchall.return_value = []
+        self.registry.get_page_titles(statuses=("ok", "new"), not_run_for=3600)
+        query, params = self.cursor.execute.call_args.args
+        self.assertIn("AND status IN (%s, %s)", query)
+        self.assertIn("INTERVAL %s SECOND", query)
+        self.assertEqual(params, [self.url, "ok", "new", 3600])
+
+    def test_record_run(self):
+        self.registry.record_run("Foo", "ok", duration=1.5, config_hash="abc")
+        self.assertEqual(
+            self.cursor.execute.call_args.args[1],
+            ("Foo", self.url, "ok", "abc", 1.5, None),
+        )
+        self.conn.commit.assert_called_once()
+
+
 class TestGetConnection(unittest.TestCase):
     """Test connection routing based on replica.my.cnf presence.
 
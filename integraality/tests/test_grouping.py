@@ -71,7 +71,7 @@ LIMIT 1000
         )
         result = grouping_configuration.get_grouping_information_query("Q1")
         expected = """
-SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?count WHERE {
+SELECT ?grouping ?count WHERE {
   {
     SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
       ?entity Q1 .
@@ -80,46 +80,44 @@ SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?count WHERE {
     GROUP BY ?grouping
     HAVING (?count >= 20)
   }
-  OPTIONAL { ?grouping wdt:P2 ?_higher_grouping }.
 }
-GROUP BY ?grouping ?count
 ORDER BY DESC(?count)
 LIMIT 1000
 """
         self.assertEqual(result, expected)
 
-    def test_get_grouping_information_query_with_grouping_link(self):
+    def test_get_decorations_query_with_higher_grouping(self):
+        grouping_configuration = grouping.GroupingConfiguration(
+            predicate="wdt:P1",
+            grouping_type=grouping.ItemGroupingType(),
+            higher_grouping="wdt:P2",
+        )
+        result = grouping_configuration.get_decorations_query(["Q3", "Q4"])
+        expected = """
+SELECT ?grouping ?higher_grouping WHERE {
+  VALUES ?grouping { wd:Q3 wd:Q4 }
+  OPTIONAL { ?grouping wdt:P2 ?higher_grouping }.
+}
+"""
+        self.assertEqual(result, expected)
+
+    def test_get_decorations_query_with_grouping_link(self):
         grouping_configuration = grouping.GroupingConfiguration(
             predicate="wdt:P1",
             grouping_type=grouping.ItemGroupingType(),
             higher_grouping="wdt:P2",
             grouping_link_type=LabelGroupingLink(template="Foo/{Len}"),
         )
-        result = grouping_configuration.get_grouping_information_query("Q1")
+        self.assertNotIn(
+            "grouping_link_value",
+            grouping_configuration.get_grouping_information_query("Q1"),
+        )
+        result = grouping_configuration.get_decorations_query(["Q3"])
         expected = """
-SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?grouping_link_value ?count WHERE {
-  {
-    SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
-      ?entity Q1 .
-      ?entity wdt:P1 ?grouping .
-    }
-    GROUP BY ?grouping
-    HAVING (?count >= 20)
-  }
-  OPTIONAL { ?grouping wdt:P2 ?_higher_grouping }.
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelMUL.
-    FILTER(lang(?groupinglabelMUL)='mul')
-  }}.
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelEN.
-    FILTER(lang(?groupinglabelEN)='en')
-  }}.
-  BIND(COALESCE(?groupinglabelEN, ?groupinglabelMUL) AS ?grouping_link_value).
+SELECT ?grouping ?higher_grouping WHERE {
+  VALUES ?grouping { wd:Q3 }
+  OPTIONAL { ?grouping wdt:P2 ?higher_grouping }.
 }
-GROUP BY ?grouping ?grouping_link_value ?count
-ORDER BY DESC(?count)
-LIMIT 1000
 """
         self.assertEqual(result, expected)
 
@@ -155,38 +153,14 @@ LIMIT 1000
 """
         self.assertEqual(result, expected)
 
-    def test_get_grouping_information_query_with_grouping_link(self):
+    def test_has_decorations_with_label_grouping_link(self):
         grouping_configuration = grouping.GroupingConfiguration(
             predicate="wdt:P1",
             grouping_type=grouping.YearGroupingType(),
             grouping_link_type=LabelGroupingLink(template="Foo/{Len}"),
         )
-        result = grouping_configuration.get_grouping_information_query("Q1")
-        expected = """
-SELECT ?grouping ?grouping_link_value ?count WHERE {
-  {
-    SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
-      ?entity Q1 .
-      ?entity wdt:P1 ?date .
-      BIND(YEAR(?date) as ?grouping) .
-    }
-    GROUP BY ?grouping
-    HAVING (?count >= 20)
-  }
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelMUL.
-    FILTER(lang(?groupinglabelMUL)='mul')
-  }}.
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelEN.
-    FILTER(lang(?groupinglabelEN)='en')
-  }}.
-  BIND(COALESCE(?groupinglabelEN, ?groupinglabelMUL) AS ?grouping_link_value).
-}
-ORDER BY DESC(?count)
-LIMIT 1000
-"""
-        self.assertEqual(result, expected)
+        self.assertTrue(grouping_configuration.has_decorations())
+        self.assertFalse(grouping_configuration.has_sparql_decorations())
 
 
 class SitelinkGroupingConfigurationTest(unittest.TestCase):
@@ -223,29 +197,20 @@ LIMIT 1000
 """
         self.assertEqual(result, expected)
 
-    def test_get_grouping_information_query_with_higher_grouping(self):
+    def test_get_decorations_query_with_higher_grouping(self):
         grouping_configuration = grouping.GroupingConfiguration(
             predicate="^schema:about",
             grouping_type=grouping.SitelinkGroupingType(),
             higher_grouping="wikibase:wikiGroup",
         )
-        result = grouping_configuration.get_grouping_information_query("Q1")
+        result = grouping_configuration.get_decorations_query(
+            ["https://br.wikipedia.org/"]
+        )
         expected = """
-SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?count WHERE {
-  {
-    SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
-      ?entity Q1 .
-      ?entity ^schema:about ?sitelink.
-      ?sitelink schema:isPartOf ?grouping.
-    }
-    GROUP BY ?grouping
-    HAVING (?count >= 20)
-  }
-  OPTIONAL { ?grouping wikibase:wikiGroup ?_higher_grouping }.
+SELECT ?grouping ?higher_grouping WHERE {
+  VALUES ?grouping { <https://br.wikipedia.org/> }
+  OPTIONAL { ?grouping wikibase:wikiGroup ?higher_grouping }.
 }
-GROUP BY ?grouping ?count
-ORDER BY DESC(?count)
-LIMIT 1000
 """
         self.assertEqual(result, expected)
 
@@ -359,6 +324,63 @@ class TestResolveType(unittest.TestCase):
         mock_engine.select.assert_not_called()
 
 
+class TestIsPartition(unittest.TestCase):
+    def setUp(self):
+        self.mock_engine = create_autospec(WdqsSparqlQueryEngine, instance=True)
+
+    def test_single_value_constraint(self):
+        self.mock_engine.select.return_value = [{"count": "1"}]
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P17", grouping_type=grouping.ItemGroupingType()
+        )
+        self.assertTrue(config.is_partition(self.mock_engine))
+        self.assertIn("wd:P17 p:P2302", self.mock_engine.select.call_args.args[0])
+
+    def test_no_single_value_constraint(self):
+        self.mock_engine.select.return_value = [{"count": "0"}]
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P17", grouping_type=grouping.ItemGroupingType()
+        )
+        self.assertFalse(config.is_partition(self.mock_engine))
+
+    def test_constraint_query_failure(self):
+        from ..sparql_utils import QueryException
+
+        self.mock_engine.select.side_effect = QueryException("timeout", query="")
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P17", grouping_type=grouping.ItemGroupingType()
+        )
+        self.assertFalse(config.is_partition(self.mock_engine))
+
+    def test_property_path(self):
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P131/wdt:P17", grouping_type=grouping.ItemGroupingType()
+        )
+        self.assertFalse(config.is_partition(self.mock_engine))
+        self.mock_engine.select.assert_not_called()
+
+    def test_year(self):
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P569", grouping_type=grouping.YearGroupingType()
+        )
+        self.assertTrue(config.is_partition(self.mock_engine))
+        self.mock_engine.select.assert_not_called()
+
+    def test_sitelink(self):
+        config = grouping.GroupingConfiguration(
+            predicate="^schema:about", grouping_type=grouping.SitelinkGroupingType()
+        )
+        self.assertFalse(config.is_partition(self.mock_engine))
+
+    def test_explicit_groupings(self):
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P569",
+            grouping_type=grouping.YearGroupingType(),
+            explicit_groupings=[2020],
+        )
+        self.assertFalse(config.is_partition(self.mock_engine))
+
+
 class TestParseGroupings(unittest.TestCase):
     def test_parse_item_groupings(self):
         result = grouping.ItemGroupingType.parse_groupings("Q1,Q2,Q3")
@@ -408,6 +430,26 @@ class TestParseGroupings(unittest.TestCase):
         self.assertEqual(result, expected)
 
 
+class TestIsValidGrouping(unittest.TestCase):
+    def test_item(self):
+        self.assertTrue(grouping.ItemGroupingType.is_valid_grouping("Q142"))
+        self.assertFalse(grouping.ItemGroupingType.is_valid_grouping("Q142 ."))
+        self.assertFalse(grouping.ItemGroupingType.is_valid_grouping("Q142\n"))
+
+    def test_year(self):
+        self.assertTrue(grouping.YearGroupingType.is_valid_grouping("1990"))
+        self.assertTrue(grouping.YearGroupingType.is_valid_grouping("-500/100"))
+        self.assertFalse(grouping.YearGroupingType.is_valid_grouping("1990) ."))
+
+    def test_sitelink(self):
+        self.assertTrue(
+            grouping.SitelinkGroupingType.is_valid_grouping("https://br.wikipedia.org/")
+        )
+        self.assertFalse(
+            grouping.SitelinkGroupingType.is_valid_grouping("https://a.org/> . ?s")
+        )
+
+
 class TestExplicitGroupings(unittest.TestCase):
     def test_item_grouping_get_values_clause(self):
         config = grouping.GroupingConfiguration(
@@ -532,6 +574,109 @@ LIMIT 1000
         self.assertEqual(result, expected)
 
 
+class YearTimeSpanTest(unittest.TestCase):
+    def setUp(self):
+        self.grouping_type = grouping.YearGroupingType()
+        self.mock_engine = create_autospec(WdqsSparqlQueryEngine, instance=True)
+
+    def make_result(self, first, last):
+        return [{"first": str(first), "last": str(last)}]
+
+    def test_get_year_range_query(self):
+        query = self.grouping_type.get_year_range_query("wdt:P31 wd:Q5", "wdt:P569")
+        self.assertEqual(
+            query,
+            "SELECT (MIN(YEAR(?date)) AS ?first) (MAX(YEAR(?date)) AS ?last) WHERE {\n"
+            "  ?entity wdt:P31 wd:Q5 .\n"
+            "  ?entity wdt:P569 ?date .\n"
+            "}",
+        )
+
+    def test_prepare_picks_time_span(self):
+        self.mock_engine.select.return_value = self.make_result(1880, 2024)
+        self.grouping_type.prepare("wdt:P31 wd:Q5", "wdt:P569", self.mock_engine)
+        self.assertEqual(self.grouping_type.time_span, 10)
+        self.assertEqual(
+            self.grouping_type.get_grouping_selector("wdt:P569"),
+            [
+                "  ?entity wdt:P569 ?date .",
+                "  BIND(xsd:integer(FLOOR(YEAR(?date) / 10) * 10) as ?grouping) .",
+            ],
+        )
+
+    def test_prepare_negative_years(self):
+        self.mock_engine.select.return_value = self.make_result(-4500, 2020)
+        self.grouping_type.prepare("wdt:P31 wd:Q5", "wdt:P569", self.mock_engine)
+        self.assertEqual(self.grouping_type.time_span, 100)
+
+    def test_prepare_few_years(self):
+        self.mock_engine.select.return_value = self.make_result(1950, 2049)
+        self.grouping_type.prepare("wdt:P31 wd:Q5", "wdt:P569", self.mock_engine)
+        self.assertEqual(self.grouping_type.time_span, 1)
+
+    def test_prepare_no_dates(self):
+        self.mock_engine.select.return_value = [{}]
+        self.grouping_type.prepare("wdt:P31 wd:Q5", "wdt:P569", self.mock_engine)
+        self.assertEqual(self.grouping_type.time_span, 1)
+
+    def test_prepare_query_failure(self):
+        from ..sparql_utils import QueryException
+
+        self.mock_engine.select.side_effect = QueryException("timeout", query="")
+        self.grouping_type.prepare("wdt:P31 wd:Q5", "wdt:P569", self.mock_engine)
+        self.assertEqual(self.grouping_type.time_span, 1)
+
+    def test_post_process_binned(self):
+        self.grouping_type.time_span = 10
+        groupings = collections.OrderedDict(
+            [
+                ("1900", YearGrouping(title="1900", count=5)),
+                ("1910", YearGrouping(title="1910", count=3)),
+            ]
+        )
+        result = self.grouping_type.post_process(groupings)
+        self.assertEqual(list(result.keys()), ["1900/10", "1910/10"])
+        self.assertEqual(result["1910/10"].count, 3)
+
+    def test_post_process_binned_too_many(self):
+        self.grouping_type.time_span = 10
+        groupings = collections.OrderedDict(
+            (str(year), YearGrouping(title=str(year), count=5))
+            for year in range(0, 2000, 10)
+        )
+        result = self.grouping_type.post_process(groupings)
+        self.assertEqual(len(result), 20)
+        self.assertEqual(result["1900/100"].count, 50)
+
+    def test_prepared_before_grouping_query(self):
+        self.mock_engine.select.side_effect = [
+            [{"datatype": "http://www.w3.org/2001/XMLSchema#dateTime"}],
+            self.make_result(1000, 2020),
+        ]
+        config = grouping.GroupingConfiguration(predicate="wdt:P569")
+        config._resolve_type("wdt:P31 wd:Q5", self.mock_engine)
+        # Only probed when the groupings are about to be queried
+        self.assertEqual(self.mock_engine.select.call_count, 1)
+        self.assertTrue(config.needs_preparation())
+        config.prepare("wdt:P31 wd:Q5", self.mock_engine)
+        config.prepare("wdt:P31 wd:Q5", self.mock_engine)
+        self.assertEqual(self.mock_engine.select.call_count, 2)
+        self.assertFalse(config.needs_preparation())
+        self.assertEqual(config.grouping_type.time_span, 100)
+
+    def test_explicit_groupings_not_prepared(self):
+        self.mock_engine.select.return_value = [
+            {"datatype": "http://www.w3.org/2001/XMLSchema#dateTime"}
+        ]
+        config = grouping.GroupingConfiguration(
+            predicate="wdt:P569", raw_explicit_groupings="2020,2021"
+        )
+        config._resolve_type("wdt:P31 wd:Q5", self.mock_engine)
+        self.assertFalse(config.needs_preparation())
+        config.prepare("wdt:P31 wd:Q5", self.mock_engine)
+        self.assertEqual(self.mock_engine.select.call_count, 1)
+
+
 class YearRebinningTest(unittest.TestCase):
     def setUp(self):
         self.config = grouping.GroupingConfiguration(
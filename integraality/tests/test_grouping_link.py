@@ -85,25 +85,13 @@ class TestLabelGroupingLink(unittest.TestCase):
         self.assertEqual(result, "Foo/Q123")
 
     def test_get_select_clause(self):
-        self.assertEqual(self.link.get_select_clause(), "?grouping_link_value")
+        self.assertEqual(self.link.get_select_clause(), "")
 
     def test_get_sparql_fragment(self):
-        (fragment, group_by) = self.link.get_sparql_fragment()
-        self.assertEqual(group_by, "?grouping_link_value")
-        self.assertEqual(
-            fragment,
-            [
-                "  OPTIONAL {{",
-                "    ?grouping rdfs:label ?groupinglabelMUL.",
-                "    FILTER(lang(?groupinglabelMUL)='mul')",
-                "  }}.",
-                "  OPTIONAL {{",
-                "    ?grouping rdfs:label ?groupinglabelEN.",
-                "    FILTER(lang(?groupinglabelEN)='en')",
-                "  }}.",
-                "  BIND(COALESCE(?groupinglabelEN, ?groupinglabelMUL) AS ?grouping_link_value).",
-            ],
-        )
+        self.assertEqual(self.link.get_sparql_fragment(), ([], None))
+
+    def test_label_language(self):
+        self.assertEqual(self.link.label_language, "en")
 
 
 class TestLabelGroupingLinkFrench(unittest.TestCase):
@@ -114,23 +102,8 @@ class TestLabelGroupingLinkFrench(unittest.TestCase):
         result = self.link.resolve("Q456", {"grouping_link_value": "Chose"})
         self.assertEqual(result, "Foo/Chose")
 
-    def test_get_sparql_fragment(self):
-        (fragment, group_by) = self.link.get_sparql_fragment()
-        self.assertEqual(group_by, "?grouping_link_value")
-        self.assertEqual(
-            fragment,
-            [
-                "  OPTIONAL {{",
-                "    ?grouping rdfs:label ?groupinglabelMUL.",
-                "    FILTER(lang(?groupinglabelMUL)='mul')",
-                "  }}.",
-                "  OPTIONAL {{",
-                "    ?grouping rdfs:label ?groupinglabelFR.",
-                "    FILTER(lang(?groupinglabelFR)='fr')",
-                "  }}.",
-                "  BIND(COALESCE(?groupinglabelFR, ?groupinglabelMUL) AS ?grouping_link_value).",
-            ],
-        )
+    def test_label_language(self):
+        self.assertEqual(self.link.label_language, "fr")
 
 
 class TestIdGroupingLink(unittest.TestCase):
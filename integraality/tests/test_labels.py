@@ -0,0 +1,75 @@
+# -*- coding: utf-8  -*-
+"""Unit tests for labels.py."""
+
+import unittest
+from unittest.mock import create_autospec
+
+import fakeredis
+
+from ..cache import INVALIDATION_CHANNEL, RedisCache, TieredCache
+from ..labels import LabelService
+from ..sparql_utils import WdqsSparqlQueryEngine
+
+
+def make_label(entity_id, lang, label):
+    return {
+        "item": f"http://www.wikidata.org/entity/{entity_id}",
+        "lang": lang,
+        "label": label,
+    }
+
+
+class LabelServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_autospec(WdqsSparqlQueryEngine, instance=True)
+        self.service = LabelService(self.engine)
+
+    def test_get_labels_query(self):
+        result = self.service.get_labels_query(["Q1", "Q2"], ["fr", "mul"])
+        expected = """
+SELECT ?item ?lang ?label WHERE {
+  VALUES ?item { wd:Q1 wd:Q2 }
+  ?item rdfs:label ?label .
+  BIND(LANG(?label) AS ?lang)
+  FILTER(?lang IN ('fr', 'mul'))
+}
+"""
+        self.assertEqual(result, expected)
+
+    def test_get_labels(self):
+        self.engine.select.return_value = [
+            make_label("Q1", "mul", "Un"),
+            make_label("Q1", "fr", "Premier"),
+            make_label("Q2", "mul", "Deux"),
+        ]
+        result = self.service.get_labels(["Q1", "Q2", "Q3"], lang="fr")
+        self.assertEqual(result, {"Q1": "Premier", "Q2": "Deux"})
+
+    def test_get_labels_ignores_non_entities(self):
+        self.assertEqual(self.service.get_labels(["1990", "UNKNOWN_VALUE"]), {})
+        self.engine.select.assert_not_called()
+
+    def test_get_labels_batched(self):
+        self.service.BATCH_SIZE = 2
+        self.engine.select.return_value = []
+        self.service.get_labels(["Q1", "Q2", "Q3"])
+        self.assertEqual(self.engine.select.call_count, 2)
+
+    def test_get_labels_cached(self):
+        self.service.cache = RedisCache(fakeredis.FakeStrictRedis())
+        self.engine.select.return_value = [make_label("Q1", "en", "One")]
+        self.service.get_labels(["Q1", "Q2"])
+        self.assertEqual(self.service.get_labels(["Q1", "Q2"]), {"Q1": "One"})
+        self.assertEqual(self.service.get_label("Q1"), "One")
+        self.engine.select.assert_called_once()
+
+    def test_labels_skip_local_tier(self):
+        client = fakeredis.FakeStrictRedis()
+        pubsub = client.pubsub()
+        pubsub.subscribe(INVALIDATION_CHANNEL)
+        pubsub.get_message(timeout=1)
+        service = LabelService(self.engine, cache=TieredCache(client))
+        self.engine.select.return_value = [make_label("Q1", "en", "One")]
+        self.assertEqual(service.get_labels(["Q1"]), {"Q1": "One"})
+        # No invalidation is broadcast for the labels
+        self.assertIsNone(pubsub.get_message(timeout=0.1))
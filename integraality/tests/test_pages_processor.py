@@ -3,11 +3,23 @@
 
 import argparse
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, call, create_autospec, patch
 
 import fakeredis
+import pywikibot
 
-from ..pages_processor import PagesProcessor, main
+from ..db import DashboardRegistry
+from ..pages_processor import (
+    BROKEN_RETRY_INTERVAL,
+    BROKEN_STATUSES,
+    RUNNABLE_STATUSES,
+    NoEndTemplateException,
+    PagesProcessor,
+    TransientServerException,
+    extract_dashboard_params,
+    main,
+)
+from ..sparql_utils import QueryException, WdqsSparqlQueryEngine
 
 
 class ProcessortTest(unittest.TestCase):
@@ -16,6 +28,386 @@ class ProcessortTest(unittest.TestCase):
         self.processor = PagesProcessor(cache_client=fake_cache_client)
 
 
+class TestCachedQueries(ProcessortTest):
+    def setUp(self):
+        super().setUp()
+        self.templates = {
+            "P17|*": {
+                "column": "P17",
+                "column_html_snippet": "P17",
+                "column_type_name": "property",
+                "positive_query": "SELECT ?entity { ?entity wdt:P17 wd:__INTEGRAALITY_GROUPING__ }",
+                "negative_query": "SELECT ?entity {}",
+                "formatted_predicate": "P17",
+            }
+        }
+
+    def test_get_cached_queries_for_column(self):
+        self.processor.cache.set_cache_mapping(
+            self.processor.make_queries_cache_key("Foo"),
+            dict(self.templates, **{"label|en|Q142": "France"}),
+        )
+        result, label = self.processor.get_cached_queries_for_column(
+            "Foo", "P17", "Q142"
+        )
+        self.assertEqual(
+            result["positive_query"], "SELECT ?entity { ?entity wdt:P17 wd:Q142 }"
+        )
+        self.assertEqual(result["column_type_name"], "property")
+        self.assertEqual(label, "France")
+        _, label = self.processor.get_cached_queries_for_column(
+            "Foo", "P17", "Q142", lang="fr"
+        )
+        self.assertIsNone(label)
+
+    def test_get_cached_queries_for_column_miss(self):
+        self.processor.cache.set_cache_mapping(
+            self.processor.make_queries_cache_key("Foo"), self.templates
+        )
+        self.assertEqual(
+            self.processor.get_cached_queries_for_column("Foo", "P131", "Q142"),
+            (None, None),
+        )
+        self.assertEqual(
+            self.processor.get_cached_queries_for_column("Bar", "P17", "Q142"),
+            (None, None),
+        )
+
+
+class TestCachedConfig(ProcessortTest):
+    @patch("integraality.grouping.GroupingConfiguration._resolve_type")
+    def test_make_stats_object_for_page_title_from_cache(self, mock_resolve_type):
+        self.processor.cache.set_cache_value(
+            self.processor.make_cache_key("Foo"),
+            {
+                "selector_sparql": "wdt:P31 wd:Q5",
+                "grouping_property": "P17",
+                "properties": "P21,P569:birth",
+                "grouping_link_mode": "create",
+            },
+        )
+        stats = self.processor.make_stats_object_for_page_title("Foo")
+        self.assertEqual(stats.selector_sparql, "wdt:P31 wd:Q5")
+        self.assertEqual(list(stats.columns.keys()), ["P21", "P569"])
+        # The cached parameters are left untouched
+        stats = self.processor.make_stats_object_for_page_title("Foo")
+        self.assertEqual(list(stats.columns.keys()), ["P21", "P569"])
+
+    @patch("integraality.pages_processor.pywikibot.Page")
+    def test_make_stats_object_for_page_title_server_error(self, mock_page):
+        mock_page.return_value.templatesWithParams.side_effect = (
+            pywikibot.exceptions.ServerError("503 Service Unavailable")
+        )
+        with self.assertRaises(TransientServerException):
+            self.processor.make_stats_object_for_page_title("Foo")
+
+
+class TestWarmCache(ProcessortTest):
+    def setUp(self):
+        super().setUp()
+        self.text = """
+{{Property dashboard
+|selector_sparql=wdt:P31 wd:Q5
+|grouping_property=P17
+|properties=P21:gender{{!}}sex,P569
+}}
+{{Property dashboard end}}
+"""
+
+    def test_extract_dashboard_params(self):
+        params, error = extract_dashboard_params(
+            self.text, "Property dashboard", "Property dashboard end"
+        )
+        self.assertIsNone(error)
+        self.assertEqual(
+            self.processor.config_assembler.parse_config_from_params(params),
+            {
+                "selector_sparql": "wdt:P31 wd:Q5",
+                "grouping_property": "P17",
+                "properties": "P21:gender|sex,P569",
+            },
+        )
+
+    def test_extract_dashboard_params_normalizes_names(self):
+        text = "{{template:property_dashboard|properties=P1}}{{Property dashboard end}}"
+        params, error = extract_dashboard_params(
+            text, "Property dashboard", "Property dashboard end"
+        )
+        self.assertEqual(params, ["properties=P1"])
+
+    def test_extract_dashboard_params_missing_templates(self):
+        params, error = extract_dashboard_params(
+            "{{Property dashboard}}", "Property dashboard", "Property dashboard end"
+        )
+        self.assertIsNone(params)
+        self.assertIn("No end template", error)
+        params, error = extract_dashboard_params(
+            "Foo", "Property dashboard", "Property dashboard end"
+        )
+        self.assertIn("No start template", error)
+
+    @patch("integraality.pages_processor.pagegenerators.PreloadingGenerator")
+    def test_warm_cache(self, mock_preloading_generator):
+        pages = [Mock(text=self.text), Mock(text="Foo"), Mock(text=self.text)]
+        for i, page in enumerate(pages):
+            page.title.return_value = f"Dashboard {i}"
+        mock_preloading_generator.return_value = iter(pages)
+        self.processor._site = Mock()
+
+        with (
+            patch.object(self.processor, "get_all_pages"),
+            patch.object(
+                self.processor.cache,
+                "set_cache_values",
+                wraps=self.processor.cache.set_cache_values,
+            ) as mock_set_cache_values,
+        ):
+            self.processor.warm_cache(batch_size=2, processes=1)
+
+        self.assertEqual(mock_preloading_generator.call_args.kwargs["groupsize"], 2)
+        self.assertEqual(mock_set_cache_values.call_count, 2)
+        self.assertEqual(
+            self.processor.cache.get_cache_value(
+                self.processor.make_cache_key("Dashboard 2")
+            )["grouping_property"],
+            "P17",
+        )
+        self.assertIsNone(
+            self.processor.cache.get_cache_value(
+                self.processor.make_cache_key("Dashboard 1")
+            )
+        )
+
+
+class TestProcessAll(ProcessortTest):
+    def setUp(self):
+        super().setUp()
+        self.registry = create_autospec(DashboardRegistry, instance=True)
+        self.registry.needs_reconciliation.return_value = False
+        self.registry.get_page_titles.side_effect = [["Foo", "Bar"], ["Baz"]]
+        self.processor._site = Mock()
+        patcher = patch("integraality.pages_processor.pywikibot.Page")
+        self.mock_page = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_page.side_effect = lambda site, title: Mock(
+            **{"title.return_value": title}
+        )
+
+    def test_process_all(self):
+        self.processor.cache.set_cache_value(
+            self.processor.make_cache_key("Foo"), {"properties": "P17"}
+        )
+        with patch.object(
+            self.processor,
+            "process_page",
+            side_effect=[
+                12.5,
+                NoEndTemplateException("No end"),
+                QueryException("Boom", "SELECT"),
+            ],
+        ):
+            self.processor.process_all(registry=self.registry)
+
+        self.registry.reconcile.assert_not_called()
+        self.registry.get_page_titles.assert_has_calls(
+            [
+                call(statuses=RUNNABLE_STATUSES),
+                call(statuses=BROKEN_STATUSES, not_run_for=BROKEN_RETRY_INTERVAL),
+            ]
+        )
+        self.registry.record_run.assert_has_calls(
+            [
+                call(
+                    "Foo",
+                    "ok",
+                    duration=12.5,
+                    config_hash="d40e6be6d555c65554230ccc7901703d27db6ca1",
+                    error=None,
+                ),
+                call(
+                    "Bar",
+                    "no_template",
+                    duration=None,
+                    config_hash=None,
+                    error="No end",
+                ),
+                call(
+                    "Baz", "query_error", duration=None, config_hash=None, error="Boom"
+                ),
+            ]
+        )
+
+    def test_process_all_retries_partial_pages(self):
+        self.registry.get_page_titles.side_effect = [["Foo", "Bar"], []]
+
+        def process_page(page, shared_results=None, time_budget=None, **kwargs):
+            self.assertEqual(time_budget, PagesProcessor.PAGE_TIME_BUDGET)
+            self.assertTrue(kwargs["defer_partial"])
+            if page.title() == "Foo":
+                self.processor.deferred_updates["Foo"] = Mock()
+                return None
+            return 1.5
+
+        def retry_page(page, time_budget):
+            self.assertEqual(time_budget, PagesProcessor.RETRY_TIME_BUDGET)
+            del self.processor.deferred_updates[page.title()]
+            self.processor.not_computed_columns[page.title()] = ["P131"]
+            return 2.5
+
+        with (
+            patch.object(self.processor, "process_page", side_effect=process_page),
+            patch.object(
+                self.processor, "retry_page", side_effect=retry_page
+            ) as mock_retry_page,
+        ):
+            self.processor.process_all(registry=self.registry)
+
+        mock_retry_page.assert_called_once()
+        # Foo is only recorded once retried
+        self.assertEqual(
+            self.registry.record_run.call_args_list,
+            [
+                call("Bar", "ok", duration=1.5, config_hash=None, error=None),
+                call(
+                    "Foo",
+                    "partial",
+                    duration=2.5,
+                    config_hash=None,
+                    error="Columns not computed: P131",
+                ),
+            ],
+        )
+
+    def test_process_all_reconciles(self):
+        self.registry.needs_reconciliation.return_value = True
+        self.registry.reconcile.return_value = (2, 0)
+        self.registry.get_page_titles.side_effect = [[], []]
+        with patch.object(
+            self.processor, "get_all_pages", return_value=[Mock(), Mock()]
+        ) as mock_get_all_pages:
+            mock_get_all_pages.return_value[0].title.return_value = "Foo"
+            mock_get_all_pages.return_value[1].title.return_value = "Bar"
+            self.processor.process_all(registry=self.registry)
+        self.assertEqual(
+            list(self.registry.reconcile.call_args.args[0]), ["Foo", "Bar"]
+        )
+
+
+class TestProcessPage(ProcessortTest):
+    def setUp(self):
+        super().setUp()
+        self.page = Mock(**{"title.return_value": "Foo"})
+        self.stats = Mock(columns={"P17": Mock(), "P131": Mock()})
+        self.stats.get_drilldown_query_templates.return_value = {}
+        self.stats.get_grouping_label_fields.return_value = {"label|en|Q142": "France"}
+        self.stats.get_sparql_engine_name.return_value = "QLever"
+        patcher = patch.object(
+            self.processor,
+            "make_stats_object_for_page",
+            return_value=(self.stats, None),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("integraality.pages_processor.save_to_wiki_or_local")
+        self.mock_save = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_process_page_deferred(self):
+        self.stats.not_computed_columns = ["P131"]
+        self.stats.retrieve_data.return_value = {}
+        self.stats.process_data.return_value = "output"
+        self.assertIsNone(
+            self.processor.process_page(self.page, time_budget=900, defer_partial=True)
+        )
+        self.mock_save.assert_not_called()
+
+        self.stats.retry_not_computed_columns.side_effect = lambda time_budget: (
+            self.stats.not_computed_columns.clear() or ({}, "retried output")
+        )
+        self.page.get.return_value = (
+            "{{Property dashboard}}\n{{Property dashboard end}}"
+        )
+        self.processor.retry_page(self.page, 3600)
+        self.stats.retry_not_computed_columns.assert_called_once_with(3600)
+        self.mock_save.assert_called_once()
+        self.assertIn("retried output", self.mock_save.call_args.args[2])
+        self.assertEqual(
+            self.processor.cache.get_cache_mapping_value(
+                self.processor.make_queries_cache_key("Foo"), "label|en|Q142"
+            ),
+            "France",
+        )
+        self.assertEqual(self.processor.deferred_updates, {})
+
+    def test_process_page_invalidates_cached_queries(self):
+        queries_key = self.processor.make_queries_cache_key("Foo")
+        self.processor.cache.set_cache_mapping(queries_key, {"P17|*": {}})
+        self.stats.not_computed_columns = ["P17", "P131"]
+        with self.assertRaises(QueryException):
+            self.processor.process_page(self.page, time_budget=900)
+        self.assertIsNone(
+            self.processor.cache.get_cache_mapping_value(queries_key, "P17|*")
+        )
+
+    def test_process_page_no_column_computed(self):
+        self.stats.not_computed_columns = ["P17", "P131"]
+        with self.assertRaises(QueryException):
+            self.processor.process_page(self.page, time_budget=900)
+        self.mock_save.assert_not_called()
+
+
+class TestPlanCycle(ProcessortTest):
+    def setUp(self):
+        super().setUp()
+        for page_title in ("Foo", "Bar"):
+            self.processor.cache.set_cache_value(
+                self.processor.make_cache_key(page_title),
+                {
+                    "selector_sparql": "wdt:P31 wd:Q5",
+                    "grouping_property": "P17",
+                    "properties": "P21",
+                },
+            )
+        self.engine = create_autospec(WdqsSparqlQueryEngine, instance=True)
+        self.engine.name = "Wikidata Query Service"
+        self.engine.select.return_value = [{"datatype": ""}]
+        patcher = patch(
+            "integraality.config_assembler.SparqlEngineBuilder.make",
+            return_value=self.engine,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_plan_cycle(self):
+        shared_results = self.processor.plan_cycle(["Foo", "Bar", "Baz"])
+        # The grouping type is only detected once
+        self.engine.select.assert_called_once()
+        # Grouping type, grouping information, totals and column queries
+        self.assertEqual(shared_results.get_shared_count(), 5)
+        self.assertEqual(shared_results.planned_count, 10)
+
+    def test_plan_cycle_skips_broken_configs(self):
+        self.processor.cache.set_cache_value(
+            self.processor.make_cache_key("Bar"), {"properties": "P21"}
+        )
+        shared_results = self.processor.plan_cycle(["Foo", "Bar"])
+        self.assertEqual(shared_results.get_shared_count(), 0)
+        self.assertEqual(shared_results.planned_count, 5)
+
+    def test_plan_cycle_uses_lowest_property_threshold(self):
+        self.processor.cache.set_cache_value(
+            self.processor.make_cache_key("Bar"),
+            {
+                "selector_sparql": "wdt:P31 wd:Q5",
+                "grouping_property": "P17",
+                "properties": "P21",
+                "property_threshold": "5",
+            },
+        )
+        shared_results = self.processor.plan_cycle(["Foo", "Bar"])
+        self.assertEqual(shared_results.get_shared_count(), 5)
+
+
 class TestReplaceInPage(ProcessortTest):
     def setUp(self):
         self.processor = PagesProcessor()
@@ -121,7 +513,7 @@ class TestMain(unittest.TestCase):
     def test_main_url_argument(self):
         url = "Foo"
         self.mock_args.return_value = argparse.Namespace(
-            url=url, warm_cache_only=False, page=None
+            url=url, warm_cache_only=False, reconcile_only=False, page=None
         )
         main()
         self.mock_pages_processor.assert_called_once_with(url)
@@ -130,10 +522,25 @@ class TestMain(unittest.TestCase):
     def test_main_page_argument(self):
         url = "Foo"
         self.mock_args.return_value = argparse.Namespace(
-            url=url, warm_cache_only=False, page="Bar/Dashboard"
+            url=url,
+            warm_cache_only=False,
+            reconcile_only=False,
+            page="Bar/Dashboard",
         )
         main()
         self.mock_pages_processor.assert_called_once_with(url)
         self.mock_pages_processor.return_value.process_one_page.assert_called_once_with(
             "Bar/Dashboard"
         )
+
+    def test_main_reconcile_only_argument(self):
+        url = "Foo"
+        self.mock_args.return_value = argparse.Namespace(
+            url=url, warm_cache_only=False, reconcile_only=True, page=None
+        )
+        main()
+        processor = self.mock_pages_processor.return_value
+        processor.reconcile_registry.assert_called_once_with(
+            processor.get_registry.return_value
+        )
+        processor.process_all.assert_not_called()
@@ -5,6 +5,14 @@ import unittest
 from collections import OrderedDict
 from unittest.mock import create_autospec, patch
 
+import fakeredis
+
+from ..cache import RedisCache
+from ..cancellation import (
+    CancelToken,
+    DeadlineExceededException,
+    UpdateCancelledException,
+)
 from ..column import (
     DescriptionColumn,
     LabelColumn,
@@ -14,7 +22,7 @@ from ..column import (
     SitelinkColumn,
 )
 from ..grouping import GroupingConfiguration, ItemGroupingType, YearGroupingType
-from ..grouping_link import LabelGroupingLink
+from ..grouping_link import LabelGroupingLink, PropertyGroupingLink
 from ..line import (
     ItemGrouping,
     NoGroupGrouping,
@@ -22,13 +30,15 @@ from ..line import (
     UnknownValueGrouping,
     YearGrouping,
 )
-from ..property_statistics import PropertyStatistics
+from ..property_statistics import InvalidDrilldownException, PropertyStatistics
+from ..query_sharing import SharedQueryResults
 from ..reference_check import (
     AllPropertiesReferenceCheck,
     AnyOfPropertiesReferenceCheck,
     GoodReferenceCheck,
     PropertyReferenceCheck,
 )
+from ..sampling import EntitySample
 from ..sparql_utils import QueryException, WdqsSparqlQueryEngine
 
 
@@ -47,6 +57,7 @@ class PropertyStatisticsTest(unittest.TestCase):
             predicate="wdt:P17", grouping_type=ItemGroupingType()
         )
         self.mock_sparql_query = create_autospec(WdqsSparqlQueryEngine, instance=True)
+        self.mock_sparql_query.entity_url = "http://www.wikidata.org/entity/"
         self.stats = PropertyStatistics(
             columns=self.columns,
             grouping_configuration=self.grouping_configuration,
@@ -666,6 +677,58 @@ SELECT ?entity ?entityLabel ?value ?valueLabel WHERE {
         self.assertEqual(result, expected)
 
 
+class DrilldownQueryTemplatesTest(PropertyStatisticsTest):
+    def assert_template_matches(self, templates, column_key, grouping):
+        field = PropertyStatistics.get_drilldown_template_field(column_key, grouping)
+        result = PropertyStatistics.render_drilldown_template(
+            templates[field], grouping
+        )
+        expected = PropertyStatistics.describe_queries(
+            self.stats.get_queries_for_column(column_key, grouping)
+        )
+        self.assertEqual(result, expected)
+
+    def test_item_groupings(self):
+        self.stats.row_no_group = True
+        groupings = OrderedDict(
+            [
+                ("Q142", ItemGrouping(title="Q142", count=10)),
+                ("Q5087901", ItemGrouping(title="Q5087901", count=6)),
+                ("UNKNOWN_VALUE", UnknownValueGrouping(count=2)),
+            ]
+        )
+        templates = self.stats.get_drilldown_query_templates(groupings)
+        # One entry per column for items, unknown value, no group and totals
+        self.assertEqual(len(templates), 4 * len(self.columns))
+        for column_key in self.stats.columns:
+            for grouping in ["Q142", "Q5087901", "UNKNOWN_VALUE", "None", ""]:
+                self.assert_template_matches(templates, column_key, grouping)
+
+    def test_year_groupings_with_time_span(self):
+        self.grouping_configuration = GroupingConfiguration(
+            predicate="wdt:P571", grouping_type=YearGroupingType()
+        )
+        self.stats = PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            sparql_query_engine=self.mock_sparql_query,
+        )
+        groupings = OrderedDict(
+            [
+                ("1990/10", YearGrouping(title="1990", count=10, time_span=10)),
+                ("2000/10", YearGrouping(title="2000", count=6, time_span=10)),
+            ]
+        )
+        templates = self.stats.get_drilldown_query_templates(groupings)
+        self.assertEqual(len(templates), 2 * len(self.columns))
+        self.assert_template_matches(templates, "P131", "1990/10")
+        self.assert_template_matches(templates, "Lbr", "2000/10")
+
+    def test_missing_grouping(self):
+        self.assertIsNone(PropertyStatistics.get_drilldown_template_field("P131", None))
+
+
 class GetQueryForItemsForPropertyPositiveUnresolvedType(PropertyStatisticsTest):
     """Test that queries work when grouping_type is not yet resolved."""
 
@@ -916,6 +979,143 @@ SELECT ?entity ?entityLabel ?value ?valueLabel WHERE {
         self.assertEqual(result, expected)
 
 
+class PagedDrilldownTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.column = ReferenceColumn(property="P2923")
+        self.stats.columns["P2923/S*"] = self.column
+
+    def test_get_drilldown_entities_query(self):
+        result = self.stats.get_drilldown_entities_query(
+            self.column, "Q142", after="Q5", limit=101
+        )
+        query = """
+SELECT DISTINCT ?entity WHERE {
+  ?entity wdt:P31 wd:Q39715 .
+  ?entity wdt:P17 wd:Q142 .
+  BIND(wd:Q142 AS ?grouping) .
+  ?entity p:P2923 ?statement .
+  ?statement ps:P2923 ?value .
+  FILTER NOT EXISTS {
+    ?entity p:P2923 ?_unreferenced_stmt .
+    FILTER NOT EXISTS {
+      ?_unreferenced_stmt prov:wasDerivedFrom []
+    }
+  }
+  FILTER(STR(?entity) > "http://www.wikidata.org/entity/Q5")
+}
+ORDER BY ?entity
+LIMIT 101
+"""
+        self.assertEqual(result, query)
+
+    def test_get_drilldown_details_query(self):
+        result = self.stats.get_drilldown_details_query(
+            self.column, "Q142", ["Q1", "Q2"]
+        )
+        self.assertIn(
+            "  SELECT DISTINCT ?entity ?value ?refProperty ?refValue WHERE {\n"
+            "    VALUES ?entity { <http://www.wikidata.org/entity/Q1>"
+            " <http://www.wikidata.org/entity/Q2> }\n"
+            "    ?entity wdt:P31 wd:Q39715 .\n",
+            result,
+        )
+        self.assertIn("BIND(COALESCE(?entitylabelEN, ?entitylabelMUL)", result)
+
+    def test_get_drilldown_page(self):
+        self.mock_sparql_query.select.side_effect = [
+            [
+                {"entity": "http://www.wikidata.org/entity/Q1"},
+                {"entity": "http://www.wikidata.org/entity/Q2"},
+                {"entity": "http://www.wikidata.org/entity/Q3"},
+            ],
+            [
+                {"entity": "http://www.wikidata.org/entity/Q2", "entityLabel": "B"},
+                {"entity": "http://www.wikidata.org/entity/Q1", "entityLabel": "A"},
+            ],
+        ]
+        result = self.stats.get_drilldown_page("P2923/S*", "Q142", page_size=2)
+        self.assertEqual(result["entities"], ["Q1", "Q2"])
+        self.assertEqual(result["next"], "Q2")
+        self.assertEqual([row["entityLabel"] for row in result["rows"]], ["A", "B"])
+        self.assertEqual(result["variables"][:2], ["entity", "entityLabel"])
+        self.assertIn(
+            "LIMIT 3\n", self.mock_sparql_query.select.call_args_list[0].args[0]
+        )
+        self.assertIn(
+            "VALUES ?entity { <http://www.wikidata.org/entity/Q1>"
+            " <http://www.wikidata.org/entity/Q2> }",
+            self.mock_sparql_query.select.call_args_list[1].args[0],
+        )
+
+    def test_get_drilldown_page_cached(self):
+        self.mock_sparql_query.name = "Wikidata Query Service"
+        self.mock_sparql_query.select.side_effect = [
+            [{"entity": "http://www.wikidata.org/entity/Q1"}],
+            [{"entity": "http://www.wikidata.org/entity/Q1", "entityLabel": "A"}],
+        ]
+        self.stats.cache = RedisCache(fakeredis.FakeStrictRedis())
+        first = self.stats.get_drilldown_page("P2923/S*", "Q142")
+        second = self.stats.get_drilldown_page("P2923/S*", "Q142")
+        self.assertEqual(first, second)
+        self.assertEqual(self.mock_sparql_query.select.call_count, 2)
+        (key,) = self.stats.cache.client.keys("integraality:v1:drilldown:*")
+        self.assertLessEqual(
+            self.stats.cache.client.ttl(key), self.stats.DRILLDOWN_CACHE_TTL
+        )
+
+    def test_get_drilldown_page_last(self):
+        self.mock_sparql_query.select.side_effect = [[]]
+        result = self.stats.get_drilldown_page(
+            "P2923/S*", "Q142", positive=False, after="Q3"
+        )
+        self.assertEqual(result["rows"], [])
+        self.assertIsNone(result["next"])
+        self.mock_sparql_query.select.assert_called_once()
+
+    def test_get_drilldown_page_commons(self):
+        self.mock_sparql_query.entity_url = "https://commons.wikimedia.org/entity/"
+        self.mock_sparql_query.select.side_effect = [
+            [
+                {"entity": "https://commons.wikimedia.org/entity/M3"},
+                {"entity": "https://commons.wikimedia.org/entity/M4"},
+            ],
+            [{"entity": "https://commons.wikimedia.org/entity/M3"}],
+        ]
+        result = self.stats.get_drilldown_page(
+            "P2923/S*", "Q142", after="M2", page_size=1
+        )
+        self.assertEqual(result["entities"], ["M3"])
+        self.assertEqual(result["next"], "M3")
+        (entities_query, details_query) = [
+            call.args[0] for call in self.mock_sparql_query.select.call_args_list
+        ]
+        self.assertIn(
+            'FILTER(STR(?entity) > "https://commons.wikimedia.org/entity/M2")',
+            entities_query,
+        )
+        self.assertIn(
+            "VALUES ?entity { <https://commons.wikimedia.org/entity/M3> }",
+            details_query,
+        )
+
+    def test_get_drilldown_page_special_grouping(self):
+        self.mock_sparql_query.select.side_effect = [[]]
+        self.stats.get_drilldown_page("P2923/S*", UnknownValueGrouping.MARKER)
+        self.mock_sparql_query.select.assert_called_once()
+
+    def test_get_drilldown_page_invalid_arguments(self):
+        for column_key, grouping, after in [
+            ("P1", "Q142", None),
+            ("P2923/S*", "Q142 . ?s ?p ?o", None),
+            ("P2923/S*", "Q142\n", None),
+            ("P2923/S*", "Q142", 'Q5") } SELECT * { ?s ?p ?o'),
+        ]:
+            with self.assertRaises(InvalidDrilldownException):
+                self.stats.get_drilldown_page(column_key, grouping, after=after)
+        self.mock_sparql_query.select.assert_not_called()
+
+
 class TestReferenceColumnSpecificProperty(PropertyStatisticsTest):
     def setUp(self):
         super().setUp()
@@ -2302,7 +2502,7 @@ LIMIT 1000
         }
         self.stats.grouping_configuration.higher_grouping = "wdt:P17/wdt:P298"
         query = """
-SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?count WHERE {
+SELECT ?grouping ?count WHERE {
   {
     SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
       ?entity wdt:P31 wd:Q39715 .
@@ -2311,14 +2511,21 @@ SELECT ?grouping (SAMPLE(?_higher_grouping) as ?higher_grouping) ?count WHERE {
     GROUP BY ?grouping
     HAVING (?count >= 20)
   }
-  OPTIONAL { ?grouping wdt:P17/wdt:P298 ?_higher_grouping }.
 }
-GROUP BY ?grouping ?count
 ORDER BY DESC(?count)
 LIMIT 1000
+"""
+        decorations_query = """
+SELECT ?grouping ?higher_grouping WHERE {
+  VALUES ?grouping { wd:Q142 wd:Q5087901 wd:Q623333 }
+  OPTIONAL { ?grouping wdt:P17/wdt:P298 ?higher_grouping }.
+}
 """
         result = self.stats.get_grouping_information()
-        self.assert_query_called(query)
+        self.assertEqual(
+            [c.args[0] for c in self.mock_sparql_query.select.call_args_list],
+            [query, decorations_query],
+        )
         self.assertEqual(result, expected)
 
     def test_get_grouping_information_empty_result(self):
@@ -2498,30 +2705,34 @@ LIMIT 1000
         self.assertEqual(result, expected)
 
     def test_get_grouping_information_with_grouping_link(self):
-        self.mock_sparql_query.select.return_value = [
-            {
-                "grouping": "http://www.wikidata.org/entity/Q142",
-                "grouping_link_value": "A",
-                "count": "10",
-            },
-            {
-                "grouping": "http://www.wikidata.org/entity/Q5087901",
-                "grouping_link_value": "B",
-                "count": "6",
-            },
-            {
-                "grouping": "http://www.wikidata.org/entity/Q623333",
-                "grouping_link_value": "C",
-                "count": "6",
-            },
+        self.mock_sparql_query.select.side_effect = [
+            [
+                {"grouping": "http://www.wikidata.org/entity/Q142", "count": "10"},
+                {"grouping": "http://www.wikidata.org/entity/Q5087901", "count": "6"},
+                {"grouping": "http://www.wikidata.org/entity/Q623333", "count": "6"},
+            ],
+            [
+                {
+                    "item": "http://www.wikidata.org/entity/Q142",
+                    "lang": "en",
+                    "label": "A",
+                },
+                {
+                    "item": "http://www.wikidata.org/entity/Q5087901",
+                    "lang": "mul",
+                    "label": "B",
+                },
+            ],
         ]
         expected = {
             "Q142": ItemGrouping(title="Q142", grouping_link="Foo/A", count=10),
             "Q5087901": ItemGrouping(title="Q5087901", grouping_link="Foo/B", count=6),
-            "Q623333": ItemGrouping(title="Q623333", grouping_link="Foo/C", count=6),
+            "Q623333": ItemGrouping(
+                title="Q623333", grouping_link="Foo/Q623333", count=6
+            ),
         }
         query = """
-SELECT ?grouping ?grouping_link_value ?count WHERE {
+SELECT ?grouping ?count WHERE {
   {
     SELECT ?grouping (COUNT(DISTINCT ?entity) as ?count) WHERE {
       ?entity wdt:P31 wd:Q39715 .
@@ -2530,15 +2741,6 @@ SELECT ?grouping ?grouping_link_value ?count WHERE {
     GROUP BY ?grouping
     HAVING (?count >= 20)
   }
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelMUL.
-    FILTER(lang(?groupinglabelMUL)='mul')
-  }}.
-  OPTIONAL {{
-    ?grouping rdfs:label ?groupinglabelEN.
-    FILTER(lang(?groupinglabelEN)='en')
-  }}.
-  BIND(COALESCE(?groupinglabelEN, ?groupinglabelMUL) AS ?grouping_link_value).
 }
 ORDER BY DESC(?count)
 LIMIT 1000
@@ -2547,9 +2749,51 @@ LIMIT 1000
             template="Foo/{Len}"
         )
         result = self.stats.get_grouping_information()
-        self.assert_query_called(query)
+        self.assertEqual(self.mock_sparql_query.select.call_count, 2)
+        self.assertEqual(self.mock_sparql_query.select.call_args_list[0].args[0], query)
+        self.assertIn(
+            "VALUES ?item { wd:Q142 wd:Q5087901 wd:Q623333 }",
+            self.mock_sparql_query.select.call_args_list[1].args[0],
+        )
         self.assertEqual(result, expected)
 
+    def test_get_grouping_information_decorations_cached(self):
+        self.mock_sparql_query.name = "Wikidata Query Service"
+        counts = [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "10"}]
+        self.mock_sparql_query.select.side_effect = [
+            counts,
+            [
+                {
+                    "item": "http://www.wikidata.org/entity/Q142",
+                    "lang": "en",
+                    "label": "A",
+                }
+            ],
+            counts,
+        ]
+        self.stats.grouping_configuration.grouping_link_type = LabelGroupingLink(
+            template="Foo/{Len}"
+        )
+        self.stats.cache = RedisCache(fakeredis.FakeStrictRedis())
+        self.stats.get_grouping_information()
+        result = self.stats.get_grouping_information()
+        # The second time, the labels come from the cache
+        self.assertEqual(self.mock_sparql_query.select.call_count, 3)
+        self.assertEqual(result["Q142"].grouping_link, "Foo/A")
+
+    def test_get_grouping_information_decorations_batched(self):
+        self.mock_sparql_query.select.return_value = [
+            {"grouping": f"http://www.wikidata.org/entity/Q{i}", "count": "30"}
+            for i in range(1, 6)
+        ]
+        self.stats.grouping_configuration.DECORATIONS_BATCH_SIZE = 2
+        self.stats.grouping_configuration.grouping_link_type = PropertyGroupingLink(
+            template="Foo/{P297}", property="P297"
+        )
+        result = self.stats.get_grouping_information()
+        self.assertEqual(self.mock_sparql_query.select.call_count, 4)
+        self.assertEqual(result["Q5"].grouping_link, "Foo/Q5")
+
 
 class MakeTotalsTest(PropertyStatisticsTest):
     def setUp(self):
@@ -2627,6 +2871,117 @@ class MakeTotalsTest(PropertyStatisticsTest):
         self.assertEqual(result, expected)
 
 
+class MakeTotalsFromGroupingsTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.columns = [PropertyColumn(property="P1435"), LabelColumn(language="br")]
+        self.stats = PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            row_no_group=True,
+            sparql_query_engine=self.mock_sparql_query,
+        )
+        self.groupings = [
+            ItemGrouping(title="Q142", count=10, cells={"P1435": 4, "Lbr": 10}),
+            ItemGrouping(title="Q183", count=5, cells={"Lbr": 2}),
+            NoGroupGrouping(count=3, cells={"P1435": 1, "Lbr": 0}),
+        ]
+
+    def test_partition(self):
+        self.mock_sparql_query.select.return_value = [{"count": "1"}]
+        result = self.stats.make_totals_from_groupings(self.groupings, 18)
+        expected = TotalsGrouping(count=18, title="")
+        expected.cells = OrderedDict([("P1435", 5), ("Lbr", 12)])
+        self.assertEqual(result, expected)
+
+    def test_not_a_partition(self):
+        self.mock_sparql_query.select.return_value = [{"count": "0"}]
+        self.assertIsNone(self.stats.make_totals_from_groupings(self.groupings, 18))
+
+    def test_count_mismatch(self):
+        self.assertIsNone(self.stats.make_totals_from_groupings(self.groupings, 20))
+        self.mock_sparql_query.select.assert_not_called()
+
+    def test_property_threshold(self):
+        self.stats.property_threshold = 10
+        self.assertIsNone(self.stats.make_totals_from_groupings(self.groupings, 18))
+
+    def test_prepare_report_groupings(self):
+        self.stats.row_no_group = False
+        self.mock_sparql_query.select.side_effect = [
+            [{"count": "15"}],
+            [{"count": "1"}],
+        ]
+        groupings = OrderedDict(
+            (grouping.title, grouping) for grouping in self.groupings[:2]
+        )
+        result = self.stats.prepare_report_groupings(groupings)
+        self.assertEqual(self.mock_sparql_query.select.call_count, 2)
+        self.assertEqual(result[-1].count, 15)
+        self.assertEqual(result[-1].cells, {"P1435": 4, "Lbr": 12})
+
+    def test_prepare_report_groupings_fallback(self):
+        self.stats.row_no_group = False
+        self.mock_sparql_query.select.side_effect = [
+            [{"count": "20"}],
+            [{"count": "7"}],
+            [{"count": "14"}],
+        ]
+        groupings = OrderedDict(
+            (grouping.title, grouping) for grouping in self.groupings[:2]
+        )
+        result = self.stats.prepare_report_groupings(groupings)
+        self.assertEqual(result[-1].count, 20)
+        self.assertEqual(result[-1].cells, {"P1435": 7, "Lbr": 14})
+
+
+class MakeStatsForNoGroupAndTotalsTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.stats = PropertyStatistics(
+            columns=[PropertyColumn(property="P1435"), LabelColumn(language="br")],
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            row_no_group=True,
+            sparql_query_engine=self.mock_sparql_query,
+        )
+
+    def test_get_totals_and_no_grouping_query(self):
+        result = self.stats.get_totals_and_no_grouping_query()
+        expected = """
+SELECT (COUNT(*) AS ?count) (SUM(?no_grouping) AS ?no_grouping_count) WHERE {
+  ?entity wdt:P31 wd:Q39715 .
+  BIND(IF(EXISTS { ?entity wdt:P17 [] }, 0, 1) AS ?no_grouping)
+}
+"""
+        self.assertEqual(result, expected)
+
+    def test_make_stats_for_no_group_and_totals(self):
+        self.mock_sparql_query.select.side_effect = [
+            [{"count": "120", "no_grouping_count": "20"}],
+            [{"count": "30", "no_grouping_count": "2"}],
+            [{"count": "0"}],
+        ]
+        no_group, totals = self.stats.make_stats_for_no_group_and_totals()
+        self.assertEqual(self.mock_sparql_query.select.call_count, 3)
+        self.assertEqual(no_group.count, 20)
+        self.assertEqual(no_group.cells, {"P1435": 2, "Lbr": 0})
+        self.assertEqual(totals.count, 120)
+        self.assertEqual(totals.cells, {"P1435": 30, "Lbr": 0})
+
+    def test_prepare_report_groupings(self):
+        self.mock_sparql_query.select.side_effect = [
+            [{"count": "120", "no_grouping_count": "20"}],
+            [{"count": "30", "no_grouping_count": "2"}],
+            [{"count": "60", "no_grouping_count": "6"}],
+        ]
+        result = self.stats.prepare_report_groupings(OrderedDict())
+        self.assertEqual(
+            [type(grouping) for grouping in result], [NoGroupGrouping, TotalsGrouping]
+        )
+
+
 class PopulateGroupingsTest(PropertyStatisticsTest):
     def test_populate_groupings_empty(self):
         result = self.stats.populate_groupings(None)
@@ -2828,6 +3183,173 @@ class PopulateGroupingsTest(PropertyStatisticsTest):
         self.assertEqual(result, expected)
 
 
+class PushdownGroupingsTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.groupings = OrderedDict(
+            [
+                ("Q142", ItemGrouping(title="Q142", count=30)),
+                ("Q183", ItemGrouping(title="Q183", count=25)),
+            ]
+        )
+
+    def test_get_pushdown_groupings(self):
+        self.assertEqual(
+            self.stats.get_pushdown_groupings(self.groupings), ["Q142", "Q183"]
+        )
+
+    def test_no_pushdown_without_threshold(self):
+        self.grouping_configuration.grouping_threshold = 1
+        self.assertIsNone(self.stats.get_pushdown_groupings(self.groupings))
+
+    def test_no_pushdown_with_explicit_groupings(self):
+        self.grouping_configuration.explicit_groupings = ["Q142", "Q183"]
+        self.assertIsNone(self.stats.get_pushdown_groupings(self.groupings))
+
+    def test_no_pushdown_for_many_groupings(self):
+        self.stats.PUSHDOWN_MAX_GROUPINGS = 1
+        self.assertIsNone(self.stats.get_pushdown_groupings(self.groupings))
+
+    def test_no_pushdown_with_unknown_value(self):
+        self.groupings[UnknownValueGrouping.MARKER] = UnknownValueGrouping(4)
+        self.assertIsNone(self.stats.get_pushdown_groupings(self.groupings))
+
+    def test_populate_groupings_pushes_down(self):
+        self.mock_sparql_query.select.return_value = [
+            {"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"},
+        ]
+        self.stats.populate_groupings(self.groupings)
+        query = self.mock_sparql_query.select.call_args_list[0].args[0]
+        self.assertIn("  VALUES ?grouping { wd:Q142 wd:Q183 }\n", query)
+        self.assertEqual(self.groupings["Q142"].cells["P1435"], 12)
+
+    def test_shared_query_not_pushed_down(self):
+        self.mock_sparql_query.name = "Wikidata Query Service"
+        shared_results = SharedQueryResults()
+        stats = PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            sparql_query_engine=self.mock_sparql_query,
+            shared_results=shared_results,
+        )
+        column = self.columns[0]
+        shared_query = stats.get_column_info_query(column)
+        shared_results.plan(stats.sparql_query_engine, shared_query)
+        shared_results.plan(stats.sparql_query_engine, shared_query)
+        self.assertEqual(
+            stats.get_column_info_query(column, ["Q142", "Q183"]), shared_query
+        )
+        # The last planned use still gets the shared result
+        shared_results.select(self.mock_sparql_query, shared_query)
+        self.assertEqual(
+            stats.get_column_info_query(column, ["Q142", "Q183"]), shared_query
+        )
+        shared_results.select(self.mock_sparql_query, shared_query)
+        self.assertNotEqual(
+            stats.get_column_info_query(column, ["Q142", "Q183"]), shared_query
+        )
+
+
+class ReferenceScanTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.stats.columns = {
+            "P31/S*": ReferenceColumn(property="P31"),
+            "P1435": PropertyColumn(property="P1435"),
+            "P31/S248": ReferenceColumn(
+                property="P31", reference_check=PropertyReferenceCheck("P248")
+            ),
+        }
+        self.groupings = OrderedDict(
+            [
+                ("Q142", ItemGrouping(title="Q142", count=30)),
+                ("Q183", ItemGrouping(title="Q183", count=25)),
+            ]
+        )
+
+    def test_populate_groupings(self):
+        self.mock_sparql_query.select.side_effect = [
+            [
+                {
+                    "grouping": "http://www.wikidata.org/entity/Q142",
+                    "count_0": "20",
+                    "count_1": "4",
+                },
+                {
+                    "grouping": "http://www.wikidata.org/entity/Q183",
+                    "count_0": "12",
+                    "count_1": "11",
+                },
+            ],
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "30"}],
+        ]
+        self.stats.populate_groupings(self.groupings)
+        self.assertEqual(self.mock_sparql_query.select.call_count, 2)
+        self.assertIn(
+            "?count_1", self.mock_sparql_query.select.call_args_list[0].args[0]
+        )
+        self.assertEqual(self.groupings["Q142"].cells, {"P31/S*": 20, "P1435": 30})
+        self.assertEqual(self.groupings["Q183"].cells, {"P31/S*": 12, "P31/S248": 11})
+
+    def test_get_shared_queries(self):
+        self.stats.row_totals = False
+        queries = self.stats.get_shared_queries()
+        self.assertEqual(len(queries), 3)
+        self.assertIn(
+            self.stats.get_reference_scan_query(self.stats.get_reference_scans()[0]),
+            queries,
+        )
+
+
+class SampleTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.stats = PropertyStatistics(
+            columns=[PropertyColumn(property="P1435")],
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            property_threshold=10,
+            sparql_query_engine=self.mock_sparql_query,
+            sample=EntitySample(1 / 16),
+        )
+
+    def test_queries_are_sampled(self):
+        sample_filter = 'FILTER(SUBSTR(MD5(STR(?entity)), 1, 4) < "1000")'
+        for query in self.stats.get_shared_queries():
+            self.assertIn(sample_filter, query)
+
+    def test_thresholds_are_scaled(self):
+        self.mock_sparql_query.select.return_value = [
+            {"grouping": "http://www.wikidata.org/entity/Q142", "count": "3"},
+        ]
+        self.stats.get_grouping_information()
+        self.assertIn(
+            "HAVING (?count >= 1)",
+            self.mock_sparql_query.select.call_args_list[0].args[0],
+        )
+        # At least 10 items, hence 1 on a sixteenth of them
+        self.assertIn(
+            "HAVING (?count >= 1)",
+            self.stats.get_column_info_query(self.stats.columns["P1435"]),
+        )
+
+    def test_estimate_report_groupings(self):
+        report_groupings = [
+            ItemGrouping(title="Q142", count=3, cells=OrderedDict(P1435=1)),
+            ItemGrouping(title="Q183", count=1, cells=OrderedDict(P1435=1)),
+            TotalsGrouping(count=4, cells=OrderedDict(P1435=0)),
+        ]
+        result = self.stats.estimate_report_groupings(report_groupings)
+        self.assertEqual(
+            result,
+            [
+                ItemGrouping(title="Q142", count=48, cells=OrderedDict(P1435=16)),
+                TotalsGrouping(count=64, cells=OrderedDict(P1435=0)),
+            ],
+        )
+
+
 class RetrieveDataTest(PropertyStatisticsTest):
     def test_retrieve_data_empty(self):
         result = self.stats.retrieve_data()
@@ -2891,6 +3413,56 @@ class RetrieveDataTest(PropertyStatisticsTest):
         self.assertEqual(result, expected)
 
 
+class ResultCallbackTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.results = []
+        self.stats.result_callback = self.results.append
+
+    def test_retrieve_data(self):
+        self.stats.columns = {
+            "P1435": PropertyColumn(property="P1435", title="Heritage")
+        }
+        self.mock_sparql_query.select.return_value = [
+            {"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"},
+            {"grouping": "http://www.wikidata.org/entity/Q5087901", "count": "6"},
+        ]
+        self.stats.retrieve_data()
+        expected = [
+            {
+                "kind": "groupings",
+                "columns": [{"key": "P1435", "title": "Heritage"}],
+                "groupings": [
+                    {"key": "Q142", "count": 12, "cells": {}},
+                    {"key": "Q5087901", "count": 6, "cells": {}},
+                ],
+            },
+            {
+                "kind": "column",
+                "column": "P1435",
+                "cells": {"Q142": 12, "Q5087901": 6},
+            },
+        ]
+        self.assertEqual(self.results, expected)
+
+    def test_prepare_report_groupings(self):
+        self.stats.columns = {"P1435": PropertyColumn(property="P1435")}
+        self.mock_sparql_query.select.side_effect = [
+            [{"count": "20"}],
+            [{"count": "15"}],
+        ]
+        self.stats.prepare_report_groupings({})
+        expected = [
+            {
+                "kind": "summary",
+                "key": TotalsGrouping.MARKER,
+                "count": 20,
+                "cells": {"P1435": 15},
+            }
+        ]
+        self.assertEqual(self.results, expected)
+
+
 class ProcessDataTest(PropertyStatisticsTest):
     def test_process_data_empty(self):
         result = self.stats.process_data({})
@@ -3248,3 +3820,250 @@ class RetrieveAndProcessDataTest(PropertyStatisticsTest):
             "|}\n"
         )
         self.assertEqual(result, expected)
+
+
+class CancellationTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.cancel_token = CancelToken()
+        self.stats = PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            sparql_query_engine=self.mock_sparql_query,
+            cancel_token=self.cancel_token,
+        )
+
+    def test_queries_get_cancel_token(self):
+        self.mock_sparql_query.select.return_value = [{"count": "10"}]
+        self.assertEqual(self.stats.get_totals(), 10)
+        self.mock_sparql_query.select.assert_called_once()
+        self.assertIs(
+            self.mock_sparql_query.select.call_args.kwargs["cancel_token"],
+            self.cancel_token,
+        )
+
+    def test_no_query_once_cancelled(self):
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q31", "count": "10"}],
+        ]
+        self.cancel_token.cancel()
+        with self.assertRaises(UpdateCancelledException):
+            self.stats.retrieve_data()
+        self.mock_sparql_query.select.assert_not_called()
+
+
+class TimeBudgetTest(PropertyStatisticsTest):
+    def make_stats(self, time_budget, **kwargs):
+        return PropertyStatistics(
+            columns=[PropertyColumn(property="P1435"), PropertyColumn(property="P131")],
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            row_totals=False,
+            sparql_query_engine=self.mock_sparql_query,
+            time_budget=time_budget,
+            **kwargs,
+        )
+
+    def test_late_column_not_computed(self):
+        stats = self.make_stats(time_budget=3600)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+            DeadlineExceededException(),
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "5"}],
+        ]
+        groupings = stats.retrieve_data()
+        self.assertEqual(stats.not_computed_columns, ["P1435"])
+        self.assertEqual(groupings["Q142"].cells, OrderedDict([("P131", 5)]))
+        result = stats.process_data(groupings)
+        self.assertIn("| data-sort-value=\"-1\" | ''not computed''\n", result)
+        self.assertIn(
+            "| {{Integraality cell|41.67|5|column=P131|grouping=Q142}}", result
+        )
+
+    def test_retry_not_computed_columns(self):
+        stats = self.make_stats(time_budget=3600)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+            DeadlineExceededException(),
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "5"}],
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "7"}],
+        ]
+        stats.process_data(stats.retrieve_data())
+        groupings, result = stats.retry_not_computed_columns(3600)
+        # Only the column not computed is queried again
+        self.assertEqual(self.mock_sparql_query.select.call_count, 4)
+        self.assertEqual(stats.not_computed_columns, [])
+        self.assertEqual(
+            groupings["Q142"].cells, OrderedDict([("P131", 5), ("P1435", 7)])
+        )
+        self.assertNotIn("not computed", result)
+        self.assertIn(
+            "| {{Integraality cell|58.33|7|column=P1435|grouping=Q142}}", result
+        )
+
+    def test_retry_not_computed_summary(self):
+        stats = self.make_stats(time_budget=3600, row_no_group=True)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "7"}],
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "5"}],
+            [{"count": "4"}],
+            [{"count": "2"}],
+            DeadlineExceededException(),
+            [{"count": "1"}],
+        ]
+        stats.process_data(stats.retrieve_data())
+        self.assertEqual(stats.not_computed_columns, ["P131"])
+        groupings, result = stats.retry_not_computed_columns(3600)
+        # Only the no-group cell of the column is queried again
+        self.assertEqual(self.mock_sparql_query.select.call_count, 7)
+        self.assertEqual(stats.not_computed_columns, [])
+        self.assertEqual(
+            groupings["Q142"].cells, OrderedDict([("P1435", 7), ("P131", 5)])
+        )
+        self.assertNotIn("not computed", result)
+
+    def test_exhausted_budget(self):
+        stats = self.make_stats(time_budget=0)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+        ]
+        stats.retrieve_data()
+        self.assertEqual(stats.not_computed_columns, ["P1435", "P131"])
+        # Only the grouping query is sent
+        self.mock_sparql_query.select.assert_called_once()
+
+    def test_timed_out_column_not_computed(self):
+        stats = self.make_stats(time_budget=3600)
+
+        results = iter(
+            [
+                [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+                None,
+                [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "5"}],
+            ]
+        )
+
+        def select(query, cancel_token):
+            result = next(results)
+            if result is None:
+                # The endpoint is cut off at the deadline of the query
+                cancel_token._deadline = 0
+                raise QueryException("QLever timed out", query)
+            return result
+
+        self.mock_sparql_query.select.side_effect = select
+        groupings = stats.retrieve_data()
+        self.assertEqual(stats.not_computed_columns, ["P1435"])
+        self.assertEqual(groupings["Q142"].cells, OrderedDict([("P131", 5)]))
+
+    def test_failed_column_with_budget(self):
+        stats = self.make_stats(time_budget=3600)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+            QueryException("QLever is not available", "SELECT"),
+        ]
+        with self.assertRaises(QueryException):
+            stats.retrieve_data()
+
+    def test_failed_column_without_budget(self):
+        stats = self.make_stats(time_budget=None)
+        self.mock_sparql_query.select.side_effect = [
+            [{"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"}],
+            QueryException("Timeout", "SELECT"),
+        ]
+        with self.assertRaises(QueryException):
+            stats.retrieve_data()
+
+
+class SharedResultsTest(PropertyStatisticsTest):
+    def setUp(self):
+        super().setUp()
+        self.mock_sparql_query.name = "Wikidata Query Service"
+        self.shared_results = SharedQueryResults()
+
+    def make_stats(self, **kwargs):
+        return PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=self.grouping_configuration,
+            selector_sparql="wdt:P31 wd:Q39715",
+            sparql_query_engine=self.mock_sparql_query,
+            shared_results=self.shared_results,
+            **kwargs,
+        )
+
+    def test_get_shared_queries(self):
+        stats = self.make_stats(row_no_group=True)
+        queries = stats.get_shared_queries()
+        self.assertEqual(len(queries), 2 + 2 * len(self.columns))
+        self.assertEqual(
+            queries[:2],
+            [
+                self.grouping_configuration.get_grouping_information_query(
+                    "wdt:P31 wd:Q39715"
+                ),
+                self.columns[0].get_info_query(stats),
+            ],
+        )
+        self.assertIn(stats.get_totals_and_no_grouping_query(), queries)
+
+    def test_no_shared_queries_before_probing_years(self):
+        self.mock_sparql_query.select.return_value = [
+            {"datatype": "http://www.w3.org/2001/XMLSchema#dateTime"}
+        ]
+        stats = PropertyStatistics(
+            columns=self.columns,
+            grouping_configuration=GroupingConfiguration(predicate="wdt:P569"),
+            selector_sparql="wdt:P31 wd:Q5",
+            sparql_query_engine=self.mock_sparql_query,
+        )
+        # Only the grouping type is detected up front
+        self.mock_sparql_query.select.assert_called_once()
+        self.assertEqual(stats.get_shared_queries(), [])
+
+    def test_get_shared_queries_without_totals(self):
+        stats = self.make_stats(row_totals=False)
+        self.assertEqual(len(stats.get_shared_queries()), 1 + len(self.columns))
+
+    def test_column_queried_with_lowest_threshold(self):
+        first = self.make_stats(property_threshold=10)
+        second = self.make_stats(property_threshold=2)
+        for stats in (first, second):
+            stats.plan_property_thresholds(self.shared_results)
+        column = self.columns[0]
+        self.assertEqual(
+            first.get_column_info_query(column),
+            column.get_info_query(second),
+        )
+
+    def test_counts_below_threshold_filtered(self):
+        stats = self.make_stats(property_threshold=10)
+        self.make_stats(property_threshold=2).plan_property_thresholds(
+            self.shared_results
+        )
+        stats.plan_property_thresholds(self.shared_results)
+        self.mock_sparql_query.select.return_value = [
+            {"grouping": "http://www.wikidata.org/entity/Q142", "count": "12"},
+            {"grouping": "http://www.wikidata.org/entity/Q838261", "count": "4"},
+        ]
+        groupings = stats.populate_groupings(
+            {
+                "Q142": ItemGrouping(title="Q142", count=20),
+                "Q838261": ItemGrouping(title="Q838261", count=10),
+            }
+        )
+        self.assertEqual(groupings["Q142"].cells["P1435"], 12)
+        self.assertNotIn("P1435", groupings["Q838261"].cells)
+
+    def test_totals_shared_between_dashboards(self):
+        self.mock_sparql_query.select.return_value = [{"count": "10"}]
+        first = self.make_stats()
+        second = self.make_stats()
+        for stats in (first, second):
+            self.shared_results.plan(
+                stats.sparql_query_engine, stats.get_totals_query()
+            )
+        self.assertEqual(first.get_totals(), 10)
+        self.assertEqual(second.get_totals(), 10)
+        self.assert_query_called(first.get_totals_query())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8  -*-
+"""Unit tests for query_sharing.py."""
+
+import unittest
+from unittest.mock import create_autospec
+
+from ..query_sharing import SharedQueryResults, SharedSparqlQueryEngine, make_query_key
+from ..sparql_utils import QLeverSparqlQueryEngine, QueryException
+
+
+class MakeQueryKeyTest(unittest.TestCase):
+    def test_whitespace_is_normalised(self):
+        engine = QLeverSparqlQueryEngine()
+        self.assertEqual(
+            make_query_key(engine, "\nSELECT ?a WHERE {\n  ?a ?b ?c\n}\n"),
+            make_query_key(engine, "SELECT ?a WHERE { ?a ?b ?c }"),
+        )
+
+    def test_endpoints_are_distinguished(self):
+        query = "SELECT ?a WHERE { ?a ?b ?c }"
+        self.assertNotEqual(
+            make_query_key(QLeverSparqlQueryEngine(), query),
+            make_query_key(
+                QLeverSparqlQueryEngine("https://qlever.dev/api/wikimedia-commons"),
+                query,
+            ),
+        )
+
+
+class SharedQueryResultsTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_autospec(QLeverSparqlQueryEngine, instance=True)
+        self.engine.name = "QLever"
+        self.engine.endpoint = "https://qlever.dev/api/wikidata"
+        self.engine.select.side_effect = lambda query, **kwargs: [{"query": query}]
+        self.shared_results = SharedQueryResults()
+
+    def test_is_planned(self):
+        self.assertFalse(self.shared_results.is_planned(self.engine, "SELECT 1"))
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.assertTrue(self.shared_results.is_planned(self.engine, "SELECT 1"))
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.assertFalse(self.shared_results.is_planned(self.engine, "SELECT 1"))
+
+    def test_planned_query_sent_once(self):
+        for _ in range(3):
+            self.shared_results.plan(self.engine, "SELECT 1")
+        for _ in range(3):
+            self.assertEqual(
+                self.shared_results.select(self.engine, "SELECT  1"),
+                [{"query": "SELECT  1"}],
+            )
+        self.engine.select.assert_called_once_with("SELECT  1")
+        self.assertEqual(
+            self.shared_results.get_report(),
+            {"planned": 3, "executed": 1, "saved": 2},
+        )
+
+    def test_result_dropped_after_last_use(self):
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.assertEqual(self.engine.select.call_count, 2)
+        self.assertEqual(self.shared_results._results, {})
+
+    def test_unplanned_query_is_not_kept(self):
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.assertEqual(self.engine.select.call_count, 2)
+        self.assertEqual(self.shared_results.get_report()["executed"], 0)
+
+    def test_failed_query_is_retried(self):
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.engine.select.side_effect = [QueryException("Boom", "SELECT 1"), []]
+        with self.assertRaises(QueryException):
+            self.shared_results.select(self.engine, "SELECT 1")
+        self.assertEqual(self.shared_results.select(self.engine, "SELECT 1"), [])
+
+    def test_queries_run_while_planning_are_kept(self):
+        with self.shared_results.planning():
+            self.shared_results.select(self.engine, "SELECT 1")
+            self.shared_results.select(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.shared_results.select(self.engine, "SELECT 1")
+        self.engine.select.assert_called_once_with("SELECT 1")
+        self.assertEqual(
+            self.shared_results.get_report(),
+            {"planned": 2, "executed": 1, "saved": 2},
+        )
+
+    def test_shared_count(self):
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.shared_results.plan(self.engine, "SELECT 1")
+        self.shared_results.plan(self.engine, "SELECT 2")
+        self.assertEqual(self.shared_results.get_shared_count(), 1)
+
+
+class SharedSparqlQueryEngineTest(unittest.TestCase):
+    def test_select(self):
+        engine = create_autospec(QLeverSparqlQueryEngine, instance=True)
+        engine.name = "QLever"
+        engine.select.return_value = [{"count": "1"}]
+        shared_results = SharedQueryResults()
+        shared_results.plan(engine, "SELECT 1")
+        shared_results.plan(engine, "SELECT 1")
+        shared_engine = SharedSparqlQueryEngine(engine, shared_results)
+        shared_engine.select("SELECT 1", cancel_token=None)
+        shared_engine.select("SELECT 1", cancel_token=None)
+        engine.select.assert_called_once_with("SELECT 1", cancel_token=None)
+        self.assertEqual(shared_engine.name, "QLever")
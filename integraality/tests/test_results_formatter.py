@@ -15,6 +15,7 @@ from ..line import (
     YearGrouping,
 )
 from ..results_formatter import ResultsFormatter
+from ..sampling import EntitySample
 
 
 class ResultsFormatterTest(unittest.TestCase):
@@ -459,3 +460,59 @@ class TestFormatReport(ResultsFormatterTest):
             "|}\n"
         )
         self.assertEqual(result, expected)
+
+
+class TestFormatApproximate(ResultsFormatterTest):
+    def setUp(self):
+        super().setUp()
+        self.formatter.sample = EntitySample(1 / 16)
+
+    def test_format_header(self):
+        result = self.formatter._format_header()
+        self.assertTrue(
+            result.startswith(
+                '{| class="wikitable sortable"\n'
+                "|+ Approximate preview, estimated from a sample of 6.25% of the "
+                "items (± gives the 95% confidence interval)\n"
+            )
+        )
+
+    def test_format_grouping(self):
+        grouping = ItemGrouping(title="Q3115846", count=160)
+        grouping.cells = OrderedDict([("P21", 160), ("P19", 32)])
+        result = self.formatter._format_grouping(grouping)
+        expected = (
+            "|-\n"
+            "| {{Q|Q3115846}}\n"
+            "| ~160 ±96 \n"
+            "| {{Integraality cell|100.0|160|column=P21|grouping=Q3115846|margin=96}}\n"
+            "| {{Integraality cell|20.0|32|column=P19|grouping=Q3115846|margin=43}}\n"
+            "| {{Integraality cell|0|0|column=Lbr|grouping=Q3115846|margin=0}}\n"
+        )
+        self.assertEqual(result, expected)
+
+
+class TestFormatNotComputed(ResultsFormatterTest):
+    def setUp(self):
+        super().setUp()
+        self.formatter.not_computed_columns = ["P19"]
+
+    def test_format_grouping(self):
+        grouping = ItemGrouping(title="Q3115846", count=10)
+        grouping.cells = OrderedDict([("P21", 10), ("Lbr", 1)])
+        result = self.formatter._format_grouping(grouping)
+        expected = (
+            "|-\n"
+            "| {{Q|Q3115846}}\n"
+            "| 10 \n"
+            "| {{Integraality cell|100.0|10|column=P21|grouping=Q3115846}}\n"
+            "| data-sort-value=\"-1\" | ''not computed''\n"
+            "| {{Integraality cell|10.0|1|column=Lbr|grouping=Q3115846}}\n"
+        )
+        self.assertEqual(result, expected)
+
+    def test_format_totals(self):
+        grouping = TotalsGrouping(count=30)
+        grouping.cells = OrderedDict([("P21", 30), ("Lbr", 3)])
+        result = self.formatter._format_grouping(grouping)
+        self.assertIn("| data-sort-value=\"-1\" | ''not computed''\n", result)
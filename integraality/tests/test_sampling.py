@@ -0,0 +1,43 @@
+# -*- coding: utf-8  -*-
+"""Unit tests for sampling.py."""
+
+import unittest
+
+from ..sampling import EntitySample
+
+
+class EntitySampleTest(unittest.TestCase):
+    def setUp(self):
+        self.sample = EntitySample(1 / 16)
+
+    def test_rate(self):
+        self.assertEqual(self.sample.threshold, 4096)
+        self.assertEqual(self.sample.rate, 1 / 16)
+
+    def test_rate_is_capped(self):
+        self.assertEqual(EntitySample(1).threshold, 65535)
+        self.assertEqual(EntitySample(0).threshold, 1)
+
+    def test_get_filter(self):
+        self.assertEqual(
+            self.sample.get_filter(),
+            'FILTER(SUBSTR(MD5(STR(?entity)), 1, 4) < "1000")',
+        )
+
+    def test_apply_to_selector(self):
+        self.assertEqual(
+            self.sample.apply_to_selector("wdt:P31 wd:Q5 . "),
+            'wdt:P31 wd:Q5 . FILTER(SUBSTR(MD5(STR(?entity)), 1, 4) < "1000")',
+        )
+
+    def test_get_sample_threshold(self):
+        self.assertEqual(self.sample.get_sample_threshold(20), 1)
+        self.assertEqual(self.sample.get_sample_threshold("100"), 6)
+        self.assertEqual(self.sample.get_sample_threshold(0), 0)
+
+    def test_estimate(self):
+        self.assertEqual(self.sample.estimate(10), 160)
+
+    def test_get_margin(self):
+        self.assertEqual(self.sample.get_margin(160), 96)
+        self.assertEqual(self.sample.get_margin(0), 0)
@@ -7,7 +7,14 @@ from unittest.mock import Mock, patch
 import pywikibot
 import requests
 
+from ..cancellation import (
+    CancelToken,
+    DeadlineExceededException,
+    TimeBudget,
+    UpdateCancelledException,
+)
 from ..sparql_utils import (
+    CancellableSparqlQueryEngine,
     QLeverSparqlQueryEngine,
     QueryException,
     SparqlEngineBuilder,
@@ -52,6 +59,33 @@ class WdqsSparqlQueryEngineTest(unittest.TestCase):
         )
         self.assertEqual(cm.exception.query, "SELECT * WHERE { ?s ?p ?o }")
 
+    @patch("requests.get")
+    def test_select_with_deadline(self, mock_get):
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.iter_content.return_value = [
+            b'{"head": {"vars": ["entity", "value"]}, "results": {"bindings": [',
+            b'{"entity": {"value": "http://www.wikidata.org/entity/Q1"}}]}}',
+        ]
+        budget = TimeBudget(20)
+
+        engine = WdqsSparqlQueryEngine()
+        with budget.query_deadline(2):
+            result = engine.select("SELECT ?entity ?value", cancel_token=budget)
+
+        self.assertEqual(
+            result, [{"entity": "http://www.wikidata.org/entity/Q1", "value": None}]
+        )
+        self.assertAlmostEqual(mock_get.call_args.kwargs["timeout"], 10, delta=1)
+
+    @patch("requests.get")
+    def test_select_with_deadline_timeout(self, mock_get):
+        mock_get.side_effect = requests.exceptions.Timeout("Request timed out")
+
+        engine = WdqsSparqlQueryEngine()
+        with self.assertRaises(QueryException):
+            engine.select("SELECT ?entity", cancel_token=CancelToken())
+        self.assertEqual(mock_get.call_args.kwargs["timeout"], 60)
+
 
 class QLeverSparqlQueryEngineTest(unittest.TestCase):
     def setUp(self):
@@ -98,6 +132,50 @@ class QLeverSparqlQueryEngineTest(unittest.TestCase):
         self.assertIn("QLever is not available", str(cm.exception))
         self.assertIsNotNone(cm.exception.query)
 
+    @patch("requests.get")
+    def test_select_with_cancel_token(self, mock_get):
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.iter_content.return_value = [
+            b'{"results": {"bindings": [{"entity": ',
+            b'{"value": "http://www.wikidata.org/entity/Q1"}}]}}',
+        ]
+
+        result = self.engine.select(
+            "SELECT ?entity WHERE { ?entity wdt:P31 wd:Q5 }",
+            cancel_token=CancelToken(),
+        )
+
+        self.assertEqual(result, [{"entity": "http://www.wikidata.org/entity/Q1"}])
+        self.assertTrue(mock_get.call_args.kwargs["stream"])
+        self.assertEqual(mock_get.call_args.kwargs["timeout"], 30)
+
+    def test_get_timeout(self):
+        budget = TimeBudget(3600)
+        self.assertEqual(self.engine.get_timeout(budget), 30)
+        with budget.query_deadline(360):
+            self.assertAlmostEqual(self.engine.get_timeout(budget), 10, delta=1)
+        budget = TimeBudget(0)
+        with budget.query_deadline(1):
+            self.assertEqual(self.engine.get_timeout(budget), 0.1)
+
+    @patch("requests.get")
+    def test_select_cancelled_while_streaming(self, mock_get):
+        cancel_token = CancelToken()
+
+        def iter_content(chunk_size):
+            yield b'{"results": '
+            cancel_token.cancel()
+            yield b'{"bindings": []}}'
+
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.iter_content.side_effect = iter_content
+
+        with self.assertRaises(UpdateCancelledException):
+            self.engine.select(
+                "SELECT ?entity WHERE { ?entity wdt:P31 wd:Q5 }",
+                cancel_token=cancel_token,
+            )
+
     def test_transform_response_valid(self):
         data = {
             "results": {
@@ -186,6 +264,7 @@ class SparqlEngineBuilderTest(unittest.TestCase):
         engine = SparqlEngineBuilder.make("qlever")
         self.assertIsInstance(engine, QLeverSparqlQueryEngine)
         self.assertEqual(engine.endpoint, "https://qlever.dev/api/wikidata")
+        self.assertEqual(engine.entity_url, "http://www.wikidata.org/entity/")
 
     def test_create_qlever_engine_commons_from_site_url(self):
         engine = SparqlEngineBuilder.make(
@@ -193,6 +272,7 @@ class SparqlEngineBuilderTest(unittest.TestCase):
         )
         self.assertIsInstance(engine, QLeverSparqlQueryEngine)
         self.assertEqual(engine.endpoint, "https://qlever.dev/api/wikimedia-commons")
+        self.assertEqual(engine.entity_url, "https://commons.wikimedia.org/entity/")
 
     def test_create_qlever_engine_commons_ignores_sparql_endpoint(self):
         engine = SparqlEngineBuilder.make(
@@ -292,3 +372,61 @@ class GetLabelsForSelectVarsTest(unittest.TestCase):
     def test_empty_list(self):
         result = get_labels_for_select_vars([])
         self.assertEqual(result, "\n")
+
+
+class CancellableSparqlQueryEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = Mock(spec=QLeverSparqlQueryEngine)
+        self.engine.name = "QLever"
+        self.cancel_token = CancelToken()
+        self.cancellable = CancellableSparqlQueryEngine(self.engine, self.cancel_token)
+
+    def test_select(self):
+        self.engine.select.return_value = [{"count": "1"}]
+        self.assertEqual(self.cancellable.select("SELECT"), [{"count": "1"}])
+        self.engine.select.assert_called_once_with(
+            "SELECT", cancel_token=self.cancel_token
+        )
+
+    def test_select_cancelled(self):
+        self.cancel_token.cancel()
+        with self.assertRaises(UpdateCancelledException):
+            self.cancellable.select("SELECT")
+        self.engine.select.assert_not_called()
+
+    def make_budgeted(self, side_effect):
+        budget = TimeBudget(3600)
+
+        def select(query, cancel_token):
+            # The query runs up to its deadline
+            budget._deadline = 0
+            return side_effect()
+
+        self.engine.select.side_effect = select
+        return budget, CancellableSparqlQueryEngine(self.engine, budget)
+
+    def test_select_past_deadline(self):
+        budget, cancellable = self.make_budgeted(lambda: [{"count": "1"}])
+        with budget.query_deadline(1):
+            with self.assertRaises(DeadlineExceededException):
+                cancellable.select("SELECT")
+
+    def test_select_timed_out_at_deadline(self):
+        def timed_out():
+            raise QueryException("QLever timed out", "SELECT")
+
+        budget, cancellable = self.make_budgeted(timed_out)
+        with budget.query_deadline(1):
+            with self.assertRaises(DeadlineExceededException):
+                cancellable.select("SELECT")
+
+    def test_select_failed_before_deadline(self):
+        budget = TimeBudget(3600)
+        cancellable = CancellableSparqlQueryEngine(self.engine, budget)
+        self.engine.select.side_effect = QueryException("QLever timed out", "SELECT")
+        with budget.query_deadline(1):
+            with self.assertRaises(QueryException):
+                cancellable.select("SELECT")
+
+    def test_attributes(self):
+        self.assertEqual(self.cancellable.name, "QLever")
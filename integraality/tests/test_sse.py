@@ -1,11 +1,18 @@
 import json
 import logging
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from ..sse import run_with_sse
+from ..sse import (
+    ProgressChannelHandler,
+    format_sse,
+    iter_progress_events,
+    propagate_context,
+    publish_partial_result,
+)
 
 
-class RunWithSSETest(unittest.TestCase):
+class ProgressEventsTest(unittest.TestCase):
     def test_success(self):
         def func():
             logger = logging.getLogger("integraality.update")
@@ -13,7 +20,7 @@ class RunWithSSETest(unittest.TestCase):
             logger.info("step 2")
             return 42.0
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -30,7 +37,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise ValueError("boom")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -44,7 +51,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise RuntimeError("unexpected")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -61,7 +68,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise QueryException("Timeout", "SELECT ?x WHERE {}")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -79,7 +86,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise ProcessingException("Bad config")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -96,7 +103,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise TransientServerException("503")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -113,7 +120,7 @@ class RunWithSSETest(unittest.TestCase):
         def func():
             raise ConfigException("missing property")
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -129,7 +136,7 @@ class RunWithSSETest(unittest.TestCase):
             logger.info("Querying P569...", extra={"query": "SELECT ?x WHERE {}"})
             return 1.0
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -146,7 +153,7 @@ class RunWithSSETest(unittest.TestCase):
             logger.info("Saving to wiki...")
             return 1.0
 
-        events = list(run_with_sse(func))
+        events = list(format_sse(iter_progress_events(func)))
         parsed = [
             json.loads(e.removeprefix("data: "))
             for e in events
@@ -155,3 +162,91 @@ class RunWithSSETest(unittest.TestCase):
         progress = [e for e in parsed if e["status"] == "progress"]
         self.assertEqual(len(progress), 1)
         self.assertIsNone(progress[0]["query"])
+
+
+class ProgressRoutingTest(unittest.TestCase):
+    def _messages(self, events):
+        return [e["message"] for e in events if e["status"] == "progress"]
+
+    def test_single_handler(self):
+        list(iter_progress_events(lambda: 1.0))
+        list(iter_progress_events(lambda: 2.0))
+        handlers = [
+            handler
+            for handler in logging.getLogger("integraality.update").handlers
+            if isinstance(handler, ProgressChannelHandler)
+        ]
+        self.assertEqual(len(handlers), 1)
+
+    def test_helper_threads(self):
+        logger = logging.getLogger("integraality.update")
+
+        def step(i):
+            logger.info(f"step {i}")
+            return i
+
+        def func():
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                return sum(executor.map(propagate_context(step), range(4)))
+
+        events = list(iter_progress_events(func))
+        self.assertEqual(
+            sorted(self._messages(events)), ["step 0", "step 1", "step 2", "step 3"]
+        )
+        self.assertEqual(events[-1], {"status": "done", "result": 6})
+
+    def test_concurrent_streams_are_isolated(self):
+        logger = logging.getLogger("integraality.update")
+
+        def make_func(name):
+            def func():
+                logger.info(f"{name} 1")
+                logger.info(f"{name} 2")
+                return name
+
+            return func
+
+        first = iter_progress_events(make_func("first"))
+        second = iter_progress_events(make_func("second"))
+        # Both updates run at the same time once their first event is read
+        first_events = [next(first)]
+        second_events = [next(second)]
+        first_events.extend(first)
+        second_events.extend(second)
+        self.assertEqual(self._messages(first_events), ["first 1", "first 2"])
+        self.assertEqual(self._messages(second_events), ["second 1", "second 2"])
+
+    def test_records_outside_streams_are_ignored(self):
+        logging.getLogger("integraality.update").info("Nobody listens")
+        events = list(iter_progress_events(lambda: 1.0))
+        self.assertEqual(events, [{"status": "done", "result": 1.0}])
+
+
+class PartialResultTest(unittest.TestCase):
+    def test_partial_result(self):
+        def func():
+            publish_partial_result({"kind": "column", "column": "P1", "cells": {}})
+            return 1.0
+
+        events = list(iter_progress_events(func))
+        self.assertEqual(
+            events,
+            [
+                {"status": "partial", "kind": "column", "column": "P1", "cells": {}},
+                {"status": "done", "result": 1.0},
+            ],
+        )
+
+    def test_partial_result_outside_streams_is_ignored(self):
+        publish_partial_result({"kind": "groupings", "groupings": []})
+        events = list(iter_progress_events(lambda: 1.0))
+        self.assertEqual(events, [{"status": "done", "result": 1.0}])
+
+
+class FormatSSETest(unittest.TestCase):
+    def test_keepalive(self):
+        events = list(format_sse([None, {"status": "done", "result": 1.0}]))
+        self.assertEqual(
+            events,
+            [": keepalive\n\n", 'data: {"status": "done", "result": 1.0}\n\n'],
+        )
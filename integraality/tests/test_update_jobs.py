@@ -0,0 +1,155 @@
+import threading
+import unittest
+
+import fakeredis
+
+from ..metrics import Metrics
+from ..update_jobs import UpdateJob, UpdateQueue
+
+
+class UpdateJobTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.url = "https://www.wikidata.org/wiki/"
+        self.job = UpdateJob(self.client, self.url, "Foo bar")
+
+    def test_keys(self):
+        self.assertEqual(
+            self.job.lock_key, "integraality:update:www.wikidata.org:Foo_bar:lock"
+        )
+
+    def test_single_runner(self):
+        other_job = UpdateJob(self.client, self.url, "Foo bar")
+        self.assertTrue(self.job.acquire())
+        self.assertFalse(other_job.acquire())
+        self.assertTrue(UpdateJob(self.client, self.url, "Other page").acquire())
+
+    def test_acquire_drops_previous_events(self):
+        self.assertTrue(self.job.acquire())
+        self.job.run(lambda cancel_token: 4.2)
+        self.assertTrue(self.job.acquire())
+        self.assertFalse(self.client.exists(self.job.events_key))
+        self.assertEqual(self.client.get(self.job.lock_key), self.job.token.encode())
+
+    def test_release_only_own_lock(self):
+        other_job = UpdateJob(self.client, self.url, "Foo bar")
+        self.assertTrue(self.job.acquire())
+        other_job.release()
+        self.assertTrue(self.client.exists(self.job.lock_key))
+        self.job.release()
+        self.assertTrue(other_job.acquire())
+
+    def test_run_records_events_and_releases(self):
+        self.assertTrue(self.job.acquire())
+        self.job.add_watcher()
+        self.job.run(lambda cancel_token: 4.2)
+        self.assertFalse(self.client.exists(self.job.lock_key))
+        events = list(UpdateJob(self.client, self.url, "Foo bar").iter_events())
+        self.assertEqual(events, [{"status": "done", "result": 4.2}])
+
+    def test_follower_replays_and_follows(self):
+        self.assertTrue(self.job.acquire())
+        self.job.record({"status": "progress", "message": "step 1"})
+        follower = UpdateJob(self.client, self.url, "Foo bar")
+        follower.POLL_INTERVAL = 0.01
+        events = []
+
+        def follow():
+            events.extend(follower.iter_events())
+
+        thread = threading.Thread(target=follow)
+        thread.start()
+        self.job.record({"status": "progress", "message": "step 2"})
+        self.job.record({"status": "done", "result": 1.0})
+        self.job.release()
+        thread.join(timeout=5)
+
+        self.assertEqual(
+            [event.get("message") for event in events], ["step 1", "step 2", None]
+        )
+        self.assertEqual(events[-1]["status"], "done")
+
+    def test_interrupted_update(self):
+        self.assertTrue(self.job.acquire())
+        self.job.record({"status": "progress", "message": "step 1"})
+        self.client.delete(self.job.lock_key)
+        events = list(UpdateJob(self.client, self.url, "Foo bar").iter_events())
+        self.assertEqual(events[0]["message"], "step 1")
+        self.assertEqual(events[-1]["status"], "error")
+        self.assertEqual(events[-1]["error_category"], "transient")
+
+    def test_abandoned_update_is_cancelled(self):
+        self.assertTrue(self.job.acquire())
+        watcher_id = self.job.add_watcher()
+        self.job.remove_watcher(watcher_id)
+
+        def func(cancel_token):
+            cancel_token.raise_if_cancelled()
+            return 1.0
+
+        self.job.run(func)
+        events = list(UpdateJob(self.client, self.url, "Foo bar").iter_events())
+        self.assertEqual(events[-1]["error_type"], "UpdateCancelledException")
+        self.assertEqual(Metrics(self.client).get_all(), {"updates_cancelled": 1})
+
+    def test_watched_update_is_not_cancelled(self):
+        self.assertTrue(self.job.acquire())
+        self.job.add_watcher()
+
+        def func(cancel_token):
+            cancel_token.raise_if_cancelled()
+            return 1.0
+
+        self.job.run(func)
+        events = list(UpdateJob(self.client, self.url, "Foo bar").iter_events())
+        self.assertEqual(events, [{"status": "done", "result": 1.0}])
+        self.assertEqual(Metrics(self.client).get_all(), {})
+
+    def test_closing_events_removes_watcher(self):
+        self.assertTrue(self.job.acquire())
+        self.job.record({"status": "progress", "message": "step 1"})
+        events = self.job.iter_events()
+        next(events)
+        self.assertFalse(self.job.is_abandoned())
+        events.close()
+        self.assertTrue(self.job.is_abandoned())
+
+
+class UpdateQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.queue = UpdateQueue(self.client)
+        self.url = "https://www.wikidata.org/wiki/"
+
+    def test_submit_and_pop(self):
+        job = UpdateJob(self.client, self.url, "Foo bar")
+        self.queue.submit(job)
+        popped = self.queue.pop(timeout=1)
+        self.assertEqual(popped.url, self.url)
+        self.assertEqual(popped.page_title, "Foo bar")
+        self.assertEqual(popped.token, job.token)
+        self.assertEqual(popped.lock_key, job.lock_key)
+
+    def test_queued_lock_is_refreshed(self):
+        job = UpdateJob(self.client, self.url, "Foo bar")
+        job.acquire()
+        self.client.expire(job.lock_key, 10)
+        self.queue.submit(job)
+        self.assertGreater(self.client.ttl(job.lock_key), 10)
+        self.client.expire(job.lock_key, 10)
+        self.queue.heartbeat("worker-1")
+        self.assertGreater(self.client.ttl(job.lock_key), 10)
+
+    def test_pop_empty(self):
+        self.assertIsNone(self.queue.pop(timeout=1))
+
+    def test_has_workers(self):
+        self.assertFalse(self.queue.has_workers())
+        self.queue.heartbeat("worker-1")
+        self.assertTrue(self.queue.has_workers())
+        self.queue.unregister("worker-1")
+        self.assertFalse(self.queue.has_workers())
+
+    def test_stale_workers_are_ignored(self):
+        self.client.zadd(self.queue.workers_key, {"worker-1": 0})
+        self.assertFalse(self.queue.has_workers())
@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import ANY, patch
+
+import fakeredis
+from redis.exceptions import ConnectionError
+
+from ..sse import publish_partial_result
+from ..update_jobs import UpdateJob, UpdateQueue
+from ..update_worker import UpdateWorker
+
+
+class UpdateWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.worker = UpdateWorker(self.client)
+        self.worker.POP_TIMEOUT = 1
+        self.url = "https://www.wikidata.org/wiki/"
+
+    def test_run_once_empty_queue(self):
+        self.assertFalse(self.worker.run_once())
+
+    @patch("integraality.update_worker.PagesProcessor", autospec=True)
+    def test_run_once(self, mock_pages_processor):
+        mock_pages_processor.return_value.process_one_page.return_value = 87.5
+        job = UpdateJob(self.client, self.url, "Foo bar")
+        self.assertTrue(job.acquire())
+        UpdateQueue(self.client).submit(job)
+
+        self.assertTrue(self.worker.run_once())
+
+        mock_pages_processor.assert_called_once_with(self.url)
+        mock_pages_processor.return_value.process_one_page.assert_called_once_with(
+            "Foo bar", cancel_token=ANY, result_callback=publish_partial_result
+        )
+        self.assertFalse(self.client.exists(job.lock_key))
+        self.assertEqual(list(job.iter_events()), [{"status": "done", "result": 87.5}])
+
+    @patch("integraality.update_worker.time.sleep")
+    def test_run_forever_survives_errors(self, mock_sleep):
+        with patch.object(
+            self.worker,
+            "run_once",
+            side_effect=[
+                ConnectionError("Connection refused"),
+                ConnectionError("Connection refused"),
+                True,
+                ValueError("Boom"),
+                KeyboardInterrupt(),
+            ],
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                self.worker.run_forever()
+        self.assertEqual(
+            [c.args[0] for c in mock_sleep.call_args_list],
+            [1, 2, 1],
+        )
+        self.assertFalse(UpdateQueue(self.client).has_workers())
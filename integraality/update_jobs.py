@@ -0,0 +1,253 @@
+"""Coordination of on-demand dashboard updates across web workers."""
+
+import json
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+from redis.exceptions import WatchError
+
+from .cancellation import CancelToken, UpdateCancelledException
+from .metrics import Metrics
+from .sse import is_final_event, iter_progress_events
+
+LOCK_TTL = (
+    900  # Refreshed while queued and on every event, so only bounds crashed updates
+)
+EVENTS_TTL = 600  # Lets late requesters replay a finished update
+WORKER_TIMEOUT = 60  # Workers not seen for that long are considered gone
+WATCHER_TIMEOUT = 30  # Same for requesters following an update
+KEEPALIVE_INTERVAL = 10  # Lets the web server notice disconnected clients
+
+
+class UpdateJob:
+    """
+    An update of one dashboard page, shared by everyone who requested it.
+
+    The first requester takes a per-(site, page) lock in Redis and has the
+    update run, by a worker process or in a thread of its own. Progress events
+    are appended to a Redis list and published on a channel: all requesters
+    replay the events emitted so far from the list, then follow the running
+    update from the channel instead of starting a duplicate one.
+
+    Requesters also register as watchers while they follow the update: once
+    none is left, the update is cancelled at its next query.
+    """
+
+    POLL_INTERVAL = 0.2
+
+    def __init__(
+        self, cache_client, url, page_title, token=None, prefix="integraality:update"
+    ):
+        self.client = cache_client
+        self.url = url
+        self.page_title = page_title
+        key = ":".join([prefix, urlparse(url).netloc, page_title]).replace(" ", "_")
+        self.lock_key = f"{key}:lock"
+        self.events_key = f"{key}:events"
+        self.channel = f"{key}:channel"
+        self.watchers_key = f"{key}:watchers"
+        self.token = token or uuid.uuid4().hex
+
+    def acquire(self):
+        """Try to become the runner of the update. Return True on success."""
+        # The lock is taken and the events of the previous run dropped in one
+        # transaction, so that no follower replays them as those of this run
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if pipe.exists(self.lock_key):
+                    return False
+                pipe.multi()
+                pipe.set(self.lock_key, self.token, ex=LOCK_TTL)
+                pipe.delete(self.events_key)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def release(self):
+        """Release the lock, unless it has expired and been taken over."""
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.lock_key)
+                if pipe.get(self.lock_key) == self.token.encode():
+                    pipe.multi()
+                    pipe.delete(self.lock_key)
+                    pipe.execute()
+            except WatchError:
+                pass
+
+    def record(self, event):
+        """Append the event to the log, then publish it with its position."""
+        pipe = self.client.pipeline()
+        pipe.rpush(self.events_key, json.dumps(event))
+        pipe.expire(self.events_key, EVENTS_TTL if is_final_event(event) else LOCK_TTL)
+        pipe.expire(self.lock_key, LOCK_TTL)
+        length = pipe.execute()[0]
+        self.client.publish(self.channel, json.dumps([length - 1, event]))
+
+    def add_watcher(self, watcher_id=None):
+        """Register (or refresh) a requester following the update."""
+        watcher_id = watcher_id or uuid.uuid4().hex
+        pipe = self.client.pipeline()
+        pipe.zadd(self.watchers_key, {watcher_id: time.time()})
+        pipe.expire(self.watchers_key, LOCK_TTL)
+        pipe.execute()
+        return watcher_id
+
+    def remove_watcher(self, watcher_id):
+        self.client.zrem(self.watchers_key, watcher_id)
+
+    def is_abandoned(self):
+        """Whether no requester has followed the update for WATCHER_TIMEOUT."""
+        now = time.time()
+        self.client.zremrangebyscore(self.watchers_key, 0, now - WATCHER_TIMEOUT)
+        return self.client.zcard(self.watchers_key) == 0
+
+    def run(self, func):
+        """
+        Run func, recording its progress events, then release the lock.
+
+        func is given a cancel token to check, cancelled once the update is
+        abandoned.
+        """
+        cancel_token = CancelToken(check=self.is_abandoned)
+        try:
+            for event in iter_progress_events(lambda: func(cancel_token)):
+                self.record(event)
+                if event.get("error_type") == UpdateCancelledException.__name__:
+                    Metrics(self.client).incr("updates_cancelled")
+        finally:
+            self.release()
+
+    def start(self, func):
+        """Run func in a background thread of this process."""
+        thread = threading.Thread(target=self.run, args=(func,), daemon=True)
+        thread.start()
+        return thread
+
+    def iter_events(self, watcher_id=None):
+        """
+        Yield the events of the update from its start until it ends.
+
+        None is yielded every KEEPALIVE_INTERVAL without any event, so that
+        the caller writes something and finds out if its client is gone.
+        """
+        watcher_id = self.add_watcher(watcher_id)
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before reading the log, so that no event falls in between
+        pubsub.subscribe(self.channel)
+        try:
+            yield from self._iter_events(pubsub, watcher_id)
+        finally:
+            pubsub.close()
+            self.remove_watcher(watcher_id)
+
+    def _iter_events(self, pubsub, watcher_id):
+        offset = 0
+        lock_lost = False
+        last_seen = last_yield = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - last_seen >= WATCHER_TIMEOUT / 3:
+                self.add_watcher(watcher_id)
+                last_seen = now
+            if now - last_yield >= KEEPALIVE_INTERVAL:
+                last_yield = now
+                yield None
+
+            raw_events = self.client.lrange(self.events_key, offset, -1)
+            offset += len(raw_events)
+            for raw_event in raw_events:
+                event = json.loads(raw_event)
+                last_yield = time.monotonic()
+                yield event
+                if is_final_event(event):
+                    return
+
+            message = pubsub.get_message(timeout=self.POLL_INTERVAL)
+            if message is None:
+                if lock_lost:
+                    # The log was read once more after noticing the lock was
+                    # gone, as the update may have finished in between.
+                    yield {
+                        "status": "error",
+                        "error_type": "InterruptedUpdate",
+                        "error_category": "transient",
+                        "message": "The update was interrupted. Please try again.",
+                    }
+                    return
+                lock_lost = not self.client.exists(self.lock_key)
+                continue
+
+            lock_lost = False
+            while message:
+                position, event = json.loads(message["data"])
+                if position > offset:
+                    # Missed an event: catch up from the log.
+                    break
+                if position == offset:
+                    offset += 1
+                    last_yield = time.monotonic()
+                    yield event
+                    if is_final_event(event):
+                        return
+                message = pubsub.get_message()
+
+
+class UpdateQueue:
+    """
+    Redis-backed queue of updates, consumed by update_worker processes.
+
+    Workers register a heartbeat, so that updates are only queued when at
+    least one worker is alive to consume them. The heartbeat also refreshes
+    the locks of the queued updates, which record no events while waiting.
+    """
+
+    def __init__(self, cache_client, prefix="integraality:update"):
+        self.client = cache_client
+        self.queue_key = f"{prefix}:queue"
+        self.workers_key = f"{prefix}:workers"
+
+    def submit(self, job):
+        payload = {"url": job.url, "page_title": job.page_title, "token": job.token}
+        pipe = self.client.pipeline()
+        pipe.lpush(self.queue_key, json.dumps(payload))
+        pipe.expire(job.lock_key, LOCK_TTL)
+        pipe.execute()
+
+    def pop(self, timeout):
+        """Wait for a queued update; return its UpdateJob, or None on timeout."""
+        item = self.client.brpop(self.queue_key, timeout=timeout)
+        if not item:
+            return None
+        return self._make_job(item[1])
+
+    def get_queued_jobs(self):
+        return [
+            self._make_job(raw_payload)
+            for raw_payload in self.client.lrange(self.queue_key, 0, -1)
+        ]
+
+    def _make_job(self, raw_payload):
+        payload = json.loads(raw_payload)
+        return UpdateJob(
+            self.client, payload["url"], payload["page_title"], payload["token"]
+        )
+
+    def heartbeat(self, worker_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(self.workers_key, {worker_id: time.time()})
+        for job in self.get_queued_jobs():
+            pipe.expire(job.lock_key, LOCK_TTL)
+        pipe.execute()
+
+    def unregister(self, worker_id):
+        self.client.zrem(self.workers_key, worker_id)
+
+    def has_workers(self):
+        now = time.time()
+        self.client.zremrangebyscore(self.workers_key, 0, now - WORKER_TIMEOUT)
+        return self.client.zcard(self.workers_key) > 0
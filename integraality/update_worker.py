@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Worker processes running the on-demand updates queued by the web app."""
+
+import functools
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from .cache import get_cache_client
+from .pages_processor import PagesProcessor
+from .sse import publish_partial_result
+from .update_jobs import WORKER_TIMEOUT, UpdateQueue
+
+logger = logging.getLogger(__name__)
+
+
+def run_update(url, page_title, cancel_token=None):
+    processor = PagesProcessor(url)
+    return processor.process_one_page(
+        page_title,
+        cancel_token=cancel_token,
+        result_callback=publish_partial_result,
+    )
+
+
+class UpdateWorker:
+    """Consume the update queue, running one update at a time."""
+
+    POP_TIMEOUT = 5
+    # Seconds waited after an error, doubled on each error in a row
+    ERROR_BACKOFF = 1
+    MAX_ERROR_BACKOFF = 60
+
+    def __init__(self, cache_client):
+        self.queue = UpdateQueue(cache_client)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopped = threading.Event()
+
+    def _keep_alive(self):
+        while not self._stopped.wait(WORKER_TIMEOUT / 3):
+            try:
+                self.queue.heartbeat(self.worker_id)
+            except Exception:
+                logger.exception("Heartbeat of worker %s failed", self.worker_id)
+
+    def run_once(self):
+        job = self.queue.pop(timeout=self.POP_TIMEOUT)
+        if job is None:
+            return False
+        logger.info("Updating %s on %s", job.page_title, job.url)
+        job.run(functools.partial(run_update, job.url, job.page_title))
+        return True
+
+    def run_forever(self):
+        """
+        Run the queued updates until interrupted.
+
+        Errors, e.g. from a lost connection to Redis, are logged and the
+        worker carries on after a backoff, rather than dying silently.
+        """
+        heartbeat_thread = threading.Thread(target=self._keep_alive, daemon=True)
+        heartbeat_thread.start()
+        backoff = self.ERROR_BACKOFF
+        try:
+            self.queue.heartbeat(self.worker_id)
+            while True:
+                try:
+                    self.run_once()
+                except Exception:
+                    logger.exception(
+                        "Worker %s failed, retrying in %d seconds",
+                        self.worker_id,
+                        backoff,
+                    )
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.MAX_ERROR_BACKOFF)
+                else:
+                    backoff = self.ERROR_BACKOFF
+        finally:
+            self._stopped.set()
+            try:
+                self.queue.unregister(self.worker_id)
+            except Exception:
+                logger.exception("Could not unregister worker %s", self.worker_id)
+
+
+def _run_worker():
+    logging.basicConfig(level=logging.INFO)
+    UpdateWorker(get_cache_client()).run_forever()
+
+
+def args_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run queued dashboard updates")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=2,
+        help="maximum number of updates running at the same time",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = args_parser()
+    processes = [
+        multiprocessing.Process(target=_run_worker) for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()